@@ -0,0 +1,79 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Measure the latency of OpBlockedArrayCache requests that touch 1, 64 and 1024 blocks.
+
+The cache is warmed up first, so the numbers show the per-request overhead of 
+the blocked cache (block bookkeeping, request dispatch and copying), 
+not the cost of computing the data.
+
+Usage: python blockedCacheLatency.py [iterations]
+"""
+import sys
+import time
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper, OpBlockedArrayCache
+
+BLOCKSHAPE = (16, 16, 16, 1)
+
+# Request shapes (in blocks) that touch 1, 64 and 1024 blocks
+REQUEST_BLOCKS = [ (1, 1, 1), (4, 4, 4), (8, 8, 16) ]
+
+def main(iterations):
+    data = numpy.random.randint( 0, 255, (128, 128, 256, 1) ).astype( numpy.uint8 )
+    data = data.view( vigra.VigraArray )
+    data.axistags = vigra.defaultAxistags('xyzc')
+
+    graph = Graph()
+    opData = OpArrayPiper( graph=graph )
+    opData.Input.setValue( data )
+
+    opCache = OpBlockedArrayCache( graph=graph )
+    opCache.Input.connect( opData.Output )
+    opCache.innerBlockShape.setValue( BLOCKSHAPE )
+    opCache.outerBlockShape.setValue( BLOCKSHAPE )
+    opCache.fixAtCurrent.setValue( False )
+
+    for request_blocks in REQUEST_BLOCKS:
+        num_blocks = numpy.prod( request_blocks )
+        stop = tuple( numpy.multiply( request_blocks, BLOCKSHAPE[:3] ) ) + (1,)
+        start = (0,0,0,0)
+
+        # Warm up the cache
+        opCache.Output( start, stop ).wait()
+
+        t = time.time()
+        for _ in range(iterations):
+            opCache.Output( start, stop ).wait()
+        latency = (time.time() - t) / iterations
+        print "{:5d} blocks: {:8.3f} ms per request ({:.1f} us per block)"\
+              .format( num_blocks, 1000*latency, 1e6*latency/num_blocks )
+
+if __name__ == "__main__":
+    iterations = 20
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    main(iterations)
@@ -0,0 +1,88 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Compare the throughput (tasks/sec) of the ThreadPool schedulers under contention.
+
+Each root request spawns a fan-out of child requests, which in turn spawn many tiny leaf requests.
+This is the typical shape of a lazyflow computation (e.g. a blocked cache request that fans out
+into per-block requests) and is where the single shared queue of the 'shared' scheduler suffers most.
+
+Usage: python schedulerContention.py [num_workers] [leaf_size]
+
+With leaf_size=0 (the default), the leaves do no work at all and the benchmark measures pure scheduling overhead.
+Otherwise, each leaf multiplies two (leaf_size x leaf_size) matrices, which releases the GIL like real operators do.
+"""
+import sys
+import time
+import multiprocessing
+
+import numpy
+
+from lazyflow.request import Request
+
+NUM_ROOTS = 4
+NUM_CHILDREN = 100
+NUM_LEAVES = 100
+LEAF_SIZE = 0
+
+def leaf():
+    if LEAF_SIZE > 0:
+        a = numpy.ones( (LEAF_SIZE, LEAF_SIZE), dtype=numpy.float32 )
+        numpy.dot(a, a)
+    return 1
+
+def child():
+    requests = [Request(leaf) for _ in range(NUM_LEAVES)]
+    for r in requests:
+        r.submit()
+    return sum( r.wait() for r in requests )
+
+def root():
+    requests = [Request(child) for _ in range(NUM_CHILDREN)]
+    for r in requests:
+        r.submit()
+    return sum( r.wait() for r in requests )
+
+def benchmark(num_workers, scheduler):
+    Request.reset_thread_pool( num_workers, scheduler=scheduler )
+
+    num_tasks = NUM_ROOTS * (1 + NUM_CHILDREN * (1 + NUM_LEAVES))
+    t1 = time.time()
+    requests = [Request(root) for _ in range(NUM_ROOTS)]
+    for r in requests:
+        r.submit()
+    total = sum( r.wait() for r in requests )
+    t2 = time.time()
+    assert total == NUM_ROOTS * NUM_CHILDREN * NUM_LEAVES
+
+    print "SCHEDULER {:>10}:   {:f} seconds for {} tasks with {} workers".format( scheduler, t2-t1, num_tasks, num_workers )
+    print "                        {:.0f} tasks/sec".format( num_tasks / (t2-t1) )
+
+if __name__ == "__main__":
+    num_workers = multiprocessing.cpu_count()
+    if len(sys.argv) > 1:
+        num_workers = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        LEAF_SIZE = int(sys.argv[2])
+
+    for scheduler in ('shared', 'stealing'):
+        benchmark(num_workers, scheduler)
@@ -550,6 +550,22 @@ class Operator(object):
         raise NotImplementedError("Operator {} does not implement"
                                   " execute()".format(self.name))
 
+    def executeReadOnly(self, slot, subindex, roi):
+        """Optional.  This method is called instead of execute() when
+        the caller asked for read-only data (see Slot.get()) and didn't
+        provide a result area.
+
+        Operators that already hold the requested data (e.g. caches)
+        or merely pass it through (e.g. pipers) can return it here
+        without copying it.  The returned array will be made read-only
+        before it is handed to the caller, so the operator must not
+        modify its contents in-place while the caller may still hold
+        it (copy-on-write).
+
+        Return None to fall back to execute() with a newly allocated
+        result area. """
+        return None
+
     def setInSlot(self, slot, subindex, key, value):
         raise NotImplementedError("Can't use __setitem__ with Operator {}"
                                   " because it doesn't implement"
@@ -23,6 +23,8 @@
 import gc
 import os
 import time
+import heapq
+import itertools
 import threading
 import platform
 import logging
@@ -30,7 +32,6 @@ logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
 
 #external dependencies
-import blist
 import psutil
 
 #lazyflow
@@ -71,7 +72,85 @@ class MemInfoNode:
         self.name = None
         self.children = []
 
+class LruEvictionPolicy(object):
+    """
+    Evict the caches that were used least recently (and least frequently) first.
+
+    The priority of a cache at time t is ``0.5 * _cache_priority + (t - _last_access)`` 
+    (see ``OpArrayCache._updatePriority``), and the cache with the highest priority is evicted first.
+    Since t is the same for all caches, we can drop it, which makes the eviction key 
+    constant between accesses.
+    """
+    
+    def evictionKey(self, array_cache, registration_time):
+        """
+        Return the eviction key of a cache.  Caches with the lowest key are evicted first.
+        Accessing a cache must never decrease its key.
+        """
+        last_access = array_cache._last_access
+        if last_access is None:
+            last_access = registration_time
+        return last_access - 0.5 * array_cache._cache_priority
+
+    def touched(self, array_cache):
+        """
+        Called when a cache is accessed (or allocated).
+        """
+        pass
+
+    def evicted(self, array_cache, key):
+        """
+        Called when a cache has been selected for eviction.
+        """
+        pass
+
+class CostAwareEvictionPolicy(object):
+    """
+    GreedyDual-Size eviction: Each cache is valued by the time it took to compute its 
+    contents, per byte of memory it holds.  Cheap, large caches are evicted before 
+    expensive, small ones.
+    
+    To prevent expensive caches from staying forever, values are aged with a global 
+    'inflation' value, which is raised to the key of each evicted cache.  A cache that 
+    is accessed gets the current inflation added to its value, so recently used caches 
+    are still preferred over stale ones of equal cost.
+    """
+    
+    def __init__(self):
+        self.inflation = 0.0
+
+    def evictionKey(self, array_cache, registration_time):
+        inflation = getattr(array_cache, '_eviction_inflation', self.inflation)
+        nbytes = array_cache.usedMemory()
+        if not nbytes:
+            return inflation
+        return inflation + array_cache.computeTime() / float(nbytes)
+
+    def touched(self, array_cache):
+        array_cache._eviction_inflation = self.inflation
+
+    def evicted(self, array_cache, key):
+        self.inflation = max(self.inflation, key)
+
 class ArrayCacheMemoryMgr(threading.Thread):
+    """
+    Keeps track of the memory consumed by all array caches, and frees the least 
+    valuable caches when memory runs low.
+
+    Caches report every allocation and every free via :py:meth:`reportAllocation` and 
+    :py:meth:`reportFree`, so the manager always knows exactly how many bytes are held by 
+    caches.  As soon as an allocation pushes that total over the cache budget (or the 
+    process exceeds its RAM limit), the manager thread is woken up and evicts caches 
+    until usage is back below the target.
+
+    Which caches are evicted first is decided by a pluggable policy 
+    (:py:class:`LruEvictionPolicy` by default, or :py:class:`CostAwareEvictionPolicy`).
+    Eviction candidates are kept in a heap ordered by the policy's eviction key.
+    Accessing a cache only ever raises its key, so the stored heap keys are lower bounds 
+    and are refreshed lazily when they reach the top.  The only event that can lower a 
+    key is an allocation (a bigger cache is cheaper per byte), so the heap entry is 
+    re-keyed immediately in :py:meth:`reportAllocation`.
+    """
     
     totalCacheMemory = OrderedSignal()
 
@@ -79,22 +158,41 @@ class ArrayCacheMemoryMgr(threading.Thread):
     logger = logging.getLogger(loggingName)
     traceLogger = logging.getLogger("TRACE." + loggingName)
 
+    # Seconds between two reports of RAM usage / totalCacheMemory
+    _report_interval = 10.0
+
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
 
-        self.caches = self._new_list()
         self.namedCaches = []
 
+        # Percentages of available RAM
         self._max_usage = 85
         self._target_usage = 70
+
+        # Budget for the memory held by caches (bytes).  None means "derive from _max_usage/_target_usage"
+        self._max_cache_bytes = None
+        self._target_cache_bytes = None
+
         self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
         self._last_usage = memoryUsagePercentage()
 
-    def _new_list(self):
-        def getPrio(array_cache):
-            return array_cache._cache_priority
-        return blist.sortedlist((), getPrio)
+        # Set when an allocation exceeds the cache budget (protected by self._condition)
+        self._eviction_requested = False
+
+        # Exact bookkeeping of the bytes held by each cache
+        self._cache_bytes = {}
+        self._total_cache_bytes = 0
+
+        self._policy = LruEvictionPolicy()
+
+        # Eviction heap: entries are [ key, sequence, cache, registration_time ]
+        # Entries for removed caches are invalidated (cache is None) rather than deleted.
+        self._heap = []
+        self._heap_entries = {}
+        self._sequence = itertools.count()
 
     def addNamedCache(self, array_cache):
         """add a cache to a special list of named caches
@@ -106,70 +204,224 @@ class ArrayCacheMemoryMgr(threading.Thread):
         """
         self.namedCaches.append(array_cache)
 
+    def setCacheBudget(self, max_bytes, target_bytes=None):
+        """
+        Limit the total memory held by caches.  When an allocation pushes the total over 
+        ``max_bytes``, caches are freed until at most ``target_bytes`` are left.
+        If ``max_bytes`` is None, the budget is derived from the total RAM usage limits again.
+        """
+        with self._condition:
+            self._max_cache_bytes = max_bytes
+            if max_bytes is not None and target_bytes is None:
+                target_bytes = max_bytes * float(self._target_usage) / self._max_usage
+            self._target_cache_bytes = target_bytes
+            self._eviction_requested = True
+            self._condition.notify()
+
+    @property
+    def policy(self):
+        return self._policy
+
+    def setEvictionPolicy(self, policy):
+        """
+        Change the strategy used to choose which caches are evicted first.
+        (e.g. :py:class:`LruEvictionPolicy` or :py:class:`CostAwareEvictionPolicy`)
+        """
+        with self._lock:
+            self._policy = policy
+            entries = self._heap_entries.values()
+            self._heap = []
+            self._heap_entries = {}
+            for entry in entries:
+                policy.touched(entry[2])
+                self._push(entry[2], entry[3])
+
+    def _cacheBudget(self):
+        """
+        Return ( max_bytes, target_bytes ) for the memory held by caches.
+        """
+        if self._max_cache_bytes is not None:
+            return self._max_cache_bytes, self._target_cache_bytes
+        available = getAvailableRamBytes()
+        return available * self._max_usage / 100.0, available * self._target_usage / 100.0
+
     def add(self, array_cache):
+        """
+        Register a cache as a candidate for eviction.
+        """
         with self._lock:
-            self.caches.add(array_cache)
+            if array_cache in self._heap_entries:
+                return
+            self._policy.touched(array_cache)
+            self._push(array_cache, time.time())
 
     def remove(self, array_cache):
+        """
+        Forget about a cache (e.g. when it is cleaned up).
+        """
+        with self._lock:
+            entry = self._heap_entries.pop(array_cache, None)
+            if entry is not None:
+                entry[2] = None
+            self._total_cache_bytes -= self._cache_bytes.pop(array_cache, 0)
+
+    def reportAllocation(self, array_cache, nbytes):
+        """
+        Called by a cache after it allocated ``nbytes`` of memory.
+        Wakes up the manager thread if the cache budget is exceeded.
+        """
+        with self._condition:
+            self._cache_bytes[array_cache] = self._cache_bytes.get(array_cache, 0) + nbytes
+            self._total_cache_bytes += nbytes
+            self._rekey(array_cache)
+            if self._total_cache_bytes > self._cacheBudget()[0]:
+                self._eviction_requested = True
+                self._condition.notify()
+
+    def reportFree(self, array_cache, nbytes):
+        """
+        Called by a cache after it released ``nbytes`` of memory.
+        """
+        with self._lock:
+            remaining = self._cache_bytes.get(array_cache, 0) - nbytes
+            if remaining > 0:
+                self._cache_bytes[array_cache] = remaining
+            else:
+                self._cache_bytes.pop(array_cache, None)
+            self._total_cache_bytes -= nbytes
+
+    def totalCacheBytes(self):
+        """
+        Return the exact number of bytes currently held by all registered caches.
+        """
+        return self._total_cache_bytes
+
+    def _push(self, array_cache, registration_time):
+        """
+        Must be called with self._lock held.
+        """
+        key = self._policy.evictionKey(array_cache, registration_time)
+        entry = [key, self._sequence.next(), array_cache, registration_time]
+        self._heap_entries[array_cache] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _rekey(self, array_cache):
+        """
+        Re-insert the cache's heap entry if its eviction key dropped below the stored one,
+        which would otherwise break the lower-bound invariant of the heap.
+        Must be called with self._lock held.
+        """
+        entry = self._heap_entries.get(array_cache)
+        if entry is None:
+            return
+        stored_key, _, _, registration_time = entry
+        if self._policy.evictionKey(array_cache, registration_time) < stored_key:
+            entry[2] = None
+            self._push(array_cache, registration_time)
+
+            # Don't let the heap fill up with invalidated entries.
+            if len(self._heap) > 2*len(self._heap_entries) + 16:
+                self._heap = [ e for e in self._heap if e[2] is not None ]
+                heapq.heapify(self._heap)
+
+    def _popVictim(self):
+        """
+        Remove and return the cache with the lowest eviction key, or None if there are no caches left.
+        Must be called with self._lock held.
+        """
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            stored_key, _, array_cache, registration_time = entry
+            if array_cache is None:
+                # Removed
+                continue
+            # The stored key is a lower bound.  If it's stale, re-insert with the real key.
+            key = self._policy.evictionKey(array_cache, registration_time)
+            if key > stored_key:
+                self._push(array_cache, registration_time)
+                continue
+            del self._heap_entries[array_cache]
+            self._policy.evicted(array_cache, key)
+            return array_cache
+        return None
+
+    def _overBudget(self):
+        """
+        Return True if either the caches or the whole process use too much memory.
+        """
+        return self._total_cache_bytes > self._cacheBudget()[0] \
+            or memoryUsagePercentage() > self._max_usage
+
+    def _aboveTarget(self):
+        return self._total_cache_bytes > self._cacheBudget()[1] \
+            or memoryUsagePercentage() > self._target_usage
+
+    def _freeMemory(self):
+        """
+        Evict caches until we're below the target usage again.
+        """
+        self.logger.info("freeing memory...")
+        count = 0
+        not_freed = []
         with self._lock:
-            try:
-                self.caches.remove(array_cache)
-            except ValueError:
-                pass
+            old_length = len(self._heap_entries)
+        gc.collect()
+        self.traceLogger.debug("Target mem usage: {}% (caches: {} bytes)".format(self._target_usage, self._cacheBudget()[1]))
+        while self._aboveTarget():
+            with self._lock:
+                victim = self._popVictim()
+            if victim is None:
+                break
+            # Must not hold our own lock here: The cache reports the freed memory to us.
+            freed = victim._freeMemory(refcheck = True)
+            self.traceLogger.debug("Freed: {}".format(freed))
+            count += 1
+            if not freed:
+                # store the caches which could not be freed
+                not_freed.append(victim)
+
+        gc.collect()
+
+        self.logger.info("freed %d/%d blocks, new usage = %f%%, cache usage = %d bytes" 
+                         % (count, old_length, memoryUsagePercentage(), self._total_cache_bytes))
+        
+        for c in not_freed:
+            # add the caches which could not be freed
+            self.add(c)
+
+    def _reportUsage(self):
+        mem_usage = memoryUsagePercentage()
+        mem_usage_gb = memoryUsageGB()
+        delta = abs(self._last_usage - mem_usage)
+        if delta > 10 or self.logger.level == logging.DEBUG:
+            cpu_usages = psutil.cpu_percent(interval=1, percpu=True)
+            avg = sum(cpu_usages) / len(cpu_usages)
+            self.logger.info( "RAM: {:1.3f} GB ({:02.0f}%), CPU: Avg={:02.0f}%, {}".format( mem_usage_gb, mem_usage, avg, cpu_usages ))
+        if delta > 10:
+            self._last_usage = mem_usage
+
+        #calculate total memory usage and send as signal
+        tot = 0.0
+        for c in self.namedCaches:
+            if c.usedMemory() is None:
+                continue
+            else:
+                tot += c.usedMemory()
+        self.totalCacheMemory(tot)
 
     def run(self):
+        next_report = time.time()
         while True:
-            mem_usage = memoryUsagePercentage()
-            mem_usage_gb = memoryUsageGB()
-            delta = abs(self._last_usage - mem_usage)
-            if delta > 10 or self.logger.level == logging.DEBUG:
-                cpu_usages = psutil.cpu_percent(interval=1, percpu=True)
-                avg = sum(cpu_usages) / len(cpu_usages)
-                self.logger.info( "RAM: {:1.3f} GB ({:02.0f}%), CPU: Avg={:02.0f}%, {}".format( mem_usage_gb, mem_usage, avg, cpu_usages ))
-            if delta > 10:
-                self._last_usage = mem_usage
-
-            #calculate total memory usage and send as signal
-            tot = 0.0
-            for c in self.namedCaches:
-                if c.usedMemory() is None:
-                    continue
-                else:
-                    tot += c.usedMemory()
-            self.totalCacheMemory(tot)
-                
-            time.sleep(10)
-
-            if mem_usage > self._max_usage:
-                self.logger.info("freeing memory...")
-                with self._lock:
-                    count = 0
-                    not_freed = []
-                    old_length = len(self.caches)
-                    new_caches = self._new_list()
-                    self.traceLogger.debug("Updating {} caches".format( len(self.caches) ))
-                    for c in iter(self.caches):
-                        c._updatePriority(c._last_access)
-                        new_caches.add(c)
-                    self.caches = new_caches
-                    gc.collect()
-                    self.traceLogger.debug("Target mem usage: {}".format(self._target_usage))
-                    while mem_usage > self._target_usage and len(self.caches) > 0:
-                        self.traceLogger.debug("Mem usage: {}".format(mem_usage))
-                        last_cache = self.caches.pop(-1)
-                            
-                        freed = last_cache._freeMemory(refcheck = True)
-                        self.traceLogger.debug("Freed: {}".format(freed))
-                        mem_usage = memoryUsagePercentage()
-                        count += 1
-                        if freed == 0:
-                            # store the caches which could not be freed
-                            not_freed.append(last_cache)
-
-                gc.collect()
-
-                self.logger.info("freed %d/%d blocks, new usage = %f%%" % (count,old_length, mem_usage))
-                
-                for c in not_freed:
-                    # add the caches which could not be freed
-                    self.add(c)
+            if time.time() >= next_report:
+                self._reportUsage()
+                next_report = time.time() + self._report_interval
+
+            if self._overBudget():
+                self._freeMemory()
+
+            # Sleep until a cache reports an allocation that exceeds the budget, or it's time for the next report.
+            # (The periodic check is a safety net for memory that isn't held by caches.)
+            with self._condition:
+                if not self._eviction_requested:
+                    self._condition.wait( max(0.0, next_report - time.time()) )
+                self._eviction_requested = False
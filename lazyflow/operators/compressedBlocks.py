@@ -0,0 +1,307 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Storage backends for the blocks of the OpCompressedCache.
+
+Each block class stores a single compressed nd-array of fixed shape and dtype,
+and supports numpy-style reading and writing via __getitem__ and __setitem__.
+Blocks that have never been written read as zeros.
+
+Blocks that support it can also be spilled to a DiskSpillStore, which frees
+their memory without losing their contents.
+"""
+# Built-in
+import threading
+
+# Third-party
+import numpy
+import h5py
+
+from lazyflow.operators.diskSpillStore import SpilledBuffer
+
+try:
+    import blosc
+    _blosc_available = True
+except ImportError:
+    _blosc_available = False
+
+class Hdf5CompressedBlock(object):
+    """
+    Stores the block as an lzf-compressed dataset in its own in-memory hdf5 file.
+    """
+    def __init__(self, shape, dtype, chunkshape=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+
+        # Create an in-memory hdf5 file with a unique name
+        filename = str(id(self))
+        self._file = h5py.File(filename, driver='core', backing_store=False, mode='w')
+
+        if chunkshape is not None:
+            # h5py will crash if the chunkshape is larger than the dataset shape.
+            chunkshape = tuple( numpy.minimum(self.shape, chunkshape) )
+
+        # Make a compressed dataset
+        self._file.create_dataset('data',
+                                  shape=self.shape,
+                                  dtype=self.dtype,
+                                  chunks=chunkshape,
+                                  compression='lzf' ) # lzf should be faster than gzip,
+                                                      # with a slightly worse compression ratio
+
+    def __getitem__(self, slicing):
+        return self._file['data'][slicing]
+
+    def __setitem__(self, slicing, data):
+        self._file['data'][slicing] = data
+
+    def readInto(self, slicing, destination):
+        """
+        Copy the given portion of the block into the given array.
+        """
+        destination[...] = self._file['data'][slicing]
+
+    def storageSize(self):
+        """
+        Return the number of (compressed) bytes this block occupies.
+        """
+        return self._file['data'].id.get_storage_size()
+
+    def exportHdf5(self, group, name):
+        """
+        Store the block's contents as a new dataset in the given hdf5 group.
+        """
+        group.copy( self._file['data'], name )
+
+    def importHdf5(self, dataset):
+        """
+        Replace the block's contents with the contents of the given hdf5 dataset.
+        """
+        assert dataset.dtype == self.dtype
+        assert dataset.shape == self.shape
+        del self._file['data']
+        self._file.copy( dataset, 'data' )
+
+    def spill(self, spill_store):
+        """
+        Hdf5 blocks can't be spilled to disk.  Return the number of bytes freed (always 0).
+        """
+        return 0
+
+    def isSpilled(self):
+        return False
+
+    def unspill(self):
+        pass
+
+    def close(self):
+        self._file.close()
+
+class BloscCompressedBlock(object):
+    """
+    Stores the block as a single blosc-compressed buffer.
+
+    Blosc compresses and decompresses with multiple threads and uses a shuffle
+    filter, which is much faster than hdf5's lzf filter and avoids the
+    overhead of an hdf5 file per block.  Since the whole block is compressed
+    as one buffer, partial writes must decompress and recompress the block.
+
+    The compressed buffer can be spilled to disk (see :py:meth:`spill`), in which
+    case it is read back from the spill file on each access, until the block is
+    written again or loaded back into memory with :py:meth:`unspill`.
+    """
+    def __init__(self, shape, dtype, chunkshape=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._compressed = None # None means 'all zeros'.  Otherwise a string or a SpilledBuffer.
+        self._lock = threading.RLock()
+
+        assert self.nbytes <= blosc.MAX_BUFFERSIZE, \
+            "Block of shape {} is too large to be compressed with blosc".format( self.shape )
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * self.dtype.itemsize
+
+    @classmethod
+    def compressionName(cls):
+        # lz4 is preferred, but it isn't compiled into every blosc build.
+        if 'lz4' in blosc.cnames:
+            return 'lz4'
+        return 'blosclz'
+
+    def _decompress(self, out=None):
+        """
+        Decompress the entire block into the given C-contiguous array (or a new one).
+        """
+        if out is None:
+            out = numpy.ndarray( self.shape, dtype=self.dtype )
+        compressed = self._compressed
+        if isinstance(compressed, SpilledBuffer):
+            with self._lock:
+                # (Re-check with the lock held: a writer may have replaced and deleted the spill file.)
+                compressed = self._compressed
+                if isinstance(compressed, SpilledBuffer):
+                    compressed = compressed.read()
+        if compressed is None:
+            out[...] = 0
+        else:
+            blosc.decompress_ptr( compressed, out.__array_interface__['data'][0] )
+        return out
+
+    def _compress(self, data):
+        data = numpy.ascontiguousarray( data, dtype=self.dtype )
+        assert data.shape == self.shape
+        old_compressed = self._compressed
+        self._compressed = blosc.compress_ptr( data.__array_interface__['data'][0],
+                                               data.size,
+                                               typesize=self.dtype.itemsize,
+                                               clevel=5,
+                                               shuffle=True,
+                                               cname=self.compressionName() )
+        if isinstance(old_compressed, SpilledBuffer):
+            old_compressed.discard()
+
+    def _isEntireBlock(self, slicing):
+        if slicing is Ellipsis:
+            return True
+        if not isinstance(slicing, tuple):
+            slicing = (slicing,)
+        for s in slicing:
+            if not ( s is Ellipsis or (isinstance(s, slice) and s.step in (None, 1)) ):
+                return False
+        try:
+            # Apply the slicing to a (zero-strided) dummy array of our shape to see what it selects.
+            dummy = numpy.lib.stride_tricks.as_strided( numpy.zeros((1,), dtype=numpy.bool_),
+                                                        shape=self.shape,
+                                                        strides=(0,)*len(self.shape) )
+            return dummy[slicing].shape == self.shape
+        except (IndexError, ValueError):
+            return False
+
+    def __getitem__(self, slicing):
+        if self._isEntireBlock(slicing):
+            return self._decompress()
+        return self._decompress()[slicing]
+
+    def __setitem__(self, slicing, data):
+        with self._lock:
+            if self._isEntireBlock(slicing):
+                # Fast path: Replace the entire block without decompressing it first.
+                data = numpy.asarray(data)
+                if data.shape != self.shape:
+                    full_data = numpy.ndarray( self.shape, dtype=self.dtype )
+                    full_data[...] = data
+                    data = full_data
+                self._compress( data )
+            else:
+                block_data = self._decompress()
+                block_data[slicing] = data
+                self._compress( block_data )
+
+    def readInto(self, slicing, destination):
+        """
+        Copy the given portion of the block into the given array.
+        If possible, decompress directly into the destination without a temporary copy.
+        """
+        if self._isEntireBlock(slicing) \
+        and destination.shape == self.shape \
+        and destination.dtype == self.dtype \
+        and destination.flags.c_contiguous:
+            self._decompress( destination )
+        else:
+            destination[...] = self[slicing]
+
+    def storageSize(self):
+        """
+        Return the number of (compressed) bytes this block occupies in memory.
+        """
+        compressed = self._compressed
+        if compressed is None or isinstance(compressed, SpilledBuffer):
+            return 0
+        return len(compressed)
+
+    def spill(self, spill_store):
+        """
+        Move the compressed buffer to the given DiskSpillStore.
+        Return the number of bytes freed (0 if there was nothing to spill or the store is full).
+        """
+        with self._lock:
+            compressed = self._compressed
+            if compressed is None or isinstance(compressed, SpilledBuffer):
+                return 0
+            spilled = spill_store.storeBuffer(compressed)
+            if spilled is None:
+                return 0
+            self._compressed = spilled
+            return len(compressed)
+
+    def isSpilled(self):
+        return isinstance(self._compressed, SpilledBuffer)
+
+    def unspill(self):
+        """
+        Load a spilled buffer back into memory (and delete its spill file).
+        """
+        with self._lock:
+            compressed = self._compressed
+            if isinstance(compressed, SpilledBuffer):
+                self._compressed = compressed.read()
+                compressed.discard()
+
+    def exportHdf5(self, group, name):
+        """
+        Store the block's contents as a new (lzf-compressed) dataset in the given hdf5 group.
+        """
+        group.create_dataset( name, data=self._decompress(), compression='lzf' )
+
+    def importHdf5(self, dataset):
+        """
+        Replace the block's contents with the contents of the given hdf5 dataset.
+        """
+        assert dataset.dtype == self.dtype
+        assert dataset.shape == self.shape
+        self[...] = dataset[...]
+
+    def close(self):
+        with self._lock:
+            compressed = self._compressed
+            self._compressed = None
+            if isinstance(compressed, SpilledBuffer):
+                compressed.discard()
+
+def defaultBlockClass():
+    """
+    Return the block class to use if the user didn't choose one: blosc if it is installed, hdf5 otherwise.
+    """
+    if _blosc_available:
+        return BloscCompressedBlock
+    return Hdf5CompressedBlock
+
+def createBlock(block_class, shape, dtype, chunkshape=None):
+    """
+    Create a block of the given class, falling back to hdf5 for blocks that blosc can't handle.
+    """
+    if block_class is BloscCompressedBlock \
+    and int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize > blosc.MAX_BUFFERSIZE:
+        block_class = Hdf5CompressedBlock
+    return block_class(shape, dtype, chunkshape)
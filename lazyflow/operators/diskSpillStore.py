@@ -0,0 +1,188 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+#Python
+import os
+import shutil
+import atexit
+import tempfile
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+#SciPy
+import numpy
+
+try:
+    import blosc
+    _blosc_available = True
+except ImportError:
+    _blosc_available = False
+
+class SpilledBuffer(object):
+    """
+    A string of bytes that was written to a file in the spill directory.
+    """
+    def __init__(self, store, path, nbytes):
+        self._store = store
+        self.path = path
+        self.nbytes = nbytes
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def discard(self):
+        """
+        Delete the file and give its space back to the store.
+        """
+        if self.path is not None:
+            self._store._discard(self)
+            self.path = None
+
+class SpilledArray(object):
+    """
+    An array that was written to a file in the spill directory.
+    If blosc is available, the array is stored compressed.
+    Otherwise, it is stored raw and memory-mapped when it is read back.
+    """
+    def __init__(self, spilled_buffer, shape, dtype, compressed):
+        self._buffer = spilled_buffer
+        self.shape = shape
+        self.dtype = dtype
+        self._compressed = compressed
+
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes
+
+    def readInto(self, out):
+        """
+        Copy the array into the given C-contiguous array of the same shape and dtype.
+        """
+        assert out.shape == self.shape and out.dtype == self.dtype
+        assert out.flags.c_contiguous
+        if self._compressed:
+            blosc.decompress_ptr( self._buffer.read(), out.__array_interface__['data'][0] )
+        else:
+            mapped = numpy.memmap( self._buffer.path, dtype=self.dtype, mode='r', shape=self.shape )
+            out[...] = mapped
+            del mapped
+        return out
+
+    def discard(self):
+        self._buffer.discard()
+
+class DiskSpillStore(object):
+    """
+    A second cache tier on local disk.
+
+    When the memory manager evicts a cache, the cache may write its contents into
+    this store instead of throwing them away, and read them back on the next access
+    instead of recomputing them.  The store is disabled until :py:meth:`configure`
+    is called with a nonzero budget.
+
+    The store never deletes data on its own: If a spill would exceed the disk budget,
+    it is refused (and the caller must drop its data as it would without a spill tier).
+    Callers are responsible for discarding spilled data that became invalid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._max_bytes = 0
+        self._used_bytes = 0
+        self._directory = None
+
+    def configure(self, max_bytes, directory=None):
+        """
+        Enable the store with a budget of ``max_bytes`` of disk space in the given directory.
+        If no directory is given, a temporary directory is created (and deleted at exit).
+        A budget of 0 disables the store.  (Data that was already spilled remains valid.)
+        """
+        with self._lock:
+            self._max_bytes = max_bytes
+            if max_bytes and directory is None and self._directory is None:
+                directory = tempfile.mkdtemp(prefix='lazyflow-spill-')
+                atexit.register( shutil.rmtree, directory, True )
+            if directory is not None:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                self._directory = directory
+
+    def enabled(self):
+        return self._max_bytes > 0 and self._directory is not None
+
+    def usedBytes(self):
+        return self._used_bytes
+
+    def storeBuffer(self, data):
+        """
+        Write the given string to disk.
+        Return a :py:class:`SpilledBuffer`, or None if the store is disabled or full.
+        """
+        nbytes = len(data)
+        with self._lock:
+            if not self.enabled() or self._used_bytes + nbytes > self._max_bytes:
+                return None
+            self._used_bytes += nbytes
+            directory = self._directory
+
+        try:
+            fd, path = tempfile.mkstemp(suffix='.spill', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except (IOError, OSError) as ex:
+            logger.warning( "Could not spill {} bytes to {}: {}".format( nbytes, directory, ex ) )
+            with self._lock:
+                self._used_bytes -= nbytes
+            return None
+        return SpilledBuffer(self, path, nbytes)
+
+    def storeArray(self, array):
+        """
+        Write the given array to disk (compressed, if possible).
+        Return a :py:class:`SpilledArray`, or None if the store is disabled or full 
+        (or if the array can't be stored, e.g. because it holds python objects).
+        """
+        if array.dtype.hasobject or array.size == 0:
+            return None
+        array = numpy.ascontiguousarray(array)
+        compressed = _blosc_available and 0 < array.nbytes <= blosc.MAX_BUFFERSIZE
+        if compressed:
+            data = blosc.compress_ptr( array.__array_interface__['data'][0],
+                                       array.size,
+                                       typesize=array.dtype.itemsize,
+                                       clevel=5,
+                                       shuffle=True )
+        else:
+            data = array.data
+        spilled_buffer = self.storeBuffer(data)
+        if spilled_buffer is None:
+            return None
+        return SpilledArray(spilled_buffer, array.shape, array.dtype, compressed)
+
+    def _discard(self, spilled_buffer):
+        try:
+            os.remove(spilled_buffer.path)
+        except OSError:
+            pass
+        with self._lock:
+            self._used_bytes -= spilled_buffer.nbytes
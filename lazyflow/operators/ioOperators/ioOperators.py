@@ -21,9 +21,12 @@
 ###############################################################################
 import os
 import math
+import zlib
 import logging
 import glob
+import threading
 from collections import OrderedDict
+from functools import partial
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger('TRACE.' + __name__)
 
@@ -35,17 +38,18 @@ import vigra
 from lazyflow.graph import OrderedSignal, Operator, OutputSlot, InputSlot
 from lazyflow.roi import roiToSlice, roiFromShape, determineBlockShape
 from lazyflow.utility.bigRequestStreamer import BigRequestStreamer
-from lazyflow.request import Request 
+from lazyflow.request import Request, RequestPool
 
 
 class OpStackLoader(Operator):
     """Imports an image stack.
 
-    Note: This operator does NOT cache the images, so direct access
-          via the execute() function is very inefficient, especially
+    Note: This operator does NOT cache the images by default, so direct
+          access via the execute() function is very inefficient, especially
           through the Z-axis. Typically, you'll want to connect this
           operator to a cache whose block size is large in the X-Y
-          plane.
+          plane.  Alternatively, set SliceCacheMB to keep recently decoded
+          slices in memory, so that xz/yz requests don't re-decode every file.
 
     :param globstring: A glob string as defined by the glob module. We
         also support the following special extension to globstring
@@ -61,11 +65,14 @@ class OpStackLoader(Operator):
 
             ['/a/b/c.txt', '/d/e/f.txt', '../g/i/h.txt']
 
+    :param SliceCacheMB: Memory budget (in MB) for decoded slices.
+        0 (the default) disables the slice cache.
     """
     name = "Image Stack Reader"
     category = "Input"
 
-    inputSlots = [InputSlot("globstring", stype = "string")]
+    inputSlots = [InputSlot("globstring", stype = "string"),
+                  InputSlot("SliceCacheMB", value=0)]
     outputSlots = [OutputSlot("stack")]
 
     class FileOpenError( Exception ):
@@ -74,21 +81,31 @@ class OpStackLoader(Operator):
             self.msg = "Unable to open file: {}".format(filename)
             super(OpStackLoader.FileOpenError, self).__init__( self.msg )
 
+    def __init__(self, *args, **kwargs):
+        super(OpStackLoader, self).__init__(*args, **kwargs)
+        self._slice_cache = OrderedDict() # (filename, index) -> decoded xyc slice, in LRU order
+        self._slice_cache_bytes = 0
+        self._slice_cache_lock = threading.Lock()
+
     def setupOutputs(self):
+        self._clearSliceCache()
         self.fileNameList = self.expandGlobStrings(self.globstring.value)
 
         num_files = len(self.fileNameList)
         if len(self.fileNameList) == 0:
             self.stack.meta.NOTREADY = True
             return
-        try:
-            self.info = vigra.impex.ImageInfo(self.fileNameList[0])
-            self.slices_per_file = vigra.impex.numberImages(self.fileNameList[0])
-        except RuntimeError as e:
-            logger.error(str(e))
-            raise OpStackLoader.FileOpenError(self.fileNameList[0])
+        self.info, self.slices_per_file = self._readFileInfo(self.fileNameList[0])
 
+        # Validate the whole stack once, here, rather than on every execute() call.
         slice_shape = self.info.getShape()
+        for fileName in self.fileNameList[1:]:
+            info, slices_per_file = self._readFileInfo(fileName)
+            if info.getShape() != slice_shape:
+                raise RuntimeError('not all files have the same shape')
+            if slices_per_file != self.slices_per_file:
+                raise RuntimeError("Not all files have the same number of slices")
+
         X, Y, C = slice_shape
         if self.slices_per_file == 1:
             # If this is a stack of 2D images, we assume xy slices stacked along z
@@ -106,9 +123,24 @@ class OpStackLoader(Operator):
         self.stack.meta.axistags = axistags
         self.stack.meta.dtype = self.info.getDtype()
 
+    @staticmethod
+    def _readFileInfo(fileName):
+        """
+        Return the ImageInfo and number of images for the given file.
+        """
+        try:
+            return vigra.impex.ImageInfo(fileName), vigra.impex.numberImages(fileName)
+        except RuntimeError as e:
+            logger.error(str(e))
+            raise OpStackLoader.FileOpenError(fileName)
+
     def propagateDirty(self, slot, subindex, roi):
+        if slot == self.SliceCacheMB:
+            # The cache budget doesn't affect our output data.
+            return
         assert slot == self.globstring
         # Any change to the globstring means our entire output is dirty.
+        self._clearSliceCache()
         self.stack.setDirty()
 
     def execute(self, slot, subindex, roi, result):
@@ -124,35 +156,72 @@ class OpStackLoader(Operator):
         # roi is in zyxc order.
         z_start, y_start, x_start, c_start = roi.start
         z_stop, y_stop, x_stop, c_stop = roi.stop
+        slicing = (slice(x_start, x_stop), slice(y_start, y_stop), slice(c_start, c_stop))
 
-        # Copy each z-slice one at a time.
+        # Read the z-slices in parallel.
+        pool = RequestPool()
         for result_z, fileName in enumerate(self.fileNameList[z_start:z_stop]):
-            traceLogger.debug( "Reading image: {}".format(fileName) )
-            if self.info.getShape() != vigra.impex.ImageInfo(fileName).getShape():
-                raise RuntimeError('not all files have the same shape')
-            if self.slices_per_file != vigra.impex.numberImages(self.fileNameList[0]):
-                raise RuntimeError("Not all files have the same number of slices")
-
-            result[result_z,:,:,:] = vigra.impex.readImage(fileName)[x_start:x_stop,
-                                                                     y_start:y_stop,
-                                                                     c_start:c_stop].withAxes( *'yxc' )
+            pool.add( Request( partial( self._copySlice, fileName, 0, slicing, result[result_z] ) ) )
+        pool.wait()
         return result
 
     def _execute_5d(self, roi, result):
         # roi is in tzyxc order.
         t_start, z_start, y_start, x_start, c_start = roi.start
         t_stop, z_stop, y_stop, x_stop, c_stop = roi.stop
+        slicing = (slice(x_start, x_stop), slice(y_start, y_stop), slice(c_start, c_stop))
 
         # Use *enumerated* range to get global t coords and result t coords
+        pool = RequestPool()
         for result_t, t in enumerate( range( t_start, t_stop ) ):
             file_name = self.fileNameList[t]
             for result_z, z in enumerate( range( z_start, z_stop ) ):
-                img = vigra.readImage( file_name, index=z )
-                result[result_t, result_z, :, :, :] = img[ x_start:x_stop,
-                                                           y_start:y_stop,
-                                                           c_start:c_stop ].withAxes( *'yxc' )
+                pool.add( Request( partial( self._copySlice, file_name, z, slicing, result[result_t, result_z] ) ) )
+        pool.wait()
         return result
 
+    def _copySlice(self, fileName, index, slicing, destination):
+        """
+        Copy the given xyc slicing of one image into destination (yxc order).
+        """
+        img = self._getSlice(fileName, index)
+        destination[:] = img[slicing].withAxes( *'yxc' )
+
+    def _getSlice(self, fileName, index):
+        """
+        Return the entire decoded image at the given index of the given file,
+        from the slice cache if possible.
+        """
+        key = (fileName, index)
+        with self._slice_cache_lock:
+            img = self._slice_cache.pop(key, None)
+            if img is not None:
+                # Re-insert as most recently used.
+                self._slice_cache[key] = img
+                return img
+
+        traceLogger.debug( "Reading image: {} (index {})".format(fileName, index) )
+        if self.slices_per_file == 1:
+            img = vigra.impex.readImage(fileName)
+        else:
+            img = vigra.readImage(fileName, index=index)
+
+        max_bytes = self.SliceCacheMB.value * 1024**2
+        if 0 < img.nbytes <= max_bytes:
+            with self._slice_cache_lock:
+                if key not in self._slice_cache:
+                    self._slice_cache[key] = img
+                    self._slice_cache_bytes += img.nbytes
+                while self._slice_cache_bytes > max_bytes:
+                    _, evicted = self._slice_cache.popitem(last=False)
+                    self._slice_cache_bytes -= evicted.nbytes
+        return img
+
+    def _clearSliceCache(self):
+        with self._slice_cache_lock:
+            self._slice_cache.clear()
+            self._slice_cache_bytes = 0
+
     @staticmethod
     def expandGlobStrings(globStrings):
         ret = []
@@ -392,10 +461,14 @@ class OpH5WriterBigDataset(Operator):
     inputSlots = [InputSlot("hdf5File"), # Must be an already-open hdf5File (or group) for writing to
                   InputSlot("hdf5Path", stype = "string"),
                   InputSlot("Image"),
-                  InputSlot("CompressionEnabled", value=True)]
+                  InputSlot("CompressionEnabled", value=True),
+                  InputSlot("ParallelChunkWrites", value=True)] # Compress chunks in parallel and write them with direct chunk writes
 
     outputSlots = [OutputSlot("WriteImage")]
 
+    # gzip level used when compression is enabled.
+    CompressionLevel = 1
+
     loggingName = __name__ + ".OpH5WriterBigDataset"
     logger = logging.getLogger(loggingName)
     traceLogger = logging.getLogger("TRACE." + loggingName)
@@ -456,7 +529,7 @@ class OpH5WriterBigDataset(Operator):
             'chunks' : self.chunkShape }
         if self.CompressionEnabled.value:
             kwargs['compression'] = 'gzip' # <-- Would be nice to use lzf compression here, but that is h5py-specific.
-            kwargs['compression_opts'] = 1 # <-- Optimize for speed, not disk space.
+            kwargs['compression_opts'] = self.CompressionLevel # <-- Optimize for speed, not disk space.
         self.d=g.create_dataset(datasetName, **kwargs)
 
         if self.Image.meta.drange is not None:
@@ -468,6 +541,24 @@ class OpH5WriterBigDataset(Operator):
         # Save the axistags as a dataset attribute
         self.d.attrs['axistags'] = self.Image.meta.axistags.toJSON()
 
+        # Direct chunk writes require h5py >= 2.3 and hdf5 >= 1.8.11
+        if self.ParallelChunkWrites.value and hasattr(self.d.id, 'write_direct_chunk'):
+            self._writeChunkAligned()
+        else:
+            self._writeBlocks()
+
+        # Be paranoid: Flush right now.
+        self.f.file.flush()
+
+        # We're finished.
+        result[0] = True
+
+        self.progressSignal(100)
+
+    def _writeBlocks(self):
+        """
+        Request the image block-by-block and let hdf5 compress and write each block.
+        """
         def handle_block_result(roi, data):
             slicing = roiToSlice(*roi)
             if data.flags.c_contiguous:
@@ -479,13 +570,74 @@ class OpH5WriterBigDataset(Operator):
         requester.progressSignal.subscribe( self.progressSignal )
         requester.execute()            
 
-        # Be paranoid: Flush right now.
-        self.f.file.flush()
+    def _writeChunkAligned(self):
+        """
+        Request the image in blocks that consist of whole hdf5 chunks, compress 
+        the chunks of each block in the thread that produced it (in parallel), 
+        and write the compressed chunks directly to the file.
+        Only the writes themselves are serialized.
+        """
+        write_lock = threading.Lock()
+        def handle_block_result(roi, data):
+            # Called in parallel.
+            chunks = self._encodeChunks(roi, data)
+            with write_lock:
+                if chunks is None:
+                    # Not chunk-aligned: Let hdf5 do the work.
+                    self.d[roiToSlice(*roi)] = data
+                else:
+                    for chunk_start, chunk_bytes in chunks:
+                        self.d.id.write_direct_chunk( chunk_start, chunk_bytes )
+
+        blockshape = self._chunkAlignedBlockshape()
+        self.logger.info( "Writing with chunk-aligned blockshape: {}".format( blockshape ) )
+        requester = BigRequestStreamer( self.Image, roiFromShape( self.Image.meta.shape ), blockshape, allowParallelResults=True )
+        requester.resultSignal.subscribe( handle_block_result )
+        requester.progressSignal.subscribe( self.progressSignal )
+        requester.execute()
 
-        # We're finished.
-        result[0] = True
+    def _chunkAlignedBlockshape(self):
+        """
+        Round the streamer's default blockshape down to a whole multiple of our chunkshape (at least one chunk).
+        """
+        blockshape = BigRequestStreamer.determine_blockshape( self.Image )
+        chunkshape = numpy.array( self.chunkShape )
+        blockshape = numpy.maximum( 1, numpy.array(blockshape) // chunkshape ) * chunkshape
+        return tuple( blockshape )
 
-        self.progressSignal(100)
+    def _encodeChunks(self, roi, data):
+        """
+        Split the given block into hdf5 chunks and compress each of them (if compression is enabled).
+        Returns a list of (chunk_start, chunk_bytes), or None if the block isn't aligned to the chunks.
+        """
+        start, stop = numpy.array(roi[0]), numpy.array(roi[1])
+        chunkshape = numpy.array( self.chunkShape )
+        shape = numpy.array( self.d.shape )
+        if (start % chunkshape).any() or ((stop % chunkshape != 0) & (stop != shape)).any():
+            return None
+
+        compress = self.CompressionEnabled.value
+        dtype = self.d.dtype
+        data = data.view(numpy.ndarray)
+        chunks = []
+        num_chunks = (stop - start + chunkshape - 1) // chunkshape
+        for chunk_index in numpy.ndindex( *num_chunks ):
+            chunk_start = start + numpy.array(chunk_index) * chunkshape
+            chunk_stop = numpy.minimum( chunk_start + chunkshape, stop )
+            chunk_data = data[roiToSlice( chunk_start - start, chunk_stop - start )]
+            if chunk_data.shape != tuple(chunkshape):
+                # hdf5 stores edge chunks at full size
+                padded = numpy.zeros( chunkshape, dtype=dtype )
+                padded[roiToSlice( numpy.zeros_like(chunkshape), chunk_data.shape )] = chunk_data
+                chunk_data = padded
+            chunk_data = numpy.ascontiguousarray( chunk_data, dtype=dtype )
+            if compress:
+                # (zlib releases the GIL, so this runs in parallel with other blocks.)
+                chunk_bytes = zlib.compress( buffer(chunk_data), self.CompressionLevel )
+            else:
+                chunk_bytes = chunk_data.tostring()
+            chunks.append( ( tuple(chunk_start), chunk_bytes ) )
+        return chunks
 
     def propagateDirty(self, slot, subindex, roi):
         # The output from this operator isn't generally connected to other operators.
@@ -20,9 +20,11 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 import numpy
+import numpy.lib.format
 from lazyflow.graph import Operator, InputSlot
+from lazyflow.request import Request
 
-from lazyflow.roi import roiToSlice, roiFromShape
+from lazyflow.roi import roiFromShape
 from lazyflow.utility import BigRequestStreamer, OrderedSignal
 
 import logging
@@ -49,25 +51,61 @@ class OpNpyWriter(Operator):
         """
         Requests the entire input and saves it to the file.
         This function executes synchronously.
+
+        The data is requested in blocks that are contiguous in the file (i.e. C-order slabs), 
+        and the blocks are appended to the file in order as they arrive, 
+        so the whole dataset never has to be held in RAM.
+        The blocks are sized so that one block per worker thread fits in RAM, 
+        so (no matter how slow the file is) at most that many blocks are 
+        computed or waiting to be written at any time.
         """
-        # TODO: Use a lazyflow.utility.BigRequestStreamer to split up 
-        #       this giant request into a series of streamed subrequests.
-        
-        logger.warn("The current implementation of NPY-format data export computes the entire dataset at once, which requires lots of RAM.")
         path = self.Filepath.value
+        shape = tuple(self.Input.meta.shape)
+        dtype = numpy.dtype(self.Input.meta.dtype)
 
         self.progressSignal(0)
 
-        final_data = numpy.zeros( self.Input.meta.shape, self.Input.meta.dtype )
-
-        def handle_block_result(roi, data):
-            slicing = roiToSlice(*roi)
-            final_data[slicing] = data
-        requester = BigRequestStreamer( self.Input, roiFromShape( self.Input.meta.shape ) )
-        requester.resultSignal.subscribe( handle_block_result )
+        blockshape = self._contiguousBlockshape( shape, BigRequestStreamer.determine_blockshape( self.Input ) )
+        num_threads = max(1, Request.global_thread_pool.num_workers)
+        requester = BigRequestStreamer( self.Input, roiFromShape( shape ), blockshape, batchSize=num_threads )
         requester.progressSignal.subscribe( self.progressSignal )
-        requester.execute()
 
-        numpy.save(path, final_data)
+        with open(path, 'wb') as f:
+            header = { 'descr' : numpy.lib.format.dtype_to_descr( dtype ),
+                       'fortran_order' : False,
+                       'shape' : shape }
+            numpy.lib.format.write_array_header_1_0( f, header )
+            for _roi, data in requester.iterResults( bufferSize=num_threads ):
+                self._writeBlock( f, numpy.ascontiguousarray( data, dtype=dtype ) )
+
         self.progressSignal(100)
-    
\ No newline at end of file
+
+    def _writeBlock(self, f, data):
+        """
+        Append the given (C-contiguous) block to the file.
+        """
+        data.tofile( f )
+
+    @classmethod
+    def _contiguousBlockshape(cls, shape, blockshape):
+        """
+        Return a blockshape of (roughly) the same volume as the given one, 
+        but whose blocks are contiguous in a C-order array of the given shape.
+        That is, the blockshape spans the full extent of all axes after the first axis it splits, 
+        and is 1 for all axes before it:
+
+        >>> OpNpyWriter._contiguousBlockshape( (10, 20, 30), (5, 5, 5) )
+        (1, 4, 30)
+        >>> OpNpyWriter._contiguousBlockshape( (10, 20, 30), (10, 10, 30) )
+        (5, 20, 30)
+        """
+        target_volume = numpy.prod(blockshape)
+        contiguous_blockshape = list(shape)
+        inner_volume = 1
+        for axis in reversed(range(len(shape))):
+            if inner_volume * shape[axis] > target_volume:
+                contiguous_blockshape[axis] = max(1, target_volume // inner_volume)
+                contiguous_blockshape[:axis] = [1] * axis
+                break
+            inner_volume *= shape[axis]
+        return tuple( int(x) for x in contiguous_blockshape )
@@ -42,12 +42,17 @@ from lazyflow.utility import fastWhere
 from lazyflow.operators.opCache import OpCache
 from lazyflow.operators.opArrayPiper import OpArrayPiper
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
+from lazyflow.operators.diskSpillStore import DiskSpillStore
 
 class OpArrayCache(OpCache):
     """ Allocates a block of memory as large as Input.meta.shape (==Output.meta.shape)
         with the same dtype in order to be able to cache results.
         
         blockShape: dirty regions are tracked with a granularity of blockShape
+        
+        If the DiskSpillStore is enabled, the cache contents are written to disk 
+        when the memory manager frees the cache, and the clean blocks are read back 
+        (instead of recomputed) the next time the cache is used.
     """
     
     name = "ArrayCache"
@@ -92,6 +97,12 @@ class OpArrayCache(OpCache):
         self._has_fixed_dirty_blocks = False
         self._memory_manager = ArrayCacheMemoryMgr.instance
         self._running = 0
+        self._compute_time = 0.0
+        self._spill_store = DiskSpillStore.instance
+        self._spilled = None # SpilledArray with our contents, if we were spilled to disk
+        self._spilledBlocks = None # Which blocks of the spilled data are still valid
+        self._spilled_compute_time = 0.0
+        self._readonlyBuffer = None # Weakref to the read-only alias of our cache that executeReadOnly() hands out views of
        
     def usedMemory(self):
         if self._cache is not None:
@@ -124,6 +135,9 @@ class OpArrayCache(OpCache):
     
     def lastAccessTime(self):
         return self._last_access
+
+    def computeTime(self):
+        return self._compute_time
         
     def generateReport(self, report):
         report.name = self.name
@@ -140,7 +154,13 @@ class OpArrayCache(OpCache):
             if self._cache is not None and (self._blockState != OpArrayCache.IN_PROCESS).all():
                 if self._cache.shape == ():
                     return
+                if self._readOnlyViewsInUse():
+                    # The read-only views handed out by executeReadOnly() keep our memory alive, 
+                    #  so freeing the cache now wouldn't release anything.
+                    self.logger.debug("OpArrayCache (name={}): not freed, read-only views are in use".format(self.name))
+                    return 0
                 fshape = self._cache.shape
+                spilled = self._spillToDisk()
                 try:
                     self._cache.resize((), refcheck = refcheck)
                 except ValueError:
@@ -150,11 +170,85 @@ class OpArrayCache(OpCache):
                     self.logger.debug("OpArrayCache: freed cache of shape:{}".format(fshape))
     
                     with self._lock:
+                        if spilled is not None:
+                            self._spilled = spilled
+                            self._spilledBlocks = (self._blockState == OpArrayCache.CLEAN)
+                            self._spilled_compute_time = self._compute_time
                         self._blockState[:] = OpArrayCache.DIRTY
                         del self._cache
                         self._cache = None
+                        self._compute_time = 0.0
+                    self._memory_manager.reportFree(self, freed)
+                elif spilled is not None:
+                    spilled.discard()
             return freed
 
+    def _readOnlyViewsInUse(self):
+        return self._readonlyBuffer is not None and self._readonlyBuffer() is not None
+
+    def _readOnlyAlias(self):
+        """
+        Return a read-only array that aliases our cache.
+        All views handed out by executeReadOnly() are views of a single flat 
+        alias, so we can tell whether any of them are still in use with a weakref.
+        (Views of the cache itself would all refer to the cache as their base.)
+        """
+        flat = self._readonlyBuffer and self._readonlyBuffer()
+        if flat is None:
+            flat = numpy.frombuffer( buffer(self._cache), dtype=self._cache.dtype )
+            self._readonlyBuffer = weakref.ref(flat)
+        return flat.reshape(self._cache.shape)
+
+    def _copyOnWrite(self):
+        """
+        Must be called with self._lock held before writing into the cache.
+        If read-only views of the cache are still in use, replace the cache 
+        with a copy, so that the data in the views doesn't change.
+        """
+        if self._readOnlyViewsInUse():
+            self._cache = self._cache.copy()
+        self._readonlyBuffer = None
+
+    def _spillToDisk(self):
+        """
+        Write our contents to the spill store (if it is enabled and we have any clean blocks).
+        Return the SpilledArray, or None.
+        """
+        if not self._spill_store.enabled() or self._spilled is not None:
+            return None
+        if not (self._blockState == OpArrayCache.CLEAN).any():
+            return None
+        return self._spill_store.storeArray(self._cache)
+
+    def _restoreSpilledData(self):
+        """
+        Copy the blocks that were spilled to disk (and haven't become dirty since) back into our cache.
+        Must be called with self._lock held, after the cache was allocated.
+        """
+        spilled = self._spilled
+        if spilled is None:
+            return
+        self._spilled = None
+        try:
+            if spilled.shape != self._cache.shape or spilled.dtype != self._cache.dtype:
+                return
+            restore = self._spilledBlocks & (self._blockState == OpArrayCache.DIRTY)
+            if not restore.any():
+                return
+            spilled.readInto(self._cache)
+            self._blockState[:] = fastWhere(restore, OpArrayCache.CLEAN, self._blockState, numpy.uint8)
+            self._compute_time = self._spilled_compute_time
+            self.logger.debug("OpArrayCache: restored {} blocks from disk".format( restore.sum() ))
+        finally:
+            self._spilledBlocks = None
+            spilled.discard()
+
+    def _discardSpilledData(self):
+        if self._spilled is not None:
+            self._spilled.discard()
+            self._spilled = None
+            self._spilledBlocks = None
+
     def _get_full_blockshape(self, input_blockshape):
         max_shape = self.Input.meta.shape
         if not isinstance(input_blockshape, collections.Iterable):
@@ -178,6 +272,7 @@ class OpArrayCache(OpCache):
         
         #keep track of the dirty state of each block
         self._blockState = OpArrayCache.DIRTY * numpy.ones(self._dirtyShape, numpy.uint8)
+        self._discardSpilledData()
     
         self._blockState[:]= OpArrayCache.DIRTY
         self._dirtyState = OpArrayCache.CLEAN
@@ -193,9 +288,19 @@ class OpArrayCache(OpCache):
                 self.logger.debug("OpArrayCache: Allocating cache (size: %dbytes)" % mem.nbytes)
                 if self._blockState is None:
                     self._allocateManagementStructures()
+                if self._cache is not None:
+                    self._memory_manager.reportFree(self, self._cache.nbytes)
                 self._cache = mem
+                self._readonlyBuffer = None
+                self._memory_manager.reportAllocation(self, mem.nbytes)
+                self._restoreSpilledData()
         self._memory_manager.add(self)
 
+    def cleanUp(self):
+        self._memory_manager.remove(self)
+        self._discardSpilledData()
+        super( OpArrayCache, self ).cleanUp()
+
     def setupOutputs(self):
         self.CleanBlocks.meta.shape = (1,)
         self.CleanBlocks.meta.dtype = object
@@ -257,6 +362,8 @@ class OpArrayCache(OpCache):
                     blockStart = numpy.floor(1.0 * start / self._blockShape)
                     blockStop = numpy.ceil(1.0 * stop / self._blockShape)
                     blockKey = roiToSlice(blockStart,blockStop)
+                    if self._spilledBlocks is not None:
+                        self._spilledBlocks[blockKey] = False
                     if self._fixed:
                         # Remember that this block became dirty while we were fixed 
                         #  so we can notify downstream operators when we become unfixed.
@@ -305,6 +412,7 @@ class OpArrayCache(OpCache):
         self._last_access = cur_time
         new_prio = 0.5 * self._cache_priority + delta
         self._cache_priority = new_prio
+        self._memory_manager.policy.touched(self)
 
     def execute(self, slot, subindex, roi, result):
         if slot == self.Output:
@@ -351,6 +459,10 @@ class OpArrayCache(OpCache):
             inProcessQueries = numpy.unique(numpy.extract( blockSet == OpArrayCache.IN_PROCESS, self._blockQuery[blockKey]))
     
             cond = (blockSet == OpArrayCache.DIRTY)
+            if not self._fixed and cond.any():
+                # We're about to write into the cache.
+                self._copyOnWrite()
+                cacheView = self._cache[:]
             tileWeights = fastWhere(cond, 1, 128**3, numpy.uint32)
             trueDirtyIndices = numpy.nonzero(cond)
     
@@ -416,8 +528,11 @@ class OpArrayCache(OpCache):
 
         #wait for all requests to finish
         something_updated = len( dirtyPool ) > 0
+        compute_start = time.time()
         dirtyPool.wait()
         if something_updated:
+            # Remember how expensive our contents are (used by the cost-aware eviction policy)
+            self._compute_time += time.time() - compute_start
             # Signal that something was updated.
             # Note that we don't need to do this for the 'in process' queries (below)  
             #  because they are already in the dirtyPool in some other thread
@@ -450,6 +565,36 @@ class OpArrayCache(OpCache):
             cacheView = None
         self.logger.debug("read %s took %f sec." % (roi.pprint(), time.time()-t))
 
+    def executeReadOnly(self, slot, subindex, roi):
+        """
+        If the requested data is already in the cache, return a read-only view of it instead of a copy.
+        Otherwise, return None (so the data will be computed via execute()).
+        """
+        if slot != self.Output:
+            return None
+        start, stop = sliceToRoi(roi.toSlice(), self.Output.meta.shape)
+        with self._lock:
+            if self._cache is None or self._cache.shape == ():
+                return None
+            if self._cache.dtype.hasobject:
+                # Arrays of python objects can't be aliased via their buffer.  Use the copying path.
+                return None
+            # As long as any views are in use, blocks must not be written in-place.
+            # Blocks that are in process are being written right now, so don't hand out any views.
+            if (self._blockState == OpArrayCache.IN_PROCESS).any():
+                return None
+
+            blockStart = (1.0 * start / self._blockShape).floor()
+            blockStop = (1.0 * stop / self._blockShape).ceil()
+            blockSet = self._blockState[roiToSlice(blockStart,blockStop)]
+            if not numpy.logical_or(blockSet == OpArrayCache.CLEAN, blockSet == OpArrayCache.FIXED_DIRTY).all():
+                return None
+
+            self._cacheHits += 1
+            view = self._readOnlyAlias()[roiToSlice(start, stop)]
+            self._updatePriority()
+        return view
+
     def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.inputs["Input"]
         ch = self._cacheHits
@@ -469,6 +614,7 @@ class OpArrayCache(OpCache):
             with self._lock:
                 if self._cache is None:
                     self._allocateCache()
+                self._copyOnWrite()
                 self._cache[key2] = value[roiToSlice(start2-start,stop2-start)]
                 self._blockState[blockKey] = self._dirtyState
                 self._blockQuery[blockKey] = None
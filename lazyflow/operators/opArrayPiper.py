@@ -20,6 +20,7 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.rtype import SubRegion
 
 class OpArrayPiper(Operator):
     name = "ArrayPiper"
@@ -41,6 +42,14 @@ class OpArrayPiper(Operator):
         req.wait()
         return result
 
+    def executeReadOnly(self, slot, subindex, roi):
+        if type(self).execute.__func__ is not OpArrayPiper.execute.__func__:
+            # A subclass computes something else, so we can't just pass the input through.
+            return None
+        # Pass the (read-only) upstream result through without copying it.
+        inputRoi = SubRegion( self.Input, roi.start, roi.stop )
+        return self.Input.get( inputRoi, readonly=True ).wait()
+
     def propagateDirty(self, slot, subindex, roi):
         key = roi.toSlice()
         # Check for proper name because subclasses may define extra inputs.
@@ -22,25 +22,101 @@
 #Python
 import sys
 import time
-import generic
 import logging
 logger = logging.getLogger(__name__)
 from threading import Lock
+from functools import partial
 
 #SciPy
 import numpy
 
 #lazyflow
 from lazyflow.roi import roiToSlice
-from lazyflow.utility import RamMeasurementContext
+from lazyflow.utility import RamMeasurementContext, fastWhere
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.rtype import SubRegion
-from lazyflow.request import RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.operators.opCache import OpCache
-from lazyflow.operators.opArrayCache import OpArrayCache
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
+from lazyflow.operators.diskSpillStore import DiskSpillStore
+
+class _CacheBlock(object):
+    """
+    The data of one (outer) block of an OpBlockedArrayCache, and the state of each 
+    inner block within it.
+    
+    Each block is registered with the ArrayCacheMemoryMgr on its own, so blocks are 
+    evicted individually (just like the per-block OpArrayCache operators this replaces).
+    """
+    # Inner block states
+    DIRTY       = 0
+    CLEAN       = 1
+    IN_PROCESS  = 2
+
+    def __init__(self, owner, block_index, start, stop, inner_blockshape):
+        self.owner = owner
+        self.index = block_index
+        self.start = start
+        self.stop = stop
+        self.shape = tuple(stop - start)
+        self.inner_blockshape = numpy.minimum(inner_blockshape, self.shape)
+        state_shape = numpy.ceil( numpy.array(self.shape, dtype=float) / self.inner_blockshape ).astype(int)
+        self.states = numpy.zeros( state_shape, dtype=numpy.uint8 ) # all DIRTY
+        self.data = None
+        self.spilled = None # SpilledArray, if our data was spilled to disk
+        self.lock = RequestLock()
+        self.compute_time = 0.0
+        self._last_access = None
+        self._cache_priority = 0
+
+    def innerBlockKey(self, start, stop):
+        """
+        Return the slicing of self.states for the given (block-relative) roi.
+        """
+        inner_start = numpy.array(start) // self.inner_blockshape
+        inner_stop = numpy.ceil( numpy.array(stop, dtype=float) / self.inner_blockshape ).astype(int)
+        return roiToSlice( inner_start, inner_stop )
+
+    def updatePriority(self):
+        cur_time = time.time()
+        if self._last_access is None:
+            self._last_access = cur_time
+        delta = cur_time - self._last_access + 1e-9
+        self._last_access = cur_time
+        self._cache_priority = 0.5 * self._cache_priority + delta
+
+    def usedMemory(self):
+        data = self.data
+        if data is None:
+            return 0
+        return data.nbytes
+
+    def computeTime(self):
+        return self.compute_time
+
+    def lastAccessTime(self):
+        return self._last_access
+
+    def fractionOfUsedMemoryDirty(self):
+        if self.data is None:
+            return 0
+        return (self.states != _CacheBlock.CLEAN).sum() / float(self.states.size)
+
+    def _freeMemory(self, refcheck=True):
+        # Called by the memory manager
+        return self.owner._freeBlock(self)
 
 class OpBlockedArrayCache(OpCache):
+    """
+    A cache that divides its input into (outer) blocks, which are allocated on demand.
+    Within each outer block, dirtiness is tracked with the granularity of the innerBlockShape.
+    
+    The data of each block is kept in a plain numpy array (not in a separate cache operator), 
+    and missing data is requested from the Input with a single request per block.
+    
+    If the DiskSpillStore is enabled, blocks that are freed by the memory manager are 
+    written to disk and read back (instead of recomputed) on the next access.
+    """
     name = "OpBlockedArrayCache"
     description = ""
 
@@ -69,9 +145,9 @@ class OpBlockedArrayCache(OpCache):
         self._blockShape = None
         self._fixed_all_dirty = False  # this is a shortcut for storing wehter all subblocks are dirty
         self._forward_dirty = False
-        self._opDummy = None
-        self._opSub_list = {}
-        self._cache_list = {}
+        self._blocks = {} # block_index -> _CacheBlock
+        self._memory_manager = ArrayCacheMemoryMgr.instance
+        self._spill_store = DiskSpillStore.instance
 
         # This member is used by tests that check RAM usage.
         self.setup_ram_context = RamMeasurementContext()
@@ -135,13 +211,7 @@ class OpBlockedArrayCache(OpCache):
         
                     self.Output.meta.ram_usage_per_requested_pixel = ram_per_pixel
         
-                for op in self._cache_list.values():
-                    op.cleanUp()
-                for op in self._opSub_list.values():
-                    op.cleanUp()
-    
-                self._opSub_list = {}
-                self._cache_list = {}
+                self._discardBlocks()
     
                 self._configured = True
     
@@ -193,6 +263,7 @@ class OpBlockedArrayCache(OpCache):
         raveled_indices_block = numpy.reshape(raveled_indices, shape)
         return raveled_indices_block
 
+
     def generateReport(self, report):
         report.name = self.name
         report.fractionOfUsedMemoryDirty = self.fractionOfUsedMemoryDirty()
@@ -201,21 +272,40 @@ class OpBlockedArrayCache(OpCache):
         report.type = type(self)
         report.id = id(self)
        
-        for block_index, block in self._cache_list.iteritems():
-            start = self._blockShape*self._get_block_multi_index(block_index)
-            stop  = numpy.minimum(start + self._blockShape, self.Output.meta.shape)
-            
+        for block in self._blocks.values():
             n = MemInfoNode()
-            n.roi = (start, stop)
+            n.roi = (block.start, block.stop)
+            n.name = self.name
+            n.fractionOfUsedMemoryDirty = block.fractionOfUsedMemoryDirty()
+            n.usedMemory = block.usedMemory()
+            n.lastAccessTime = block.lastAccessTime()
+            n.dtype = self.Output.meta.dtype
+            n.type = type(block)
+            n.id = id(block)
             report.children.append(n)
-            block.generateReport(n)
             
     def usedMemory(self):
         tot = 0.0
-        for block in self._cache_list.values():
+        for block in self._blocks.values():
             tot += block.usedMemory()
         return tot
 
+    def computeTime(self):
+        tot = 0.0
+        for block in self._blocks.values():
+            tot += block.computeTime()
+        return tot
+
+    def lastAccessTime(self):
+        access_times = filter( None, (block.lastAccessTime() for block in self._blocks.values()) )
+        if not access_times:
+            return 0
+        return max(access_times)
+
+    def cleanUp(self):
+        self._discardBlocks()
+        super( OpBlockedArrayCache, self ).cleanUp()
+
     def execute(self, slot, subindex, roi, result):
         assert (roi.start >= 0).all(), \
             "Requested roi is out-of-bounds: [{}, {}]".format( roi.start, roi.stop )
@@ -234,72 +324,222 @@ class OpBlockedArrayCache(OpCache):
 
         blockStart = (start / self._blockShape)
         blockStop = (stop * 1.0 / self._blockShape).ceil()
-        innerBlocks = self._get_block_numbers(blockStart, blockStop)
+        innerBlocks = self._get_block_numbers(blockStart, blockStop).ravel()
+
+        # Compute the offsets of all blocks and their intersections with the roi at once.
+        # (Doing this block-by-block in python dominates the runtime for requests that touch many blocks.)
+        block_multi_indexes = numpy.array( numpy.unravel_index( innerBlocks, self._dirtyShape ) ).transpose()
+        offsets = block_multi_indexes * self._blockShape
+        block_stops = numpy.minimum( offsets + self._blockShape, self.shape )
+        bigstarts = numpy.maximum( offsets, start )
+        bigstops = numpy.minimum( block_stops, stop )
+        smallstarts = bigstarts - offsets
+        smallstops = bigstops - offsets
+        resultstarts = bigstarts - start
+        resultstops = bigstops - start
+
+        innerBlocks = innerBlocks.tolist()
+        with self._lock:
+            fixed = self._fixed
+            if not fixed:
+                # Create all missing blocks in one go
+                for i, block_index in enumerate(innerBlocks):
+                    if block_index not in self._blocks:
+                        self._blocks[block_index] = _CacheBlock( self, block_index, offsets[i], block_stops[i], 
+                                                                 self._innerBlockShape )
+            blocks = map( self._blocks.get, innerBlocks )
 
         pool = RequestPool()
-        for block_index in innerBlocks.flat:
+        fixed_dirty_blocks = []
+        for i, block in enumerate(blocks):
             #which part of the original key does this block fill?
-            block_multi_index = self._get_block_multi_index(block_index)
-            offset = self._blockShape*block_multi_index
-            bigstart = numpy.maximum(offset, start)
-            bigstop = numpy.minimum(offset + self._blockShape, stop)
-
-
-            smallstart = bigstart-offset
-            smallstop = bigstop - offset
-
-            bigkey = roiToSlice(bigstart-start, bigstop-start)
-
-            with self._lock:    
-                if not self._fixed:
-                    if not self._cache_list.has_key(block_index):
-
-                        self._opSub_list[block_index] = generic.OpSubRegion(parent=self)
-                        self._opSub_list[block_index].inputs["Input"].connect(self.inputs["Input"])
-                        tstart = self._blockShape*block_multi_index
-                        tstop = numpy.minimum((block_multi_index+numpy.ones(block_multi_index.shape, numpy.uint8))*self._blockShape, self.shape)
-    
-                        self._opSub_list[block_index].Roi.setValue( (tuple(tstart), tuple(tstop)) )
-    
-                        self._cache_list[block_index] = OpArrayCache(parent=self)
-                        self._cache_list[block_index].inputs["Input"].connect(self._opSub_list[block_index].outputs["Output"])
-                        self._cache_list[block_index].inputs["fixAtCurrent"].connect( self.fixAtCurrent )
-                        self._cache_list[block_index].inputs["blockShape"].setValue(self.inputs["innerBlockShape"].value)
-                        # we dont register a callback for dirtyness, since we already forward the signal
-                        
-                        # Forward value changed notifications to our own output.
-                        self._cache_list[block_index].Output.notifyValueChanged( self.Output._sig_value_changed )
-
-            if self._cache_list.has_key(block_index):
-                op = self._cache_list[block_index]
-                #req = self._cache_list[block_index].outputs["Output"][smallkey].writeInto(result[bigkey])
-
-                smallroi = SubRegion(op.outputs["Output"], start = smallstart , stop= smallstop)
-                req = op.Output(smallroi.start, smallroi.stop)
-                req.writeInto(result[bigkey])
-                pool.add( req )
-                #op.execute(op.outputs["Output"], (), smallroi, result[bigkey])
-
-                ####op.getOutSlot(op.outputs["Output"],smallkey,result[bigkey])
-                #requests.append(req)
-            else:
+            bigkey = roiToSlice( resultstarts[i], resultstops[i] )
+            if block is None:
                 #When this block has never been in the cache and the current
                 #value is fixed (fixAtCurrent=True), return 0  values
                 #This prevents random noise appearing in such cases.
                 result[bigkey] = 0
-                with self._lock:
-                    # Since a downstream operator has expressed an interest in this block,
-                    #  mark it to be signaled as dirty when we become unfixed.
-                    # Otherwise, downstream operators won't know when there's valid data in this block.
-                    self._fixed_dirty_blocks.add(block_index)
+                fixed_dirty_blocks.append( innerBlocks[i] )
+            elif fixed:
+                if not self._readFixedBlock( block, smallstarts[i], smallstops[i], result[bigkey] ):
+                    fixed_dirty_blocks.append( innerBlocks[i] )
+            elif not self._readCleanBlock( block, smallstarts[i], smallstops[i], result[bigkey] ):
+                pool.add( Request( partial( self._readBlock, block, smallstarts[i], smallstops[i], result[bigkey] ) ) )
+
+        if fixed_dirty_blocks:
+            with self._lock:
+                # Since a downstream operator has expressed an interest in these blocks,
+                #  mark them to be signaled as dirty when we become unfixed.
+                # Otherwise, downstream operators won't know when there's valid data in these blocks.
+                self._fixed_dirty_blocks.update(fixed_dirty_blocks)
 
         pool.wait()
             
         self.logger.debug("read %r took %f msec." % (roi.pprint(), 1000.0*(time.time()-t)))
 
+    def _readCleanBlock(self, block, start, stop, destination):
+        """
+        Fast path: If the given (block-relative) roi of the block is clean, copy it into destination.
+        Returns False (and copies nothing) if the data isn't available yet.
+        """
+        data = block.data
+        if data is None or (block.states[block.innerBlockKey(start, stop)] != _CacheBlock.CLEAN).any():
+            return False
+        destination[...] = data[roiToSlice(start, stop)]
+        self._touchBlock(block)
+        return True
+
+    def _readBlock(self, block, start, stop, destination):
+        """
+        Copy the given (block-relative) roi of the given block into destination, 
+        requesting the dirty parts from our Input first.
+        """
+        states_key = block.innerBlockKey(start, stop)
+        data = block.data
+        if data is None or (block.states[states_key] != _CacheBlock.CLEAN).any():
+            data = self._updateBlock(block, start, stop, states_key)
+        destination[...] = data[roiToSlice(start, stop)]
+        self._touchBlock(block)
+
+    def _updateBlock(self, block, start, stop, states_key):
+        """
+        Make sure the given roi of the block is clean, with a single request for all of its dirty inner blocks.
+        Returns the block's data array.
+        """
+        something_updated = False
+        with block.lock:
+            data = self._ensureBlockAllocated(block)
+            states = block.states[states_key]
+            dirty = (states != _CacheBlock.CLEAN)
+            if dirty.any():
+                # If all inner blocks in the bounding box of the dirty inner blocks are dirty, 
+                #  request the whole bounding box at once.
+                # Otherwise, request each dirty inner block separately, so clean ones aren't recomputed.
+                dirty_indexes = numpy.nonzero(dirty)
+                inner_offset = numpy.array( [s.start for s in states_key] )
+                bbox_start = numpy.array( [ d.min() for d in dirty_indexes ] )
+                bbox_stop = numpy.array( [ d.max()+1 for d in dirty_indexes ] )
+                if dirty[ roiToSlice(bbox_start, bbox_stop) ].all():
+                    inner_rois = [ (inner_offset + bbox_start, inner_offset + bbox_stop) ]
+                else:
+                    inner_starts = inner_offset + numpy.transpose( dirty_indexes )
+                    inner_rois = zip( inner_starts, inner_starts + 1 )
+
+                with self._lock:
+                    states = block.states[states_key]
+                    states[dirty] = _CacheBlock.IN_PROCESS
+
+                compute_start = time.time()
+                pool = RequestPool()
+                for inner_start, inner_stop in inner_rois:
+                    request_start = inner_start * block.inner_blockshape
+                    request_stop = numpy.minimum( inner_stop * block.inner_blockshape, block.shape )
+                    req = self.Input( block.start + request_start, block.start + request_stop )
+                    req.writeInto( data[roiToSlice(request_start, request_stop)] )
+                    pool.add( req )
+                pool.wait()
+                block.compute_time += time.time() - compute_start
+
+                # Blocks that became dirty while we were waiting stay dirty.
+                with self._lock:
+                    states = block.states[states_key]
+                    states[:] = fastWhere( states == _CacheBlock.IN_PROCESS, 
+                                           _CacheBlock.CLEAN, states, numpy.uint8 )
+                something_updated = True
+
+        if something_updated:
+            self.Output._sig_value_changed()
+        return data
+
+    def _readFixedBlock(self, block, start, stop, destination):
+        """
+        Copy whatever the block currently holds into destination, without requesting anything from our Input.
+        Returns False if any of the copied data is not clean.
+        """
+        data = block.data
+        if data is None and block.spilled is not None:
+            with block.lock:
+                data = self._ensureBlockAllocated(block)
+        if data is None:
+            destination[...] = 0
+            return False
+        destination[...] = data[roiToSlice(start, stop)]
+        self._touchBlock(block)
+        return (block.states[block.innerBlockKey(start, stop)] == _CacheBlock.CLEAN).all()
+
+    def _ensureBlockAllocated(self, block):
+        """
+        Allocate the data array of the given block (and restore its contents from disk, if it was spilled).
+        Must be called with block.lock held.
+        """
+        if block.data is not None:
+            return block.data
+        data = numpy.zeros( block.shape, dtype=self.Output.meta.dtype )
+        spilled = block.spilled
+        block.spilled = None
+        if spilled is not None:
+            spilled.readInto(data)
+            spilled.discard()
+            self.logger.debug("Restored block {} from disk".format( block.index ))
+        else:
+            with self._lock:
+                block.states[...] = fastWhere( block.states == _CacheBlock.CLEAN, 
+                                               _CacheBlock.DIRTY, block.states, numpy.uint8 )
+        block.data = data
+        self._memory_manager.reportAllocation(block, data.nbytes)
+        self._memory_manager.add(block)
+        return data
+
+    def _touchBlock(self, block):
+        block.updatePriority()
+        self._memory_manager.policy.touched(block)
+
+    def _freeBlock(self, block):
+        """
+        Free the memory of the given block (spilling its clean data to disk, if possible).
+        Returns the number of bytes freed.
+        """
+        if not block.lock.acquire(False):
+            # Block is busy.
+            return 0
+        try:
+            data = block.data
+            if data is None:
+                return 0
+            with self._lock:
+                has_clean_data = (block.states == _CacheBlock.CLEAN).any()
+            if has_clean_data and self._spill_store.enabled():
+                block.spilled = self._spill_store.storeArray(data)
+            if block.spilled is None:
+                with self._lock:
+                    block.states[...] = fastWhere( block.states == _CacheBlock.CLEAN,
+                                                   _CacheBlock.DIRTY, block.states, numpy.uint8 )
+                block.compute_time = 0.0
+            block.data = None
+            self._memory_manager.reportFree(block, data.nbytes)
+            return data.nbytes
+        finally:
+            block.lock.release()
+
+    def _discardBlocks(self):
+        """
+        Forget all blocks (e.g. because our configuration changed).
+        """
+        with self._lock:
+            blocks = self._blocks
+            self._blocks = {}
+        for block in blocks.values():
+            self._memory_manager.remove(block)
+            if block.spilled is not None:
+                block.spilled.discard()
+                block.spilled = None
+            block.data = None
 
     def propagateDirty(self, slot, subindex, roi):
         key = roi.toSlice()
+        if slot == self.inputs["Input"]:
+            self._markBlocksDirty(roi)
+
         if slot == self.inputs["Input"] and self._forward_dirty:
             if not self._fixed:
                 self.outputs["Output"].setDirty(key)                    
@@ -349,3 +589,21 @@ class OpBlockedArrayCache(OpCache):
 
                 if dirtystart is not None:
                     self.Output.setDirty(dirtystart, dirtystop)
+
+    def _markBlocksDirty(self, roi):
+        """
+        Mark the inner blocks of all existing blocks that intersect the given roi as dirty.
+        """
+        if self._blockShape is None or not self._blocks:
+            return
+        start, stop = roi.start, roi.stop
+        blockStart = (start / self._blockShape)
+        blockStop = (stop * 1.0 / self._blockShape).ceil()
+        with self._lock:
+            for block_index in self._get_block_numbers(blockStart, blockStop).flat:
+                block = self._blocks.get(block_index)
+                if block is None:
+                    continue
+                dirty_start = numpy.maximum( start, block.start ) - block.start
+                dirty_stop = numpy.minimum( stop, block.stop ) - block.start
+                block.states[ block.innerBlockKey(dirty_start, dirty_stop) ] = _CacheBlock.DIRTY
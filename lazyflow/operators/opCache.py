@@ -44,6 +44,10 @@ class OpCache(Operator):
     def lastAccessTime(self):
         """timestamp of last access (time.time())"""
         return 0 #overwrite me
+
+    def computeTime(self):
+        """time (in seconds) it took to compute the data currently held in the cache"""
+        return 0 #overwrite me
     
     def _after_init(self):
         """
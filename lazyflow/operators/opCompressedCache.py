@@ -24,6 +24,7 @@ import copy
 import logging
 from functools import partial
 import collections
+import threading
 import time
 
 # Third-party
@@ -35,15 +36,31 @@ from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.roi import TinyVector, getIntersectingBlocks, getBlockBounds, roiToSlice, getIntersection
 from lazyflow.operators.opCache import OpCache
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
+from lazyflow.operators.diskSpillStore import DiskSpillStore
+from lazyflow.operators.compressedBlocks import defaultBlockClass, createBlock
 
 logger = logging.getLogger(__name__)
 
 class OpCompressedCache(OpCache):
     """
-    A blockwise cache that stores each block as a separate in-memory hdf5 file with a compressed dataset.
+    A blockwise cache that stores each block in compressed form.
+    
+    By default, blocks are stored as blosc-compressed buffers (if blosc is installed).
+    Otherwise, each block is stored as a separate in-memory hdf5 file with a compressed dataset.
+    To choose the storage explicitly, set the BlockClass attribute to one of the block 
+    classes in lazyflow.operators.compressedBlocks before the first block is created.
+    
+    Since blocks that were written via setInSlot can't be recomputed, they are never thrown away.
+    But if the DiskSpillStore is enabled, the memory manager may move clean blocks to disk 
+    (if the block storage supports it), and spilled blocks are loaded back into memory on access.
+    Only then (i.e. while the DiskSpillStore is enabled) is the memory held by the blocks 
+    reported to the ArrayCacheMemoryMgr and the cache registered as an eviction candidate.
     
     Note: It is not safe to call execute() change the blockshape simultaneously.
     """
+    BlockClass = None # None: Use compressedBlocks.defaultBlockClass()
+
     Input = InputSlot() # Also used to asynchronously force data into the cache via __setitem__ (see setInSlot(), below()
     BlockShape = InputSlot(optional=True) # If not provided, the entire input is treated as one block
     
@@ -56,19 +73,30 @@ class OpCompressedCache(OpCache):
     def __init__(self, *args, **kwargs):
         super( OpCompressedCache, self ).__init__( *args, **kwargs )
         self._lock = RequestLock()
+        self._memory_manager = ArrayCacheMemoryMgr.instance
+        self._spill_store = DiskSpillStore.instance
+        self._last_access = None
+        self._cache_priority = 0
+        self._cacheFiles = {}
+        self._report_lock = threading.Lock()
+        self._stored_bytes = 0   # Bytes held in memory by all blocks
+        self._reported_bytes = 0 # Bytes reported to the memory manager
         self._init_cache(None)
 
     def _init_cache(self, new_blockshape):
         with self._lock:
+            self._closeBlocks()
             self._blockshape = new_blockshape
             self._cacheFiles = {}
             self._dirtyBlocks = set()
             self._blockLocks = {}
+            self._blockComputeTimes = {} # Seconds spent computing each block (only for blocks computed from our Input)
             self._chunkshape = self._chooseChunkshape(self._blockshape)
 
     def cleanUp(self):
         logger.debug( "Cleaning up" )
         self._closeAllCacheFiles()
+        self._memory_manager.remove(self)
         super( OpCompressedCache, self ).cleanUp()
 
 
@@ -122,6 +150,7 @@ class OpCompressedCache(OpCache):
         # Ensure all block cache files are up-to-date
         self._waitForBlocks(block_starts)
         self._copyData(roi, destination, block_starts)
+        self._updateAccessTime()
         return destination
 
     def _waitForBlocks(self, block_starts):
@@ -139,7 +168,6 @@ class OpCompressedCache(OpCache):
 
     def _copyData(self, roi, destination, block_starts):
         # Copy data from each block
-        # (Parallelism not needed here: h5py will serialize these requests anyway)
         logger.debug( "Copying data from {} blocks...".format( len(block_starts) ) )
         for block_start in block_starts:
             entire_block_roi = getBlockBounds( self.Output.meta.shape, self._blockshape, block_start )
@@ -152,8 +180,10 @@ class OpCompressedCache(OpCache):
             block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
             
             # Copy from block to destination
-            dataset = self._getBlockDataset( entire_block_roi )
-            destination[ roiToSlice(*destination_relative_intersection) ] = dataset[ roiToSlice( *block_relative_intersection ) ]
+            block = self._getBlockDataset( entire_block_roi )
+            self._restoreSpilledBlock( tuple(block_start), block )
+            block.readInto( roiToSlice( *block_relative_intersection ), 
+                            destination[ roiToSlice(*destination_relative_intersection) ] )
 
     def _executeCleanBlocks(self, destination):
         """
@@ -179,9 +209,10 @@ class OpCompressedCache(OpCache):
 
         block_roi = [roi.start, roi.stop]
         self._ensureCached( block_roi )
-        dataset = self._getBlockDataset( block_roi )
+        block = self._getBlockDataset( block_roi )
+        self._restoreSpilledBlock( tuple(roi.start), block )
         assert str(block_roi) not in destination, "destination hdf5 group already has a dataset with this block's name"
-        destination.copy( dataset, str(block_roi) )
+        block.exportHdf5( destination, str(block_roi) )
         return destination        
 
     def propagateDirty(self, slot, subindex, roi):
@@ -267,13 +298,92 @@ class OpCompressedCache(OpCache):
         return dtype().nbytes
     
     def usedMemory(self):
-        #FIXME
         tot = 0.0
-        for b in self._cacheFiles:
-            if "data" in b:
-                tot += b["data"].size * self._getDtypeBytes(b["data"].dtype)
+        for block_start in self._cacheFiles.keys():
+            tot += self.blockStorageSize(block_start)
         return tot
+
+    def blockStorageSize(self, block_start):
+        """
+        Return the number of (compressed) bytes the given block occupies.
+        """
+        try:
+            return self._cacheFiles[block_start].storageSize()
+        except KeyError:
+            return 0
+
+    def blockComputeTime(self, block_start):
+        """
+        Return the time (in seconds) it took to compute the given block from our Input, 
+        or 0 if it wasn't computed (e.g. it was written via setInSlot).
+        """
+        return self._blockComputeTimes.get(block_start, 0.0)
+
+    def computeTime(self):
+        return sum( self._blockComputeTimes.values() )
     
+    def lastAccessTime(self):
+        return self._last_access
+
+    def _updateAccessTime(self):
+        self._last_access = time.time()
+        self._memory_manager.policy.touched(self)
+
+    def _reportStorageChange(self, old_size, new_size):
+        """
+        Keep track of how much the memory held by a block changed, and tell the memory manager.
+        
+        Our blocks can only be evicted (spilled) while the DiskSpillStore is enabled.
+        Otherwise, their memory must not count towards the cache budget: the memory manager 
+        would evict all other caches and still not get under the budget.
+        """
+        with self._report_lock:
+            self._stored_bytes += new_size - old_size
+            evictable = self._spill_store.enabled()
+            reported = self._stored_bytes if evictable else 0
+            delta = reported - self._reported_bytes
+            self._reported_bytes = reported
+
+            if delta > 0:
+                self._memory_manager.reportAllocation(self, delta)
+                # (Re-)register as a candidate for eviction.
+                # (The memory manager forgets about us after it evicted us.)
+                self._memory_manager.add(self)
+            elif delta < 0:
+                self._memory_manager.reportFree(self, -delta)
+                if not evictable:
+                    self._memory_manager.remove(self)
+
+    def _restoreSpilledBlock(self, block_start, block):
+        """
+        If the given block was spilled to disk, load it back into memory, 
+        so that subsequent reads don't have to go to the spill file.
+        """
+        if not block.isSpilled():
+            return
+        with self._blockLocks[block_start]:
+            old_size = block.storageSize()
+            block.unspill()
+            self._reportStorageChange( old_size, block.storageSize() )
+
+    def _freeMemory(self, refcheck=True):
+        """
+        Called by the memory manager.
+        Move all clean blocks to the DiskSpillStore (if it is enabled) and return the number of bytes freed.
+        """
+        if not self._spill_store.enabled():
+            return 0
+        freed = 0
+        for block_start, block in self._cacheFiles.items():
+            if block_start in self._dirtyBlocks:
+                continue
+            with self._blockLocks[block_start]:
+                freed += block.spill( self._spill_store )
+        self._reportStorageChange( freed, 0 )
+        if freed:
+            logger.debug( "Spilled {} bytes to disk".format( freed ) )
+        return freed
+
     def generateReport(self, report):
         report.name = self.name
         report.fractionOfUsedMemoryDirty = self.fractionOfUsedMemoryDirty()
@@ -285,7 +395,7 @@ class OpCompressedCache(OpCache):
 
     def _getCacheFile(self, entire_block_roi):
         """
-        Get the cache file for the block that starts at block_start.
+        Get the storage (see compressedBlocks.py) for the block that starts at block_start.
         If it doesn't exist yet, create it first.
         """
         block_start = tuple(entire_block_roi[0])
@@ -293,27 +403,15 @@ class OpCompressedCache(OpCache):
             return self._cacheFiles[block_start]
         with self._lock:
             if block_start not in self._cacheFiles:
-                # Create an in-memory hdf5 file with a unique name
-                logger.debug("Creating a cache file for block: {}".format( list(block_start) ))
-                filename = str(id(self)) + str(id(self._cacheFiles)) + str(block_start)
-                mem_file = h5py.File(filename, driver='core', backing_store=False, mode='w')                
-
-                # h5py will crash if the chunkshape is larger than the dataset shape.
+                logger.debug("Creating a cache block for block: {}".format( list(block_start) ))
+                block_class = self.BlockClass or defaultBlockClass()
                 datashape = tuple( entire_block_roi[1] - entire_block_roi[0] )
-                chunkshape = numpy.minimum(numpy.array(datashape), self._chunkshape )
-                chunkshape = tuple(chunkshape)
-
-                # Make a compressed dataset
-                mem_file.create_dataset('data',
-                                        shape=datashape,
-                                        dtype=self.Output.meta.dtype,
-                                        chunks=chunkshape,
-                                        compression='lzf' ) # lzf should be faster than gzip, 
-                                                            # with a slightly worse compression ratio
+                block = createBlock( block_class, datashape, self.Output.meta.dtype, self._chunkshape )
 
                 self._blockLocks[block_start] = RequestLock()
-                self._cacheFiles[block_start] = mem_file
+                self._cacheFiles[block_start] = block
                 self._dirtyBlocks.add( block_start )
+                self._reportStorageChange( 0, block.storageSize() )
             return self._cacheFiles[block_start]
 
 
@@ -323,22 +421,25 @@ class OpCompressedCache(OpCache):
         (Refresh it if it's dirty.)
         """
         block_start = tuple(entire_block_roi[0])
-        block_file = self._getCacheFile(entire_block_roi)
+        block = self._getCacheFile(entire_block_roi)
         if block_start in self._dirtyBlocks:
             updated_cache = False
             with self._blockLocks[block_start]:
                 # Check AGAIN now that we have the lock.
                 # (Avoid doing this twice in parallel requests.)
                 if block_start in self._dirtyBlocks:
-                    # Can't write directly into the hdf5 dataset because 
-                    #  h5py.dataset.__getitem__ creates a copy, not a view.
+                    # Can't write directly into the compressed block storage.
                     # We must use a temporary numpy array to hold the data.
+                    compute_start = time.time()
                     data = self.Input(*entire_block_roi).wait()
-                    block_file['data'][...] = data
+                    self._blockComputeTimes[block_start] = time.time() - compute_start
+                    old_size = block.storageSize()
+                    block[...] = data
+                    self._reportStorageChange( old_size, block.storageSize() )
                     
                     if logger.isEnabledFor(logging.DEBUG):
                         uncompressed_size = numpy.prod(data.shape) * self._getDtypeBytes(data.dtype)
-                        storage_size = block_file["data"].id.get_storage_size()
+                        storage_size = block.storageSize()
                         logger.debug("Storage for block: {} is {}. ({}% of original)".format( block_start, storage_size, 100*storage_size/uncompressed_size ))
                     with self._lock:
                         self._dirtyBlocks.remove( block_start )
@@ -397,13 +498,16 @@ class OpCompressedCache(OpCache):
                 pass
             else:
                 # Copy from source to block
-                dataset = self._getBlockDataset( entire_block_roi )
-                dataset[ roiToSlice( *block_relative_intersection ) ] = new_block_data
+                block = self._getBlockDataset( entire_block_roi )
+                old_size = block.storageSize()
+                block[ roiToSlice( *block_relative_intersection ) ] = new_block_data
+                self._reportStorageChange( old_size, block.storageSize() )
     
             # Here, we assume that if this function is used to update ANY PART of a 
             #  block, he is responsible for updating the ENTIRE block.
             # Therefore, this block is no longer 'dirty'
             self._dirtyBlocks.discard( block_start )
+            self._blockComputeTimes.pop( block_start, None )
     
     #            self.Output._sig_value_changed()
     #            self.OutputHdf5._sig_value_changed()
@@ -419,15 +523,15 @@ class OpCompressedCache(OpCache):
         roi_is_exactly_one_block &= ((roi.start % self._blockshape) == 0).all()
         roi_is_exactly_one_block &= (block_roi == numpy.array((roi.start, roi.stop))).all()
         if roi_is_exactly_one_block:
-            cachefile = self._getCacheFile( block_roi )
+            block = self._getCacheFile( block_roi )
             logger.debug( "Copying HDF5 data directly into block {}".format( block_roi ) )
-            assert cachefile['data'].dtype == value.dtype
-            assert cachefile['data'].shape == value.shape
-            del cachefile['data']
-            cachefile.copy( value, 'data' )
+            old_size = block.storageSize()
+            block.importHdf5( value )
+            self._reportStorageChange( old_size, block.storageSize() )
     
             block_start = tuple(roi.start)
             self._dirtyBlocks.discard( block_start )
+            self._blockComputeTimes.pop( block_start, None )
         else:
             # This hdf5 data does not correspond to exactly one block.
             # We must uncompress it and write it the "normal" way (the slow way)
@@ -440,13 +544,23 @@ class OpCompressedCache(OpCache):
 
     def _getBlockDataset(self, entire_block_roi):
         """
-        Get the correct cache file and return the *dataset* handle,
-        not a numpy array of its contents.
+        Get the correct block storage object, which supports numpy-style 
+        slicing (but is not a numpy array itself).
         """
-        block_file = self._getCacheFile(entire_block_roi)
-        return block_file['data']
+        return self._getCacheFile(entire_block_roi)
 
 
+    def _closeBlocks(self):
+        """
+        Close all blocks (which also deletes their spill files, if any).
+        Must be called with self._lock held.
+        """
+        freed = 0
+        for block in self._cacheFiles.values():
+            freed += block.storageSize()
+            block.close()
+        self._reportStorageChange( freed, 0 )
+
     def _closeAllCacheFiles(self):
         logger.debug( "Closing all caches" )
         cacheFiles = self._cacheFiles
@@ -456,6 +570,9 @@ class OpCompressedCache(OpCache):
         with self._lock:
             self._blockLocks = {}
             self._cacheFiles = {}
+        with self._report_lock:
+            self._stored_bytes = 0
+            self._reported_bytes = 0
 
 
 
@@ -298,7 +298,6 @@ class OpCompressedUserLabelArray(OpCompressedCache):
         Copy data from each block into the destination array.
         For blocks that aren't currently stored, just write zeros.
         """
-        # (Parallelism not needed here: h5py will serialize these requests anyway)
         block_starts = map( tuple, block_starts )
         for block_start in block_starts:
             entire_block_roi = getBlockBounds( self.Output.meta.shape, self._blockshape, block_start )
@@ -312,8 +311,9 @@ class OpCompressedUserLabelArray(OpCompressedCache):
             
             if block_start in self._cacheFiles:
                 # Copy from block to destination
-                dataset = self._getBlockDataset( entire_block_roi )
-                destination[ roiToSlice(*destination_relative_intersection) ] = dataset[ roiToSlice( *block_relative_intersection ) ]
+                block = self._getBlockDataset( entire_block_roi )
+                block.readInto( roiToSlice( *block_relative_intersection ),
+                                destination[ roiToSlice(*destination_relative_intersection) ] )
             else:
                 # Not stored yet.  Overwrite with zeros.
                 destination[ roiToSlice(*destination_relative_intersection) ] = 0
@@ -16,6 +16,14 @@ class OpFeatureMatrixCache(Operator):
     - Cache the feature matrix for each block separately
     - Output the concatenation of all feature matrices
     
+    The blockwise matrices are stored as row ranges of a single preallocated 
+    matrix (see _BlockRowMatrix), so updating a dirty block only patches 
+    its own rows, and the output is a view of that matrix instead of a 
+    fresh concatenation.  The storage is copy-on-write: once the output has 
+    been handed out, the next update moves the stored rows to a new matrix 
+    before changing them, so the output never changes under its readers.
+    (Don't modify the output matrix, though.)
+    
     Note: This operator does not currently use the NonZeroLabelBlocks slot.
           Instead, it only requests labels for blocks that have been
           marked dirty via dirty notifications from the LabelImage slot.
@@ -48,7 +56,7 @@ class OpFeatureMatrixCache(Operator):
         
         self._blockshape = None
         self._dirty_blocks = set()
-        self._blockwise_feature_matrices = {}
+        self._block_rows = _BlockRowMatrix(0) # Replaced in setupOutputs()
         self._block_locks = {} # One lock per stored block
 
         self._init_blocks(None, None)
@@ -60,7 +68,7 @@ class OpFeatureMatrixCache(Operator):
             return
         
         if ( len(self._dirty_blocks) != 0
-             or len(self._blockwise_feature_matrices) != 0):
+             or len(self._block_rows) != 0):
             raise RuntimeError("It's too late to change the dimensionality of your data after you've already started training.\n"
                                "Delete all your labels and try again.")
 
@@ -89,6 +97,13 @@ class OpFeatureMatrixCache(Operator):
             self.LabelAndFeatureMatrix.meta.num_feature_channels = num_feature_channels
             self.LabelAndFeatureMatrix.setDirty()
 
+        with self._lock:
+            if self._block_rows.num_columns != 1 + num_feature_channels:
+                # The stored rows have the wrong width now.
+                # Drop them and recompute those blocks on the next request.
+                self._dirty_blocks.update( self._block_rows.block_ids() )
+                self._block_rows = _BlockRowMatrix( 1 + num_feature_channels )
+
         self.ProgressSignal.meta.shape = (1,)
         self.ProgressSignal.meta.dtype = object
         self.ProgressSignal.setValue( self.progressSignal )
@@ -153,29 +168,18 @@ class OpFeatureMatrixCache(Operator):
                 labels_and_features_matrix = req.result
                 self._dirty_blocks.remove(block_start)
                 
-                if labels_and_features_matrix.shape[0] > 0:
-                    # Update the block entry with the new matrix.
-                    self._blockwise_feature_matrices[block_start] = labels_and_features_matrix
-                else:
-                    # All labels were removed from the block,
-                    # So the new feature matrix is empty.  
-                    # Just delete its entry from our list.
-                    try:
-                        del self._blockwise_feature_matrices[block_start]
-                    except KeyError:
-                        pass
-
-        # Concatenate the all blockwise results
-        if self._blockwise_feature_matrices:
-            total_feature_matrix = numpy.concatenate( self._blockwise_feature_matrices.values(), axis=0 )
-        else:
-            # No label points at all.
-            # Return an empty label&feature matrix (of the correct shape)
-            num_feature_channels = self.FeatureImage.meta.shape[-1]
-            total_feature_matrix = numpy.ndarray( shape=(0, 1 + num_feature_channels), dtype=numpy.float32 )
+                # Patch the block's rows with the new matrix.
+                # (If all labels were removed from the block, 
+                #  the new matrix is empty and the block's rows are dropped.)
+                self._block_rows.update( block_start, labels_and_features_matrix )
+
+            # No copy: this is a (copy-on-write) view of the stored rows.
+            # (If there are no label points at all, it has 0 rows, but the correct shape.)
+            total_feature_matrix = self._block_rows.matrix()
+            num_clean_blocks = len(self._block_rows)
 
         self.progressSignal(100.0)
-        logger.debug( "After update, there are {} clean blocks".format( len(self._blockwise_feature_matrices) ) )
+        logger.debug( "After update, there are {} clean blocks".format( num_clean_blocks ) )
         result[0] = total_feature_matrix
 
     def propagateDirty(self, slot, subindex, roi):
@@ -198,7 +202,7 @@ class OpFeatureMatrixCache(Operator):
         # For big dirty rois (e.g. the entire image), 
         #  we avoid a lot of unnecessary entries in self._dirty_blocks
         if slot == self.FeatureImage:
-            block_starts = set( block_starts ).intersection( self._blockwise_feature_matrices.keys() )
+            block_starts = set( block_starts ).intersection( self._block_rows.block_ids() )
 
         with self._lock:
             self._dirty_blocks.update( block_starts )
@@ -256,4 +260,123 @@ class OpFeatureMatrixCache(Operator):
         features_matrix = features[bounding_box_positions].view(numpy.ndarray)
         return numpy.concatenate( (labels_matrix, features_matrix), axis=1)
 
-        
\ No newline at end of file
+class _BlockRowMatrix(object):
+    """
+    A preallocated 2D float32 matrix that holds the rows of many blocks.
+    Each block owns one contiguous range of rows.  The matrix grows by 
+    doubling its capacity, so appending rows is cheap (amortized).
+    
+    When a block's rows are replaced by fewer rows, they are overwritten in place.
+    Otherwise, the new rows are appended at the end.  Rows that no longer belong
+    to any block are 'tombstones', which are squeezed out by compact().
+
+    The views returned by matrix() never change: If the storage has been 
+    handed out, it is copied (once) before it is modified again.
+    
+    Not threadsafe: The caller must serialize access.
+    """
+    MIN_CAPACITY = 1024
+
+    def __init__(self, num_columns):
+        self.num_columns = num_columns
+        self._data = numpy.ndarray( shape=(self.MIN_CAPACITY, num_columns), dtype=numpy.float32 )
+        self._num_rows = 0 # Rows in use, including tombstones
+        self._num_tombstones = 0
+        self._row_ranges = {} # block_id -> (start_row, stop_row)
+        self._shared = False # True if a view of self._data has been handed out by matrix()
+
+    def __len__(self):
+        """Number of stored (non-empty) blocks."""
+        return len(self._row_ranges)
+
+    def block_ids(self):
+        return self._row_ranges.keys()
+
+    def update(self, block_id, block_matrix):
+        """
+        Replace the rows of the given block with the given matrix.
+        If the matrix is empty, the block is removed.
+        """
+        num_new_rows = block_matrix.shape[0]
+        assert num_new_rows == 0 or block_matrix.shape[1] == self.num_columns, \
+            "Block matrix has wrong number of columns: {} (expected {})"\
+            "".format( block_matrix.shape[1], self.num_columns )
+
+        self._detach()
+        old_range = self._row_ranges.pop(block_id, None)
+        if old_range is not None:
+            start, stop = old_range
+            if num_new_rows <= stop - start or stop == self._num_rows:
+                # Patch in place.  (At the end of the matrix, the block may also grow in place.)
+                if stop == self._num_rows:
+                    self._reserve( start + num_new_rows )
+                    self._num_rows = start + num_new_rows
+                else:
+                    self._num_tombstones += (stop - start) - num_new_rows
+                if num_new_rows > 0:
+                    self._data[start:start+num_new_rows] = block_matrix
+                    self._row_ranges[block_id] = (start, start+num_new_rows)
+                return
+            # Doesn't fit: Abandon the old rows.
+            self._num_tombstones += stop - start
+
+        if num_new_rows == 0:
+            return
+
+        # Append
+        start = self._num_rows
+        self._reserve( start + num_new_rows )
+        self._data[start:start+num_new_rows] = block_matrix
+        self._num_rows += num_new_rows
+        self._row_ranges[block_id] = (start, start+num_new_rows)
+
+    def compact(self):
+        """
+        Squeeze out the tombstones by moving each block's rows towards the 
+        top of the matrix, and release capacity that is no longer needed.
+        """
+        if self._num_tombstones > 0:
+            self._detach()
+            next_row = 0
+            sorted_ranges = sorted( self._row_ranges.items(), key=lambda (block_id, row_range): row_range[0] )
+            for block_id, (start, stop) in sorted_ranges:
+                num_block_rows = stop - start
+                if start != next_row:
+                    # The source and destination may overlap, but numpy handles that correctly.
+                    self._data[next_row:next_row+num_block_rows] = self._data[start:stop]
+                    self._row_ranges[block_id] = (next_row, next_row+num_block_rows)
+                next_row += num_block_rows
+            self._num_rows = next_row
+            self._num_tombstones = 0
+
+        if 4*self._num_rows < len(self._data) and len(self._data) > self.MIN_CAPACITY:
+            self._resize( max(self.MIN_CAPACITY, 2*self._num_rows) )
+
+    def matrix(self):
+        """
+        Return all rows of all blocks (in no particular block order).
+        The result is a view of the internal storage, which is not modified 
+        afterwards (see _detach()).  The caller must not modify it either.
+        """
+        self.compact()
+        self._shared = True
+        return self._data[:self._num_rows]
+
+    def _detach(self):
+        """
+        Before modifying the storage: If a view of it has been handed out, 
+        continue with a private copy, so the view keeps its contents.
+        """
+        if self._shared:
+            self._resize( len(self._data) )
+
+    def _reserve(self, num_rows):
+        capacity = len(self._data)
+        if num_rows > capacity:
+            self._resize( max(num_rows, 2*capacity) )
+
+    def _resize(self, capacity):
+        new_data = numpy.ndarray( shape=(capacity, self.num_columns), dtype=numpy.float32 )
+        new_data[:self._num_rows] = self._data[:self._num_rows]
+        self._data = new_data
+        self._shared = False
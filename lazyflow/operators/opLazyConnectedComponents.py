@@ -429,13 +429,9 @@ class OpLazyConnectedComponents(Operator):
             with self._lock:
                 # determine the offset
                 # localLabel + offset = globalLabel (for localLabel>0)
-                offset = self._uf.makeNewIndex()
+                offset = self._uf.makeNewIndices(numLabels)
                 self._globalLabelOffset[chunkIndex] = offset - 1
 
-                # get n-1 more labels
-                for i in range(numLabels-1):
-                    self._uf.makeNewIndex()
-
     # merge the labels of two adjacent chunks
     # the chunks have to be ordered lexicographically, e.g. by self._orderPair
     @_chunksynchronized
@@ -472,10 +468,7 @@ class OpLazyConnectedComponents(Operator):
             map_b = self.localToGlobal(chunkB)
             labels_a = map_a[label_hyperplane_a[adjacent_bool_inds]]
             labels_b = map_b[label_hyperplane_b[adjacent_bool_inds]]
-            for a, b in zip(labels_a, labels_b):
-                assert a not in self._globalToFinal, "Invalid merge"
-                assert b not in self._globalToFinal, "Invalid merge"
-                self._uf.makeUnion(a, b)
+            self._uf.makeUnions(labels_a, labels_b)
 
             logger.debug("merged chunks {} and {}".format(chunkA, chunkB))
         correspondingLabelsA = label_hyperplane_a[adjacent_bool_inds]
@@ -527,8 +520,7 @@ class OpLazyConnectedComponents(Operator):
         numLabels = self._numIndices[chunkIndex]
         labels = np.arange(1, numLabels+1, dtype=_LABEL_TYPE) + offset
 
-        labels = np.asarray(map(self._uf.findIndex, labels),
-                            dtype=_LABEL_TYPE)
+        labels = self._uf.findIndices(labels)
 
         # we got 'numLabels' real labels, and one label '0', so our
         # output has to have numLabels+1 elements
@@ -539,21 +531,27 @@ class OpLazyConnectedComponents(Operator):
     # map an array of global indices to final labels
     # after calling this function, the labels passed in may not be used with
     # UnionFind.makeUnion any more!
-    @threadsafe
     def globalToFinal(self, t, c, labels):
-        newlabels = labels.copy()
-        d = self._globalToFinal[(t, c)]
-        labeler = self._labelIterators[(t, c)]
-        for k in np.unique(labels):
-            l = self._uf.findIndex(k)
-            if l == 0:
-                continue
-
-            if l not in d:
-                nextLabel = labeler.next()
-                d[l] = nextLabel
-            newlabels[labels == k] = d[l]
-        return newlabels
+        labels = np.asarray(labels)
+        uniqueLabels, inverse = np.unique(labels, return_inverse=True)
+        roots = self._uf.findIndices(uniqueLabels).tolist()
+
+        # final labels are never reassigned, so if every root already has a
+        # final label we don't need the lock
+        d = self._globalToFinal.get((t, c), {0: 0})
+        finalLabels = [d.get(l) for l in roots]
+        if None in finalLabels:
+            with self._lock:
+                d = self._globalToFinal[(t, c)]
+                labeler = self._labelIterators[(t, c)]
+                finalLabels = []
+                for l in roots:
+                    if l not in d:
+                        d[l] = labeler.next()
+                    finalLabels.append(d[l])
+
+        finalLabels = np.asarray(finalLabels, dtype=_LABEL_TYPE)
+        return finalLabels[inverse].reshape(labels.shape)
 
     ##########################################################################
     ##################### HELPER METHODS #####################################
@@ -688,7 +686,8 @@ class OpLazyConnectedComponents(Operator):
         # keep track of assigned global labels
         gen = partial(InfiniteLabelIterator, 1, dtype=_LABEL_TYPE)
         self._labelIterators = defaultdict(gen)
-        self._globalToFinal = defaultdict(dict)
+        # the background (global index 0) always maps to final label 0
+        self._globalToFinal = defaultdict(partial(dict, {0: 0}))
         self._isFinal = np.zeros(self._chunkArrayShape, dtype=np.bool)
 
         ### algorithmic ###
@@ -786,22 +785,23 @@ class OpLazyConnectedComponents(Operator):
 
 
 # python implementation of vigra's UnionFindArray structure
+# The parent of each label is stored in a growable numpy array, which
+# allows for vectorized find and union operations on whole label arrays.
 class UnionFindArray(object):
 
     def __init__(self, nextFree=1):
-        self._map = dict(zip(*(xrange(nextFree),)*2))
+        self._parents = np.arange(max(nextFree, 1024), dtype=_LABEL_TYPE)
         self._lock = HardLock()
         self._nextFree = nextFree
         self._it = None
 
     ## join regions a and b
-    # callback is called whenever two regions are joined that were
-    # separate before, signature is 
-    #   callback(smaller_label, larger_label)
+    # the smaller of the two representatives becomes the representative
+    # of the joined region
     @threadsafe
     def makeUnion(self, a, b):
-        assert a in self._map
-        assert b in self._map
+        assert a < self._nextFree
+        assert b < self._nextFree
 
         a = self._findIndex(a)
         b = self._findIndex(b)
@@ -811,26 +811,89 @@ class UnionFindArray(object):
         if a > b:
             a, b = b, a
 
-        self._map[b] = a
+        self._parents[b] = a
+
+    ## join regions labelsA[i] and labelsB[i] for all i
+    @threadsafe
+    def makeUnions(self, labelsA, labelsB):
+        labelsA = np.asarray(labelsA, dtype=_LABEL_TYPE).ravel()
+        labelsB = np.asarray(labelsB, dtype=_LABEL_TYPE).ravel()
+        assert labelsA.shape == labelsB.shape
+        assert labelsA.size == 0 or max(labelsA.max(), labelsB.max()) < self._nextFree
+
+        while labelsA.size > 0:
+            a = self._findIndices(labelsA)
+            b = self._findIndices(labelsB)
+            unmerged = a != b
+            if not np.any(unmerged):
+                break
+            labelsA = labelsA[unmerged]
+            labelsB = labelsB[unmerged]
+            a = a[unmerged]
+            b = b[unmerged]
+            # Point the larger representative to the smaller one. If a
+            # representative appears in several pairs, only one of them
+            # is applied in this pass, the others are handled in the
+            # next pass (the number of regions decreases in every pass).
+            self._parents[np.maximum(a, b)] = np.minimum(a, b)
 
     @threadsafe
     def makeNewIndex(self):
+        return self._makeNewIndices(1)
+
+    ## reserve n consecutive new labels, returns the first one
+    @threadsafe
+    def makeNewIndices(self, n):
+        return self._makeNewIndices(n)
+
+    def _makeNewIndices(self, n):
         newLabel = self._nextFree
-        self._nextFree += 1
-        self._map[newLabel] = newLabel
-        return newLabel
+        stop = newLabel + n
+        assert stop <= np.iinfo(_LABEL_TYPE).max, "Label overflow."
+        if stop > len(self._parents):
+            capacity = max(stop, 2*len(self._parents))
+            capacity = min(capacity, np.iinfo(_LABEL_TYPE).max)
+            parents = np.arange(capacity, dtype=_LABEL_TYPE)
+            parents[:newLabel] = self._parents[:newLabel]
+            self._parents = parents
+        self._nextFree = stop
+        return _LABEL_TYPE(newLabel)
 
     @threadsafe
     def findIndex(self, a):
         return self._findIndex(a)
 
+    ## find the representatives for an array of labels
+    @threadsafe
+    def findIndices(self, labels):
+        return self._findIndices(labels)
+
     def _findIndex(self, a):
-        while a != self._map[a]:
-            a = self._map[a]
-        return a
+        parents = self._parents
+        root = a
+        while root != parents[root]:
+            root = parents[root]
+        # path compression
+        while a != root:
+            parents[a], a = root, parents[a]
+        return root
+
+    def _findIndices(self, labels):
+        labels = np.asarray(labels, dtype=_LABEL_TYPE)
+        parents = self._parents
+        roots = parents[labels]
+        while True:
+            nextRoots = parents[roots]
+            if np.array_equal(nextRoots, roots):
+                break
+            roots = nextRoots
+        # path compression (for the queried labels)
+        parents[labels] = roots
+        return roots
 
     def __str__(self):
-        s = "<UnionFindArray>\n{}".format(self._map)
+        s = "<UnionFindArray>\n{}".format(self._parents[:self._nextFree])
+        return s
 
     def __getstate__(self):
         odict = self.__dict__.copy()
@@ -839,6 +902,7 @@ class UnionFindArray(object):
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        self._lock = HardLock()
 
 
 class InfiniteLabelIterator(object):
@@ -21,6 +21,9 @@
 ###############################################################################
 from lazyflow.graph import Operator,InputSlot,OutputSlot
 from lazyflow.stype import ArrayLike, Opaque
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool, RequestLock
+from functools import partial
 import numpy,vigra
 
 
@@ -29,19 +32,28 @@ class OpObjectFeatures(Operator):
     Image = InputSlot()  # 2D image
     Labels = InputSlot() # 2D or 3D image, if 3D last dimension is interpreted as channel
     SelectedFeatures = InputSlot(value = ["all"]) # a list of strings, or a string like "all". the string entries should equal the names returned by the AvailableFeatures slot
+    BlockShape = InputSlot(optional = True) # if given, the features are computed blockwise (in parallel) with blocks of this shape (without the channel axis),
+                                            # which limits the memory usage. Only the BlockwiseFeatures are supported in this mode.
 
     FeatureDict = OutputSlot() # a python dictionary consisting of the features names as keys and numpy arrays as values
     FeatureMatrix = OutputSlot() # a 2D numpy array of with regions along axis 0 and features along axis 1
 
     AvailableFeatures = OutputSlot() # a list of strings of the feature names
 
-    def __init__(self,parent):
-        Operator.__init__(self, parent)
+    # the features that can be computed blockwise, by merging the statistics of all blocks
+    BlockwiseFeatures = ["Count", "Sum", "Mean", "Variance", "Skewness", "Kurtosis",
+                         "Minimum", "Maximum", "Coord<Minimum>", "Coord<Maximum>", "RegionCenter"]
+
+    def __init__(self, *args, **kwargs):
+        super(OpObjectFeatures, self).__init__(*args, **kwargs)
 
     def setupOutputs(self):
-        features = self.SelectedFeatures[0].wait()
+        assert(self.Image.meta.shape[:-1] == self.Labels.meta.shape[:-1])
 
-        assert(self.Image.shape[:-1] == self.Labels.shape[:-1])
+        if self.BlockShape.ready():
+            unsupported = set(self._blockwiseFeatureNames()) - set(self.BlockwiseFeatures)
+            if unsupported:
+                raise ValueError("OpObjectFeatures: cannot compute {} blockwise".format(", ".join(sorted(unsupported))))
 
         self.FeatureDict.meta.shape = (1,)
         self.FeatureDict.meta.dtype = object
@@ -54,6 +66,8 @@ class OpObjectFeatures(Operator):
 
     def execute(self, slot, subindex, roi, result):
         if slot == self.FeatureDict:
+            if self.BlockShape.ready():
+                return [self._computeFeaturesBlockwise()]
 
             features = self.SelectedFeatures[0].wait()[0]
 
@@ -129,6 +143,342 @@ class OpObjectFeatures(Operator):
         self.FeatureDict.setDirty((slice(None), ))
         self.FeatureMatrix.setDirty((slice(None), ))
 
+    def _blockwiseFeatureNames(self):
+        features = self.SelectedFeatures.value
+        if isinstance(features, str):
+            features = [features]
+        if "all" in features:
+            return list(self.BlockwiseFeatures)
+        return list(features)
+
+    def _computeFeaturesBlockwise(self):
+        """
+        Compute the FeatureDict block by block (in parallel requests), merging
+        the region statistics of each block, so that the whole image and label
+        volumes never need to be in memory at once.
+        """
+        names = self._blockwiseFeatureNames()
+        needMoments = bool(set(names) & set(["Variance", "Skewness", "Kurtosis"]))
+        needCoords = bool(set(names) & set(["Coord<Minimum>", "Coord<Maximum>", "RegionCenter"]))
+
+        imageShape = self.Image.meta.shape
+        labelShape = self.Labels.meta.shape
+        if imageShape[-1] == labelShape[-1]:
+            # standard behaviour, last dimension of equal size (no channels)
+            hasChannels = False
+            shape = tuple(imageShape)
+            numImageChannels = numLabelChannels = 1
+        else:
+            # treat last dim of labels as channels, which is to be applied to all channels of image
+            hasChannels = True
+            shape = tuple(imageShape[:-1])
+            numImageChannels = imageShape[-1]
+            numLabelChannels = labelShape[-1]
+
+        blockShape = tuple(self.BlockShape.value)
+        assert len(blockShape) == len(shape), \
+            "BlockShape {} does not match the image shape {}".format(blockShape, shape)
+
+        # The merged statistics are sharded by label, so that several blocks can be merged at once.
+        numShards = max(1, Request.global_thread_pool.num_workers)
+        accumulators = {}
+        for ic in range(numImageChannels):
+            for cc in range(numLabelChannels):
+                accumulators[(ic, cc)] = _ShardedRegionAccumulator(len(shape), needMoments, needCoords, numShards)
+
+        def processBlock(blockStart, blockStop):
+            key = roiToSlice(blockStart, blockStop)
+            if hasChannels:
+                key += (slice(None),)
+            image = self.Image[key].wait().astype(numpy.float32)
+            labels = self.Labels[key].wait().astype(numpy.uint32)
+            if not hasChannels:
+                image.shape = image.shape + (1,)
+                labels.shape = labels.shape + (1,)
+
+            for ic in range(numImageChannels):
+                for cc in range(numLabelChannels):
+                    blockAccumulator = _RegionAccumulator.fromBlock(image[...,ic], labels[...,cc], blockStart,
+                                                                    needMoments, needCoords)
+                    accumulators[(ic, cc)].merge(blockAccumulator)
+
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks(blockShape, ([0]*len(shape), shape)):
+            blockStart, blockStop = getBlockBounds(shape, blockShape, blockStart)
+            pool.add( Request( partial(processBlock, blockStart, blockStop) ) )
+        pool.wait()
+        pool.clean()
+
+        # As in the non-blockwise case: for each image channel, each feature array holds
+        # the features of all labels that are present in any of the label channels.
+        result = {}
+        for ic in range(numImageChannels):
+            c_accumulators = [ accumulators.pop((ic, cc)).combine() for cc in range(numLabelChannels) ]
+            c_features = [ acc.features(names) for acc in c_accumulators ]
+            for name in names:
+                feat = max( (f[name] for f in c_features), key=len ).copy()
+                for cc in range(numLabelChannels):
+                    labs = c_accumulators[cc].presentLabels()
+                    feat[labs,...] = c_features[cc][name][labs,...]
+                result.setdefault(name, []).append(feat)
+        return result
+
+
+class _RegionAccumulator(object):
+    """
+    Mergeable per-label statistics of an image (count, mean and central
+    moments, minimum/maximum, bounding box and coordinate sums), which are
+    used by OpObjectFeatures to compute region features blockwise.
+    The moments are merged with the pairwise update formulas for central
+    moments (Pebay 2008), which are stable for large regions.
+
+    The statistics of a single block (see fromBlock) are compact: they have
+    one row per label that occurs in the block, and the labels attribute
+    holds the label of each row.  Other accumulators are indexed by label
+    (or by any other row index that is passed to merge).
+    """
+    def __init__(self, ndim, needMoments, needCoords):
+        self.ndim = ndim
+        self.needMoments = needMoments
+        self.needCoords = needCoords
+        self.labels = None
+        self.count = numpy.zeros((0,))
+        self.mean = numpy.zeros((0,))
+        self.minimum = numpy.zeros((0,))
+        self.maximum = numpy.zeros((0,))
+        if needMoments:
+            self.m2 = numpy.zeros((0,))
+            self.m3 = numpy.zeros((0,))
+            self.m4 = numpy.zeros((0,))
+        if needCoords:
+            self.coordMinimum = numpy.zeros((0, ndim))
+            self.coordMaximum = numpy.zeros((0, ndim))
+            self.coordSum = numpy.zeros((0, ndim))
+
+    def _statisticNames(self):
+        names = ["count", "mean", "minimum", "maximum"]
+        if self.needMoments:
+            names += ["m2", "m3", "m4"]
+        if self.needCoords:
+            names += ["coordMinimum", "coordMaximum", "coordSum"]
+        return names
+
+    @classmethod
+    def fromBlock(cls, values, labels, offset, needMoments, needCoords):
+        """
+        Compute the statistics of the labels in a single block, whose first
+        pixel is at the given (global) offset.
+        """
+        acc = cls(values.ndim, needMoments, needCoords)
+        acc.labels = numpy.zeros((0,), dtype=labels.dtype)
+        if labels.size == 0:
+            return acc
+        shape = labels.shape
+        values = values.ravel().astype(numpy.float64)
+
+        # Only the labels in this block get a row (not every label up to labels.max())
+        acc.labels, rows = numpy.unique(labels.ravel(), return_inverse=True)
+        n = len(acc.labels)
+
+        acc.count = numpy.bincount(rows, minlength=n).astype(numpy.float64)
+        acc.mean = numpy.bincount(rows, weights=values, minlength=n) / acc.count
+
+        if needMoments:
+            d = values - acc.mean[rows]
+            d2 = d*d
+            acc.m2 = numpy.bincount(rows, weights=d2, minlength=n)
+            acc.m3 = numpy.bincount(rows, weights=d2*d, minlength=n)
+            acc.m4 = numpy.bincount(rows, weights=d2*d2, minlength=n)
+            del d, d2
+
+        # reduce the sorted values of each label
+        order = numpy.argsort(rows, kind='mergesort')
+        starts = numpy.searchsorted(rows[order], numpy.arange(n))
+        def reduceLabels(ufunc, a):
+            return ufunc.reduceat(a[order], starts).astype(numpy.float64)
+
+        acc.minimum = reduceLabels(numpy.minimum, values)
+        acc.maximum = reduceLabels(numpy.maximum, values)
+
+        if needCoords:
+            acc.coordMinimum = numpy.zeros((n, acc.ndim))
+            acc.coordMaximum = numpy.zeros((n, acc.ndim))
+            acc.coordSum = numpy.zeros((n, acc.ndim))
+            for axis in range(acc.ndim):
+                # the global coordinate of each pixel along this axis
+                coordShape = [1]*acc.ndim
+                coordShape[axis] = shape[axis]
+                axisCoords = numpy.arange(offset[axis], offset[axis] + shape[axis], dtype=numpy.int32)
+                coords = numpy.empty(shape, dtype=numpy.int32)
+                coords[...] = axisCoords.reshape(coordShape)
+                coords = coords.ravel()
+                acc.coordMinimum[:, axis] = reduceLabels(numpy.minimum, coords)
+                acc.coordMaximum[:, axis] = reduceLabels(numpy.maximum, coords)
+                acc.coordSum[:, axis] = numpy.bincount(rows, weights=coords, minlength=n)
+        return acc
+
+    def presentLabels(self):
+        return numpy.flatnonzero(self.count)
+
+    def take(self, rows):
+        """
+        Return the statistics of the given rows only.
+        """
+        acc = _RegionAccumulator(self.ndim, self.needMoments, self.needCoords)
+        if self.labels is not None:
+            acc.labels = self.labels[rows]
+        for name in self._statisticNames():
+            setattr(acc, name, getattr(self, name)[rows])
+        return acc
+
+    def _reserve(self, n):
+        """
+        Make sure that there are at least n rows.  The arrays grow geometrically,
+        so that merging many blocks doesn't copy them over and over.
+        """
+        size = len(self.count)
+        if size >= n:
+            return
+        size = max(n, 2*size)
+        for name in self._statisticNames():
+            value = getattr(self, name)
+            grown = numpy.zeros((size,) + value.shape[1:])
+            grown[:len(value)] = value
+            setattr(self, name, grown)
+
+    def merge(self, other, rows):
+        """
+        Add the statistics of other (e.g. of a block) to the given rows of
+        these statistics (one row for each row of other).
+        Only the given rows are touched.
+        """
+        if len(rows) == 0:
+            return
+        self._reserve(int(rows.max()) + 1)
+
+        na = self.count[rows]
+        nb = other.count
+        nt = na + nb
+        # avoid division by zero for labels that are not present at all
+        nt_ = numpy.where(nt > 0, nt, 1)
+        mean = self.mean[rows]
+        delta = other.mean - mean
+
+        if self.needMoments:
+            m2a, m3a, m4a = self.m2[rows], self.m3[rows], self.m4[rows]
+            m2b, m3b, m4b = other.m2, other.m3, other.m4
+            self.m2[rows] = m2a + m2b + delta**2 * na*nb/nt_
+            self.m3[rows] = ( m3a + m3b + delta**3 * na*nb*(na - nb)/nt_**2
+                              + 3*delta*(na*m2b - nb*m2a)/nt_ )
+            self.m4[rows] = ( m4a + m4b + delta**4 * na*nb*(na*na - na*nb + nb*nb)/nt_**3
+                              + 6*delta**2*(na*na*m2b + nb*nb*m2a)/nt_**2
+                              + 4*delta*(na*m3b - nb*m3a)/nt_ )
+
+        aMissing = (na == 0)
+        bMissing = (nb == 0)
+        def mergeExtrema(ufunc, a, b):
+            merged = ufunc(a, b)
+            if a.ndim > 1:
+                return numpy.where(aMissing[:,None], b, numpy.where(bMissing[:,None], a, merged))
+            return numpy.where(aMissing, b, numpy.where(bMissing, a, merged))
+
+        self.minimum[rows] = mergeExtrema(numpy.minimum, self.minimum[rows], other.minimum)
+        self.maximum[rows] = mergeExtrema(numpy.maximum, self.maximum[rows], other.maximum)
+        if self.needCoords:
+            self.coordMinimum[rows] = mergeExtrema(numpy.minimum, self.coordMinimum[rows], other.coordMinimum)
+            self.coordMaximum[rows] = mergeExtrema(numpy.maximum, self.coordMaximum[rows], other.coordMaximum)
+            self.coordSum[rows] += other.coordSum
+
+        self.mean[rows] = mean + delta*nb/nt_
+        self.count[rows] = nt
+
+    def features(self, names):
+        """
+        Return a dict of the requested region features (as named by
+        vigra.analysis.extractRegionFeatures), indexed by label.
+        """
+        count = self.count
+        present = count > 0
+        count_ = numpy.where(present, count, 1)
+        result = {}
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for name in names:
+                if name == "Count":
+                    feature = count.copy()
+                elif name == "Sum":
+                    feature = self.mean * count
+                elif name == "Mean":
+                    feature = self.mean.copy()
+                elif name == "Variance":
+                    feature = self.m2 / count_
+                elif name == "Skewness":
+                    feature = numpy.sqrt(count) * self.m3 / self.m2**1.5
+                elif name == "Kurtosis":
+                    feature = count * self.m4 / self.m2**2 - 3.0
+                elif name == "Minimum":
+                    feature = self.minimum.copy()
+                elif name == "Maximum":
+                    feature = self.maximum.copy()
+                elif name == "Coord<Minimum>":
+                    feature = self.coordMinimum.copy()
+                elif name == "Coord<Maximum>":
+                    feature = self.coordMaximum.copy()
+                elif name == "RegionCenter":
+                    feature = self.coordSum / count_[:,None]
+                else:
+                    raise ValueError("Feature {} cannot be computed blockwise".format(name))
+                # labels that are not present have no features
+                feature[~present] = 0
+                result[name] = feature
+        return result
+
+
+
+class _ShardedRegionAccumulator(object):
+    """
+    The merged statistics of all labels, split into shards by label
+    (label % numShards), each with its own lock.  Merging a block only
+    touches the rows of the labels in that block, and blocks whose labels
+    are merged into different shards don't wait for each other.
+    """
+    def __init__(self, ndim, needMoments, needCoords, numShards):
+        self.numShards = numShards
+        self._shards = [ _RegionAccumulator(ndim, needMoments, needCoords) for _ in range(numShards) ]
+        self._locks = [ RequestLock() for _ in range(numShards) ]
+        self._args = (ndim, needMoments, needCoords)
+
+    def merge(self, blockAccumulator):
+        """
+        Add the statistics of a block (see _RegionAccumulator.fromBlock).
+        """
+        labels = blockAccumulator.labels.astype(numpy.int64)
+        shardIndex = labels % self.numShards
+        order = numpy.argsort(shardIndex, kind='mergesort')
+        bounds = numpy.searchsorted(shardIndex[order], numpy.arange(self.numShards + 1))
+        for s in range(self.numShards):
+            rows = order[bounds[s]:bounds[s+1]]
+            if len(rows) == 0:
+                continue
+            part = blockAccumulator.take(rows)
+            with self._locks[s]:
+                self._shards[s].merge(part, labels[rows] // self.numShards)
+
+    def combine(self):
+        """
+        Return a single _RegionAccumulator with the statistics of all labels,
+        indexed by label.  (The shards are discarded.)
+        """
+        total = _RegionAccumulator(*self._args)
+        presentLabels = [ shard.presentLabels() for shard in self._shards ]
+        n = 0
+        for s, present in enumerate(presentLabels):
+            if len(present):
+                n = max(n, present[-1]*self.numShards + s + 1)
+        total._reserve(n)
+        for s, present in enumerate(presentLabels):
+            total.merge(self._shards[s].take(present), present*self.numShards + s)
+            self._shards[s] = None
+        return total
 
 
 if __name__ == "__main__":
@@ -78,6 +78,12 @@ class OpSlicedBlockedArrayCache(OpCache):
         for iOp in self._innerOps:
             tot += iOp.usedMemory()
         return tot
+
+    def computeTime(self):
+        tot = 0.0
+        for iOp in self._innerOps:
+            tot += iOp.computeTime()
+        return tot
     
     def setupOutputs(self):
         self.shape = self.inputs["Input"].meta.shape
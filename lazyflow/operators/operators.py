@@ -37,6 +37,7 @@ from lazyflow import request
 from lazyflow.utility import Tracer
 
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
+from lazyflow.operators.diskSpillStore import DiskSpillStore
 
 #various cache operators
 from lazyflow.operators.opArrayCache import OpArrayCache
@@ -55,6 +56,10 @@ if not hasattr(ArrayCacheMemoryMgr, "instance"):
     setattr(ArrayCacheMemoryMgr, "instance" ,mgr)
     mgr.start()
 
+# create global disk spill store (disabled until configured)
+if not hasattr(DiskSpillStore, "instance"):
+    setattr(DiskSpillStore, "instance", DiskSpillStore())
+
 
 
 
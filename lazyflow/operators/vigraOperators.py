@@ -22,6 +22,7 @@
 ###############################################################################
 #Python
 import os
+import collections
 from collections import deque
 import math
 import traceback
@@ -38,7 +39,7 @@ import numpy, vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow import roi
 from lazyflow.roi import sliceToRoi, roiToSlice
-from lazyflow.request import RequestPool
+from lazyflow.request import Request, RequestPool
 from operators import OpArrayPiper
 from lazyflow.rtype import SubRegion
 from generic import OpMultiArrayStacker, popFlagsFromTheKey
@@ -118,6 +119,11 @@ Op1ToMulti = makeOpXToMulti(1)
 Op5ToMulti = makeOpXToMulti(5)
 Op50ToMulti = makeOpXToMulti(50)
 
+# A single (feature, scale) computation of OpPixelFeaturesPresmoothed.execute():
+#  the closure writes the channels channelRange of the feature into destArea,
+#  spatialRoi is the requested region relative to the presmoothed source array.
+_FeatureTask = collections.namedtuple('_FeatureTask', 'featureIndex scaleIndex closure channelRange destArea spatialRoi')
+
 class OpPixelFeaturesPresmoothed(Operator):
     name="OpPixelFeaturesPresmoothed"
     category = "Vigra filter"
@@ -139,6 +145,10 @@ class OpPixelFeaturesPresmoothed(Operator):
                           'DifferenceOfGaussians' ]
 
     WINDOW_SIZE = 3.5
+
+    # Presmoothing sigmas (and sigma increments) below this value are not
+    # computed by cascading (see _cascadedSmoothing)
+    MIN_CASCADE_SIGMA = 0.8
     
     class InvalidScalesError(Exception):
         def __init__(self, invalid_scales):
@@ -355,6 +365,84 @@ class OpPixelFeaturesPresmoothed(Operator):
             assert False, "Unknown dirty input slot."
             
 
+    def _cascadedSmoothing(self, source, presmoothSigmas, droi):
+        """
+        Smooth source (spatial axes followed by a channel axis) with each of
+        the given presmoothing sigmas and return the smoothed arrays for the
+        spatial region droi, as a dict {scale index : array}.
+
+        Since Gaussians compose (sigma_k**2 = sigma_{k-1}**2 + inc_k**2), the
+        sigmas are processed in ascending order and each result is derived
+        from the previous one with the (smaller) incremental sigma inc_k.
+        Sigmas below MIN_CASCADE_SIGMA are not well represented by a sampled
+        kernel, so such steps start a new cascade from the source instead.
+        Independent cascades are computed in parallel.
+        """
+        steps = sorted(presmoothSigmas, key=lambda (j, sigma): sigma)
+
+        # Split the sigmas into cascades of (scale index, sigma, step sigma)
+        cascades = []
+        previousSigma = 0.0
+        for j, sigma in steps:
+            increment = math.sqrt(max(0.0, sigma**2 - previousSigma**2))
+            if cascades and increment == 0.0:
+                # Same sigma as the previous step
+                cascades[-1].append( (j, sigma, 0.0) )
+            elif cascades and min(previousSigma, increment) >= self.MIN_CASCADE_SIGMA:
+                cascades[-1].append( (j, sigma, increment) )
+            else:
+                cascades.append( [(j, sigma, sigma)] )
+            previousSigma = sigma
+
+        results = {}
+        pool = RequestPool()
+        for cascade in cascades:
+            pool.add( Request( partial(self._smoothCascade, source, cascade, droi, results) ) )
+        pool.wait()
+        pool.clean()
+        return results
+
+    def _smoothCascade(self, source, cascade, droi, results):
+        """
+        Apply the steps of a single cascade (see _cascadedSmoothing) to source,
+        storing the droi region of each step in results.
+        Each step only computes the region that the following steps need.
+        """
+        spatialShape = numpy.array(source.shape[:-1])
+        droiStart, droiStop = map(numpy.array, droi)
+
+        # The margin around droi that is needed by the steps after each step
+        radii = [int(self.WINDOW_SIZE * stepSigma + 0.5) for (j, sigma, stepSigma) in cascade]
+        margins = numpy.cumsum(radii[:0:-1])[::-1].tolist() + [0]
+
+        current = source
+        currentStart = numpy.zeros_like(spatialShape)
+        for (j, sigma, stepSigma), margin in zip(cascade, margins):
+            if stepSigma > 0.0 or current is source:
+                regionStart = numpy.maximum(droiStart - margin, 0)
+                regionStop = numpy.minimum(droiStop + margin, spatialShape)
+                smoothingRoi = (tuple(map(int, regionStart - currentStart)),
+                                tuple(map(int, regionStop - currentStart)))
+                try:
+                    current = vigra.filters.gaussianSmoothing(current, sigma=stepSigma, roi=smoothingRoi, window_size=self.WINDOW_SIZE)
+                except RuntimeError as e:
+                    if e.message.find('kernel longer than line') > -1:
+                        message = "Feature computation error:\nYour image is too small to apply a filter with sigma=%.1f. Please select features with smaller sigmas." % self.scales[j]
+                        raise RuntimeError(message)
+                    else:
+                        raise e
+                currentStart = regionStart
+            key = roiToSlice(droiStart - currentStart, droiStop - currentStart) + (slice(None),)
+            results[j] = current[key]
+
+    def _featureClosures(self, featureTasks, sourceArraysForSigmas):
+        """
+        Return the closures that compute the requested features (one per
+        _FeatureTask) from the presmoothed source arrays.
+        Subclasses may override this to compute several features at once.
+        """
+        return [task.closure for task in featureTasks]
+
     def execute(self, slot, subindex, rroi, result):
         assert slot == self.Features or slot == self.Output
         if slot == self.Features:
@@ -476,44 +564,46 @@ class OpPixelFeaturesPresmoothed(Operator):
 
             sourceArraysForSigmas = [None]*dimCol
 
-            #connect individual operators
-            try:
-                for j in range(dimCol):
-                    hasScale = False
-                    for i in range(dimRow):
-                        if self.matrix[i,j]:
-                            hasScale = True
-                    if not hasScale:
-                        continue
-                    destSigma = 1.0
-                    if self.scales[j] > destSigma:
-                        tempSigma = math.sqrt(self.scales[j]**2 - destSigma**2)
-                    else:
-                        destSigma = 0.0
-                        tempSigma = self.scales[j]
-                    vigOpSourceShape = list(vigOpSourceStop - vigOpSourceStart)
-                    if hasTimeAxis:
-    
-                        if timeAxis < channelAxis:
-                            vigOpSourceShape.insert(timeAxis, ( oldstop - oldstart)[timeAxis])
-                        else:
-                            vigOpSourceShape.insert(timeAxis-1, ( oldstop - oldstart)[timeAxis])
-                        vigOpSourceShape.insert(channelAxis, inShape[channelAxis])
-    
-                        sourceArraysForSigmas[j] = numpy.ndarray(tuple(vigOpSourceShape),numpy.float32)
-                        for i,vsa in enumerate(sourceArrayV.timeIter()):
-                            droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
-                            tmp_key = getAllExceptAxis(len(sourceArraysForSigmas[j].shape),timeAxis, i)
-                            sourceArraysForSigmas[j][tmp_key] = vigra.filters.gaussianSmoothing(vsa,tempSigma, roi = droi, window_size = self.WINDOW_SIZE )
-                    else:
-                        droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
-                        sourceArraysForSigmas[j] = vigra.filters.gaussianSmoothing(sourceArrayV, sigma = tempSigma, roi = droi, window_size = self.WINDOW_SIZE)
-            except RuntimeError as e:
-                if e.message.find('kernel longer than line') > -1:
-                    message = "Feature computation error:\nYour image is too small to apply a filter with sigma=%.1f. Please select features with smaller sigmas." % self.scales[j]
-                    raise RuntimeError(message)
+            # The presmoothing sigma for each scale that is in use
+            presmoothSigmas = []
+            for j in range(dimCol):
+                if not self.matrix[:,j].any():
+                    continue
+                destSigma = 1.0
+                if self.scales[j] > destSigma:
+                    tempSigma = math.sqrt(self.scales[j]**2 - destSigma**2)
                 else:
-                    raise e
+                    destSigma = 0.0
+                    tempSigma = self.scales[j]
+                presmoothSigmas.append( (j, tempSigma) )
+
+            droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
+            if hasTimeAxis:
+                vigOpSourceShape = list(vigOpSourceStop - vigOpSourceStart)
+                if timeAxis < channelAxis:
+                    vigOpSourceShape.insert(timeAxis, ( oldstop - oldstart)[timeAxis])
+                else:
+                    vigOpSourceShape.insert(timeAxis-1, ( oldstop - oldstart)[timeAxis])
+                vigOpSourceShape.insert(channelAxis, inShape[channelAxis])
+                for j, tempSigma in presmoothSigmas:
+                    sourceArraysForSigmas[j] = numpy.ndarray(tuple(vigOpSourceShape),numpy.float32)
+
+                # Presmooth the time slices in parallel
+                def presmoothTimeSlice(i, vsa):
+                    smoothed = self._cascadedSmoothing(vsa, presmoothSigmas, droi)
+                    for j, smoothedArray in smoothed.items():
+                        tmp_key = getAllExceptAxis(len(sourceArraysForSigmas[j].shape),timeAxis, i)
+                        sourceArraysForSigmas[j][tmp_key] = smoothedArray
+
+                pool = RequestPool()
+                for i,vsa in enumerate(sourceArrayV.timeIter()):
+                    pool.add( Request( partial(presmoothTimeSlice, i, vsa) ) )
+                pool.wait()
+                pool.clean()
+            else:
+                smoothed = self._cascadedSmoothing(sourceArrayV, presmoothSigmas, droi)
+                for j, smoothedArray in smoothed.items():
+                    sourceArraysForSigmas[j] = smoothedArray
 
             del sourceArrayV
             try:
@@ -523,7 +613,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 logger.debug("Failed to free array memory.")                
             del sourceArray
 
-            closures = []
+            featureTasks = []
 
             #connect individual operators
             for i in range(dimRow):
@@ -562,7 +652,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                                 roiSmootherRegion = SubRegion(oslot, pslice=roiSmootherList)
                                 
                                 closure = partial(oslot.operator.execute, oslot, (), roiSmootherRegion, destArea, sourceArray = sourceArraysForSigmas[j])
-                                closures.append(closure)
+                                featureTasks.append( _FeatureTask(i, j, closure, (begin, end), destArea, roiSmoother) )
 
                                 written += end - begin
                             cnt += slices
@@ -579,10 +669,11 @@ class OpPixelFeaturesPresmoothed(Operator):
                                 oldroi = SubRegion(oslot, pslice=oldkey)
                                 #print "passing roi:", oldroi
                                 closure = partial(oslot.operator.execute, oslot, (), oldroi, destArea, sourceArray = sourceArraysForSigmas[j])
-                                closures.append(closure)
+                                featureTasks.append( _FeatureTask(i, j, closure, (0, slices), destArea, None) )
 
                                 written += 1
                             cnt += 1
+            closures = self._featureClosures(featureTasks, sourceArraysForSigmas)
             pool = RequestPool()
             for c in closures:
                 r = pool.request(c)
@@ -596,6 +687,142 @@ class OpPixelFeaturesPresmoothed(Operator):
                     except:
                         sourceArraysForSigmas[i] = None
 
+class OpPixelFeaturesSharedDerivatives(OpPixelFeaturesPresmoothed):
+    """
+    Drop-in replacement for OpPixelFeaturesPresmoothed (same slots, same output
+    channel layout).  For each scale, the first and second Gaussian derivatives
+    of the presmoothed image are computed only once, and the gradient magnitude,
+    Laplacian of Gaussian (trace of the Hessian), Hessian eigenvalues and
+    structure tensor eigenvalues are all derived from them.  The remaining
+    features are computed by the individual filter operators, as in
+    OpPixelFeaturesPresmoothed.
+    """
+    name = "OpPixelFeaturesSharedDerivatives"
+
+    # The features that are derived from the shared derivatives
+    DerivativeFeatureIds = [ 'GaussianGradientMagnitude',
+                             'LaplacianOfGaussian',
+                             'HessianOfGaussianEigenvalues',
+                             'StructureTensorEigenvalues' ]
+
+    def _featureClosures(self, featureTasks, sourceArraysForSigmas):
+        featureIds = self.FeatureIds.value
+        closures = []
+        derivativeTasks = collections.defaultdict(list)
+        for task in featureTasks:
+            if task.spatialRoi is not None and featureIds[task.featureIndex] in self.DerivativeFeatureIds:
+                derivativeTasks[task.scaleIndex].append(task)
+            else:
+                closures.append(task.closure)
+
+        for j, tasks in derivativeTasks.items():
+            closures.append( partial(self._computeDerivativeFeatures, sourceArraysForSigmas[j], j, tasks) )
+        return closures
+
+    def _computeDerivativeFeatures(self, sourceArray, scaleIndex, tasks):
+        """
+        Compute the features of the given tasks (which all belong to the same
+        scale) from the shared derivatives of the presmoothed sourceArray.
+        """
+        featureIds = self.FeatureIds.value
+        axistags = self.Input.meta.axistags
+        spatialKeys = [tag.key for tag in axistags if tag.isSpatial()]
+        numSpatial = len(spatialKeys)
+
+        sigma = self.newScales[scaleIndex]
+        outerScale = None
+        channelsPerChannel = {}
+        for task in tasks:
+            featureId = featureIds[task.featureIndex]
+            if featureId == 'StructureTensorEigenvalues':
+                outerScale = self.featureOps[task.featureIndex][scaleIndex].inputs["outerScale"].value
+            if featureId in ('HessianOfGaussianEigenvalues', 'StructureTensorEigenvalues'):
+                channelsPerChannel[featureId] = numSpatial
+            else:
+                channelsPerChannel[featureId] = 1
+
+        # All tasks request the same spatial region (relative to sourceArray)
+        spatialRoi = tasks[0].spatialRoi
+        start = numpy.array([s.start for s in spatialRoi])
+        stop = numpy.array([s.stop for s in spatialRoi])
+
+        source = sourceArray.view(vigra.VigraArray)
+        source.axistags = copy.copy(axistags)
+        destAreas = []
+        for task in tasks:
+            destArea = task.destArea.view(vigra.VigraArray)
+            destArea.axistags = copy.copy(axistags)
+            destAreas.append( list(destArea.timeIter()) )
+
+        for step, image in enumerate(source.timeIter()):
+            # The input channels that are needed by any of the tasks
+            firstChannel = min( task.channelRange[0] // channelsPerChannel[featureIds[task.featureIndex]] for task in tasks )
+            stopChannel = max( -(-task.channelRange[1] // channelsPerChannel[featureIds[task.featureIndex]]) for task in tasks )
+            for c in range(firstChannel, stopChannel):
+                channelImage = image.bindAxis('c', c).withAxes(*spatialKeys)
+                features = self._derivativeFeatures( channelImage, channelsPerChannel.keys(),
+                                                     sigma, outerScale, start, stop )
+
+                for task, taskDestAreas in zip(tasks, destAreas):
+                    featureId = featureIds[task.featureIndex]
+                    k = channelsPerChannel[featureId]
+                    begin, end = task.channelRange
+                    for featureChannel in range(k):
+                        outputChannel = c*k + featureChannel
+                        if begin <= outputChannel < end:
+                            destView = taskDestAreas[step].bindAxis('c', outputChannel - begin).withAxes(*spatialKeys)
+                            destView[...] = features[featureId][..., featureChannel]
+
+    @staticmethod
+    def _derivativeFeatures(image, featureIds, sigma, outerScale, start, stop):
+        """
+        Compute the given derivative features of a single-channel image for the
+        spatial region [start, stop).
+        Returns a dict {featureId : array}, with the feature channels in the last axis.
+        """
+        window = OpBaseVigraFilter.window_size_feature
+        keys = [tag.key for tag in image.axistags]
+        roi = (tuple(map(int, start)), tuple(map(int, stop)))
+        features = {}
+
+        if 'GaussianGradientMagnitude' in featureIds or 'StructureTensorEigenvalues' in featureIds:
+            if 'StructureTensorEigenvalues' in featureIds:
+                # The outer smoothing of the structure tensor needs the gradient around the roi, too
+                margin = int(window * outerScale + 0.5)
+                gradientStart = numpy.maximum(start - margin, 0)
+                gradientStop = numpy.minimum(stop + margin, image.shape)
+            else:
+                gradientStart, gradientStop = start, stop
+            gradientRoi = (tuple(map(int, gradientStart)), tuple(map(int, gradientStop)))
+            gradient = vigra.filters.gaussianGradient(image, sigma, window_size=window, roi=gradientRoi)
+            gradient = gradient.withAxes(*(keys + ['c']))
+            innerKey = roiToSlice(start - gradientStart, stop - gradientStart)
+
+            if 'GaussianGradientMagnitude' in featureIds:
+                innerGradient = numpy.asarray(gradient[innerKey])
+                features['GaussianGradientMagnitude'] = numpy.sqrt( (innerGradient**2).sum(axis=-1) )[..., None]
+            if 'StructureTensorEigenvalues' in featureIds:
+                tensor = vigra.filters.vectorToTensor(gradient)
+                innerRoi = (tuple(map(int, start - gradientStart)), tuple(map(int, stop - gradientStart)))
+                tensor = vigra.filters.gaussianSmoothing(tensor, outerScale, window_size=window, roi=innerRoi)
+                eigenvalues = vigra.filters.tensorEigenvalues(tensor)
+                features['StructureTensorEigenvalues'] = numpy.asarray(eigenvalues.withAxes(*(keys + ['c'])))
+
+        if 'LaplacianOfGaussian' in featureIds or 'HessianOfGaussianEigenvalues' in featureIds:
+            hessian = vigra.filters.hessianOfGaussian(image, sigma, window_size=window, roi=roi)
+            hessian = hessian.withAxes(*(keys + ['c']))
+            if 'LaplacianOfGaussian' in featureIds:
+                # The hessian is stored as the upper triangle of the matrix, row by row
+                n = len(keys)
+                diagonal = [ i*n - i*(i-1)//2 for i in range(n) ]
+                features['LaplacianOfGaussian'] = numpy.asarray(hessian)[..., diagonal].sum(axis=-1)[..., None]
+            if 'HessianOfGaussianEigenvalues' in featureIds:
+                eigenvalues = vigra.filters.tensorEigenvalues(hessian)
+                features['HessianOfGaussianEigenvalues'] = numpy.asarray(eigenvalues.withAxes(*(keys + ['c'])))
+
+        return features
+
+
 ###################################################3
 class OpPixelFeaturesInterpPresmoothed(Operator):
     name="OpPixelFeaturesPresmoothed"
@@ -94,10 +94,16 @@ class Request( object ):
     global_thread_pool = None
     
     @classmethod
-    def reset_thread_pool( cls, num_workers = multiprocessing.cpu_count() ):
+    def reset_thread_pool( cls, num_workers = multiprocessing.cpu_count(), scheduler = 'shared' ):
         """
         Change the number of threads allocated to the request system.
 
+        The ``scheduler`` parameter selects how unassigned requests are distributed to the workers.
+        The default (``'shared'``) uses a single priority queue for all workers.
+        With ``'stealing'``, each worker keeps the requests it spawns in its own deque and 
+        idle workers steal from their peers, which reduces lock contention on machines with many cores.
+        See :py:class:`threadPool.ThreadPool` for details.
+
         As a special case, you may set ``num_workers`` to 0.  
         In that case, the normal thread pool is not used at all.  
         Instead, all requests will execute synchronously, from within the submitting thread.  
@@ -109,7 +115,7 @@ class Request( object ):
         """
         if cls.global_thread_pool is not None:
             cls.global_thread_pool.stop()
-        cls.global_thread_pool = threadPool.ThreadPool( num_workers )
+        cls.global_thread_pool = threadPool.ThreadPool( num_workers, scheduler=scheduler )
     
     class CancellationException(Exception):
         """
@@ -181,6 +187,10 @@ class Request( object ):
         self.exception_info = (None, None, None)
         self._cleaned = False
 
+        #: Estimated RAM (in bytes) this request will consume while executing (0 means 'unknown').
+        #: Root requests with an estimate are subject to the thread pool's admission control.
+        self.ram_estimate = 0
+
         # Execution
         self.greenlet = None # Not created until assignment to a worker
         self._assigned_worker = None
@@ -194,7 +204,8 @@ class Request( object ):
         current_request = Request._current_request()
         self.parent_request = current_request
         if current_request is None:
-            self._priority = [ Request._root_request_counter.next() ]
+            # Root requests are ordered by their (negated) priority, then by age.  See set_priority().
+            self._priority = [ 0, Request._root_request_counter.next() ]
         else:
             with current_request._lock:
                 current_request.child_requests.add(self)
@@ -210,6 +221,22 @@ class Request( object ):
         
         self._sig_execution_complete = SimpleSignal()
 
+    def set_priority(self, priority):
+        """
+        Set the scheduling priority of this request relative to other root requests (default: 0).
+        When requests are waiting for a worker thread, requests with a higher priority 
+        (and all of their child requests) are executed first.
+        For example, give background work like data export a negative priority, so that it 
+        doesn't slow down interactive requests that share the same thread pool.
+
+        Only root requests (i.e. requests created outside of any other request) may be prioritized.  
+        Child requests inherit the priority of their parent.  Must be called before ``submit()``.
+        (With the ``'stealing'`` scheduler, priorities only affect requests submitted from foreign threads.)
+        """
+        assert self.parent_request is None, "Only root requests can be prioritized."
+        assert not self.started, "Can't change the priority of a request that was already submitted."
+        self._priority[0] = -priority
+
     def __lt__(self, other):
         """
         Request comparison is by priority.
@@ -337,6 +364,10 @@ class Request( object ):
             # Notify non-request-based threads
             self.finished_event.set()
 
+            # Let the admission controller start any requests that were waiting for our RAM.
+            if self._needs_admission():
+                Request.global_thread_pool.admission_controller.release(self)
+
             # Clean-up
             if self.greenlet is not None:
                 popped = self.greenlet.owning_requests.pop()
@@ -351,7 +382,9 @@ class Request( object ):
             with self._lock:
                 if not self.started:
                     self.started = True
-                    self._wake_up()
+                    if self._admit():
+                        self._wake_up()
+                    # Otherwise, the admission controller will wake us up when enough RAM is available.
         else:
             # For debug purposes, we support a worker count of zero.
             # In that case, ALL REQUESTS ARE synchronous.
@@ -367,6 +400,24 @@ class Request( object ):
             if self.exception is not None:
                 raise self.exception_info[0], self.exception_info[1], self.exception_info[2]
 
+    def _needs_admission(self):
+        """
+        Return True if this request is subject to the thread pool's admission control.
+        Only root requests with a RAM estimate are.  Child requests must always be allowed 
+        to run, since their parents are already executing and waiting for them.
+        """
+        return self.ram_estimate and self.parent_request is None \
+               and Request.global_thread_pool.num_workers > 0
+
+    def _admit(self):
+        """
+        Ask the thread pool's admission controller whether this request may start now.
+        If not, the controller will wake it up later.
+        """
+        if not self._needs_admission():
+            return True
+        return Request.global_thread_pool.admission_controller.admit(self)
+
     def _wake_up(self):
         """
         Resume this request's execution (put it back on the worker's job queue).
@@ -475,7 +526,9 @@ class Request( object ):
         self.uncancellable = True
 
         with self._lock:
-            direct_execute_needed = not self.started and (timeout is None)
+            # Requests that are subject to admission control must go through the thread pool.
+            # (Otherwise, any requests they spawn would look like root requests, too.)
+            direct_execute_needed = not self.started and (timeout is None) and not self._needs_admission()
             if direct_execute_needed:
                 # This request hasn't been started yet
                 # We can execute it directly in the current thread instead of submitting it to the request thread pool (big optimization).
@@ -25,9 +25,12 @@ import collections
 import heapq
 import threading
 import platform
+import random
 import psutil
 import time
 import os
+import logging
+logger = logging.getLogger(__name__)
 
 
 # This module's code needs to be sanitized if you're not using CPython.
@@ -86,86 +89,159 @@ class LifoQueue(object):
         return len(self._deque)
 
 
-class MemoryWatcher(threading.Thread):
+class MemoryAdmissionController(object):
     """
-    Background thread for checking memory usage
+    Holds back new root-level tasks if starting them would push this process over its RAM budget.
+
+    Each task may carry a ``ram_estimate`` attribute (in bytes), which is an estimate of the 
+    RAM it will consume while executing.  The projected RAM usage of the process is the RSS it had
+    before the admitted (unfinished) tasks started plus their estimates, or its current RSS, whichever 
+    is larger.  (The admitted tasks' real allocations already show up in the current RSS, so adding 
+    their estimates to it would count them twice.)  Tasks that don't fit 
+    in the budget are deferred (in FIFO order) and handed back to the thread pool as soon as 
+    enough earlier tasks have finished.
+
+    To guarantee progress, a task is always admitted if no other estimated tasks are in flight.
+    
+    The budget is ``lazyflow.AVAILABLE_RAM_MB``, or the total system RAM if that setting is 0.
     """
     
     def __init__(self, thread_pool):
-        threading.Thread.__init__(self)
-        self.process = psutil.Process(os.getpid())
-        self.usage = self.process.memory_percent()
-        self.tasks = FifoQueue()
         self.thread_pool = thread_pool
-        self.threshold = 85 # threshold at which to 
-        self.threshold_reached = False
-        self.stopped = False
-        self.daemon = True
-        
-    def run(self):
+        self.process = psutil.Process(os.getpid())
+        self._lock = threading.Lock()
+        self._in_flight = {} # task -> admitted estimate (bytes)
+        self._reserved_bytes = 0
+        self._baseline_rss = 0 # RSS when the first of the in-flight tasks was admitted
+        self._deferred_tasks = collections.deque()
+
+    def budget_bytes(self):
         """
-        Computes memory usage every 0.1 second.
-        Flushes queued tasks, if memory usage is below a threshold.
+        Return the number of bytes this process is allowed to use.
         """
-        while self.stopped is False:
-            self.usage = self.process.memory_percent()
-            if self.usage < self.threshold:
-                self.flush()
-            time.sleep(0.1)
-            
-    def filter(self, task):
+        import lazyflow # Late import: lazyflow imports this module.
+        if lazyflow.AVAILABLE_RAM_MB != 0:
+            return lazyflow.AVAILABLE_RAM_MB * 1024**2
+        return psutil.virtual_memory().total
+
+    def admit(self, task):
         """
-        See if a task needs to be queued due to high memory usages.
+        Return True if the task may be scheduled now.
+        Otherwise, the task is deferred and False is returned.
+        The deferred task will be handed to ``thread_pool.wake_up()`` later on.
         """
-        if self.usage > self.threshold and len(task._priority) == 1:
-            if self.threshold_reached is False:
-                print "MemoryWatcher: memory usage above %f%% filtering task." % (self.threshold,)
-                self.threshold_reached = True
-            self.tasks.push(task)
-            raise IndexError
-        return task
-            
-    def flush(self):
-        """
-        Flush all queued tasks back to the threadpool.
-        """
-        if len(self.tasks) > 0:
-            if self.threshold_reached is True:
-                print "MemoryWatcher: memory usage below %f%%. Flushing queued tasks ..." % (self.threshold,)
-                self.threshold_reached = False
-                
-        while len(self.tasks) > 0:
-            task = self.tasks.pop()
-            self.thread_pool.wake_up(task)
-            
-    def stop(self):
+        estimate = getattr(task, 'ram_estimate', 0)
+        if not estimate:
+            return True
+
+        with self._lock:
+            if not self._deferred_tasks and self._fits(estimate):
+                self._reserve(task, estimate)
+                return True
+            self._deferred_tasks.append(task)
+
+        logger.debug( "Deferring task with an estimated RAM usage of {:.1f} MB ({} tasks deferred)"
+                      .format( estimate / 1024.0**2, len(self._deferred_tasks) ) )
+        return False
+
+    def release(self, task):
         """
-        stop the MemoryWatcher
+        Notify the controller that the given task has finished executing.
+        Deferred tasks that fit in the freed memory are handed back to the thread pool.
         """
-        self.stopped = True
-   
+        with self._lock:
+            estimate = self._in_flight.pop(task, None)
+            if estimate is None:
+                return
+            self._reserved_bytes -= estimate
+            admitted = self._pop_admissible_tasks()
+
+        for t in admitted:
+            self.thread_pool.wake_up(t)
+
+    def _fits(self, estimate):
+        """
+        Return True if a task with the given estimate fits in the budget.
+        Must be called with self._lock held.
+        """
+        if not self._in_flight:
+            return True
+        rss = self.process.memory_info().rss
+        projected_rss = max( rss, self._baseline_rss + self._reserved_bytes )
+        return projected_rss + estimate <= self.budget_bytes()
+
+    def _reserve(self, task, estimate):
+        """
+        Record the given task as admitted.
+        Must be called with self._lock held.
+        """
+        if not self._in_flight:
+            self._baseline_rss = self.process.memory_info().rss
+        self._in_flight[task] = estimate
+        self._reserved_bytes += estimate
+
+    def _pop_admissible_tasks(self):
+        """
+        Admit as many deferred tasks (in order) as will fit in the budget, and return them.
+        Must be called with self._lock held.
+        """
+        admitted = []
+        while self._deferred_tasks:
+            # Peek at the oldest deferred task.
+            task = self._deferred_tasks[0]
+            estimate = task.ram_estimate
+            if not self._fits(estimate):
+                break
+            self._deferred_tasks.popleft()
+            self._reserve(task, estimate)
+            admitted.append(task)
+        return admitted
+
 class ThreadPool(object):
     """
     Manages a set of worker threads and dispatches tasks to them.
+
+    Two scheduling strategies are supported:
+
+    - ``'shared'`` (the default): All unassigned tasks are pushed onto a single shared queue,
+      and every idle worker is notified whenever a new task arrives.
+    - ``'stealing'``: Each worker owns a local deque of unassigned tasks.  Tasks that are spawned
+      from within a worker are pushed onto that worker's deque and popped again in LIFO order.
+      Tasks submitted from foreign (non-worker) threads go to the shared queue.
+      An idle worker first checks its own deque, then the shared queue, and finally steals the
+      oldest task (FIFO) from one of its peers.  Only a single idle worker (if any) is woken per new task,
+      so workers do not contend for one condition variable.
+    
+    In both modes, once a task has been assigned to a worker it is always resumed on that worker.
     """
 
     #_DefaultQueueType = FifoQueue
     #_DefaultQueueType = LifoQueue
     _DefaultQueueType = PriorityQueue
+
+    Schedulers = ('shared', 'stealing')
     
-    def __init__(self, num_workers, queue_type=_DefaultQueueType):
+    def __init__(self, num_workers, queue_type=_DefaultQueueType, scheduler='shared'):
         """
         Constructor.  Starts all workers.
         
         :param num_workers: The number of worker threads to create.
         :param queue_type: The type of queue to use for prioritizing tasks.  Possible queue types include :py:class:`PriorityQueue`,
                            :py:class:`FifoQueue`, and :py:class:`LifoQueue`, or any class with ``push()``, ``pop()``, and ``__len__()`` methods.
+        :param scheduler: Either ``'shared'`` or ``'stealing'``.  See class documentation for details.
         """
+        assert scheduler in ThreadPool.Schedulers, \
+            "Unknown scheduler: {}.  Choose from {}".format( scheduler, ThreadPool.Schedulers )
+        self.scheduler = scheduler
         self.job_condition = threading.Condition()
         self.unassigned_tasks = queue_type()
-        #self.memory = MemoryWatcher(self)
-        #self.memory.start()
+        self.admission_controller = MemoryAdmissionController(self)
         self.num_workers = num_workers
+
+        # For the 'stealing' scheduler: The set of workers that are currently waiting for work.
+        self._idle_workers = set()
+        self._idle_workers_lock = threading.Lock()
+
         self.workers = self._start_workers( num_workers, queue_type )
 
         # ThreadPools automatically stop upon program exit
@@ -179,6 +255,19 @@ class ThreadPool(object):
         # Once a task has been assigned, it must always be processed in the same worker
         if hasattr(task, 'assigned_worker') and task.assigned_worker is not None:
             task.assigned_worker.wake_up( task )
+        elif self.scheduler == 'stealing':
+            current_thread = threading.current_thread()
+            if isinstance(current_thread, _Worker) and current_thread.thread_pool is self:
+                # Spawned from within one of our workers: keep it local.
+                local_tasks = current_thread.local_tasks
+                local_tasks.append(task)
+                # The current worker may keep running for a while before it waits for the new task,
+                # so let an idle peer (if any) steal it in the meantime.
+                self._notify_one_idle_worker()
+            else:
+                self.unassigned_tasks.push(task)
+                # Only one idle worker needs to know about the new task.
+                self._notify_one_idle_worker()
         else:
             self.unassigned_tasks.push(task)
             # Notify all currently waiting workers that there's new work
@@ -189,8 +278,6 @@ class ThreadPool(object):
         Stop all threads in the pool, and block for them to complete.
         Postcondition: All worker threads have stopped.  Unfinished tasks are simply dropped.
         """
-        #self.memory.stop()
-        
         for w in self.workers:
             w.stop()
         
@@ -205,6 +292,12 @@ class ThreadPool(object):
         for i in range(num_workers):
             w = _Worker(self, i, queue_type=queue_type)
             workers.add( w )
+
+        # In stealing mode, each worker needs the full list of peers before it starts.
+        if self.scheduler == 'stealing':
+            for w in workers:
+                w.peers = [peer for peer in workers if peer is not w]
+        for w in workers:
             w.start()
         return workers
 
@@ -216,6 +309,19 @@ class ThreadPool(object):
             with worker.job_queue_condition:
                 worker.job_queue_condition.notify()
 
+    def _notify_one_idle_worker(self):
+        """
+        Wake up a single worker that is currently waiting for work, if there is one.
+        """
+        with self._idle_workers_lock:
+            try:
+                worker = self._idle_workers.pop()
+            except KeyError:
+                # Nobody is idle.  Somebody will find the task when they finish their current one.
+                return
+        with worker.job_queue_condition:
+            worker.job_queue_condition.notify()
+
     def _wait_for_idle(self):
         """
         Useful for testing only.
@@ -227,13 +333,13 @@ class ThreadPool(object):
                 time.sleep(0.1)
             
             for worker in self.workers:
-                while worker.job_queue:
+                while worker.job_queue or worker.local_tasks:
                     time.sleep(0.1)
             
             # Second pass: did any of those completing tasks launch new tasks?
             done = True
             for worker in self.workers:
-                if len(worker.job_queue) > 0:
+                if len(worker.job_queue) > 0 or len(worker.local_tasks) > 0:
                     done = False
             if self.unassigned_tasks:
                 done = False
@@ -253,6 +359,12 @@ class _Worker(threading.Thread):
         self.stopped = False
         self.job_queue_condition = threading.Condition()
         self.job_queue = queue_type()
+
+        # Used by the 'stealing' scheduler only.
+        # Unassigned tasks spawned from this worker.
+        # We pop from the right (LIFO), peers steal from the left (FIFO).
+        self.local_tasks = collections.deque() # append/pop/popleft are atomic in CPython
+        self.peers = []
         
     def run(self):
         """
@@ -299,15 +411,32 @@ class _Worker(threading.Thread):
             - a task is available (return it) OR
             - the worker has been stopped (might return None)
         """
+        stealing = (self.thread_pool.scheduler == 'stealing')
+
         # Keep trying until we get a job        
         with self.job_queue_condition:
             next_task = self._pop_job()
 
             while next_task is None and not self.stopped:
+                if stealing:
+                    # Announce that we're idle BEFORE checking for work one last time.
+                    # Otherwise, a task pushed between our check and our wait() would go unnoticed.
+                    with self.thread_pool._idle_workers_lock:
+                        self.thread_pool._idle_workers.add(self)
+                    next_task = self._pop_job()
+                    if next_task is not None:
+                        with self.thread_pool._idle_workers_lock:
+                            self.thread_pool._idle_workers.discard(self)
+                        break
+
                 # Wait for work to become available
                 self.job_queue_condition.wait()
                 next_task = self._pop_job()
 
+            if stealing:
+                with self.thread_pool._idle_workers_lock:
+                    self.thread_pool._idle_workers.discard(self)
+
         if not self.stopped:
             assert next_task is not None
             assert next_task.assigned_worker is self
@@ -318,21 +447,52 @@ class _Worker(threading.Thread):
         """
         Non-blocking.
         If possible, get a job from our own job queue.
-        Otherwise, get one from the global job queue.
-        Return None if neither queue has work to do.
+        Otherwise, get one from our local deque of unassigned tasks (stealing mode only),
+        then from the global job queue, and finally try to steal one from a peer.
+        Return None if none of them has work to do.
         """
         # Try our own queue first
         if len(self.job_queue) > 0:
             return self.job_queue.pop()
 
+        task = None
+        if self.local_tasks:
+            try:
+                task = self.local_tasks.pop()
+            except IndexError:
+                # Stolen by a peer in the meantime
+                pass
+
         # Otherwise, try to claim a job from the global unassigned list            
-        try:
-            #task = self.thread_pool.memory.filter(self.thread_pool.unassigned_tasks.pop())
-            task = self.thread_pool.unassigned_tasks.pop()
-        except IndexError:
+        if task is None:
+            try:
+                task = self.thread_pool.unassigned_tasks.pop()
+            except IndexError:
+                task = self._steal_job()
+
+        if task is None:
             return None
-        else:
-            task.assigned_worker = self # If this fails, then your callable is some built-in that doesn't allow arbitrary  
-                                        #  members (e.g. .assigned_worker) to be "monkey-patched" onto it.  You may have to wrap it in a custom class first.
-            return task
-    
+
+        task.assigned_worker = self # If this fails, then your callable is some built-in that doesn't allow arbitrary  
+                                    #  members (e.g. .assigned_worker) to be "monkey-patched" onto it.  You may have to wrap it in a custom class first.
+        return task
+
+    def _steal_job(self):
+        """
+        Non-blocking.
+        Take the oldest unassigned task from one of our peers, or return None if they have nothing to spare.
+        Peers are visited starting at a random offset so that thieves don't all pile onto the same victim.
+        """
+        peers = self.peers
+        if not peers:
+            return None
+        start = random.randrange( len(peers) )
+        for i in range( len(peers) ):
+            victim = peers[(start + i) % len(peers)]
+            if victim.local_tasks:
+                try:
+                    return victim.local_tasks.popleft()
+                except IndexError:
+                    # Somebody else got there first
+                    pass
+        return None
@@ -34,8 +34,8 @@ import vigra
 
 #lazyflow
 from lazyflow import rtype
-from lazyflow.roi import TinyVector
-from lazyflow.request import Request
+from lazyflow.roi import TinyVector, roiToSlice
+from lazyflow.request import Request, RequestLock
 from lazyflow.stype import ArrayLike
 from lazyflow.metaDict import MetaDict
 from lazyflow.utility import slicingtools, OrderedSignal
@@ -75,6 +75,126 @@ class ValueRequest(object):
         destination[:] = self.result
         return self
 
+class InFlightRegistry(object):
+    """
+    Keeps track of the rois that are currently being computed for a slot, 
+    so that a request for the same data can wait for the running computation 
+    instead of repeating it.
+
+    In 'identical' mode, only requests for exactly the same roi are merged.
+    In 'contained' mode, a request is also merged with any running request 
+    whose roi contains it, and its result is sliced from the larger result.
+
+    Each entry is tagged with the 'dirty generation' of the slot in which its 
+    computation started.  If the slot becomes dirty while the computation is 
+    running, the requests that joined it must not use its (possibly stale) result.
+    """
+    IDENTICAL = 'identical'
+    CONTAINED = 'contained'
+
+    class Entry(object):
+        def __init__(self, start, stop, generation):
+            self.start = start
+            self.stop = stop
+            self.generation = generation
+            self.followers = 0
+            self.result = None  # Only set if the computation succeeded and someone is waiting for it.
+            
+            # Held by the computing request until it is finished.
+            self._doneLock = RequestLock()
+            self._doneLock.acquire()
+
+        def contains(self, start, stop):
+            return all( a <= b for a,b in zip(self.start, start) ) \
+               and all( a >= b for a,b in zip(self.stop, stop) )
+
+        def wait(self):
+            """
+            Wait for the computation to finish.
+            Return its result, or None if it failed or was cancelled.
+            """
+            try:
+                self._doneLock.acquire()
+            except Request.CancellationException:
+                # We were woken up (and given the lock), but we were cancelled in the meantime.
+                # Pass the lock on to the other waiters before we give up.
+                self._doneLock.release()
+                raise
+            self._doneLock.release()
+            return self.result
+
+    def __init__(self, mode):
+        assert mode in (InFlightRegistry.IDENTICAL, InFlightRegistry.CONTAINED), \
+            "Unknown request deduplication mode: {}".format( mode )
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._entries = {} # (start, stop) : Entry
+        self._generation = 0 # Incremented whenever the slot becomes dirty
+
+    def join(self, roi):
+        """
+        Find a running computation that can provide the given roi.
+        Returns (entry, is_owner).  If is_owner is True, no such computation existed, 
+        and the caller must compute the roi itself and call finish() afterwards.
+        """
+        start = tuple(roi.start)
+        stop = tuple(roi.stop)
+        with self._lock:
+            entry = self._entries.get( (start, stop) )
+            if entry is None and self.mode == InFlightRegistry.CONTAINED:
+                for e in self._entries.itervalues():
+                    if e.contains(start, stop):
+                        entry = e
+                        break
+            if entry is not None:
+                entry.followers += 1
+                return entry, False
+            entry = InFlightRegistry.Entry(start, stop, self._generation)
+            self._entries[(start, stop)] = entry
+            return entry, True
+
+    def finish(self, entry, result):
+        """
+        Called by the owner of the entry when its computation is finished.
+        ``result`` is None if the computation failed.
+        """
+        with self._lock:
+            if self._entries.get( (entry.start, entry.stop) ) is entry:
+                del self._entries[(entry.start, entry.stop)]
+            followers = entry.followers
+        if followers > 0 and isinstance(result, numpy.ndarray):
+            # The owner's caller is free to modify its result as soon as we return, 
+            # so give the followers their own copy.
+            entry.result = result.copy()
+        entry._doneLock.release()
+
+    def forgetAll(self):
+        """
+        Stop handing out the running computations to new requests (e.g. because the slot became dirty), 
+        and mark their results as stale for the requests that already joined them.
+        The running computations are not affected.
+        """
+        with self._lock:
+            self._entries = {}
+            self._generation += 1
+
+    def isStale(self, entry):
+        """
+        Return True if the slot became dirty after the entry's computation started.
+        """
+        return entry.generation != self._generation
+
+def makeReadOnly(array):
+    """
+    Return a read-only view of the given array (or the array itself, 
+    if it is already read-only or isn't a numpy array).
+    Other views of the same data are not affected.
+    """
+    if isinstance(array, numpy.ndarray) and array.flags.writeable:
+        array = array.view()
+        array.flags.writeable = False
+    return array
+
 def is_setup_fn(func):
     """
     Decorator.  Marks the function as a 'setup' function, 
@@ -119,7 +239,7 @@ class Slot(object):
     
     def __init__(self, name="", operator=None, stype=ArrayLike,
                  rtype=rtype.SubRegion, value=None, optional=False,
-                 level=0, nonlane=False):
+                 level=0, nonlane=False, deduplicate=None):
         """Constructor of the Slot class.
 
         :param name: user readable name of the slot, is normally
@@ -144,6 +264,10 @@ class Slot(object):
         :param nonlane: For multislot, this flag protects it from
           being considered lane-indexed
 
+        :param deduplicate: If 'identical' or 'contained', requests for rois
+          that are already being computed by another request wait for that
+          computation instead of repeating it (see InFlightRegistry).
+
         """
         # This assertion is here for a reason: default values do NOT work on OutputSlots.
         # (We should probably change that at some point...)
@@ -192,6 +316,11 @@ class Slot(object):
         self.stype = stype(self)
         self.nonlane = nonlane
 
+        # Registry of running requests, if request deduplication is enabled.
+        self._deduplicate = None
+        self._inflight_registry = None
+        self.setRequestDeduplication(deduplicate)
+
         self._sig_changed = OrderedSignal()
         self._sig_value_changed = OrderedSignal()
         self._sig_ready = OrderedSignal()
@@ -699,15 +828,27 @@ class Slot(object):
         # call after-remove callbacks
         self._sig_removed(self, position, finalsize)
 
-    def get(self, roi):
+    def setRequestDeduplication(self, mode):
+        """
+        Enable (or disable, if mode is None) deduplication of concurrent 
+        requests for the same roi.  See InFlightRegistry for the supported modes.
+        """
+        self._deduplicate = mode
+        if mode is None:
+            self._inflight_registry = None
+        else:
+            self._inflight_registry = InFlightRegistry(mode)
+
+    def get(self, roi, readonly=False):
         """This method is used to retrieve the actual content of a Slot.
 
         :param roi: the region of interest, e.g. a subregion in the
         case of an ArrayLike stype
 
-        :param destination: this may define a destination area for the
-          request, for example a ndarray into which the results should
-          be written in the case of an ArrayLike stype
+        :param readonly: if True, the caller promises not to modify the
+          result, and the result may be a read-only view of data that is
+          owned by some operator (e.g. a cache), instead of a copy.
+          Has no effect if a destination is given with writeInto().
 
         Returns:
           a request.Request object.
@@ -718,11 +859,13 @@ class Slot(object):
             # having a ._value
             # --> construct cheaper request object for this case
             result = self.stype.writeIntoDestination(None, self._value, roi)
+            if readonly:
+                result = makeReadOnly(result)
             return ValueRequest(result)
         elif self.partner is not None:
             # this handles the case of an inputslot
             # --> just relay the request
-            return self.partner.get(roi)
+            return self.partner.get(roi, readonly)
         else:
             if not self.ready():
                 # Something is wrong.  Are we cancelled?
@@ -747,14 +890,33 @@ class Slot(object):
                 assert self._type != "input", "This inputSlot has no value and no partner.  You can't ask for its data yet!"
             # normal (outputslot) case
             # --> construct heavy request object..
-            execWrapper = Slot.RequestExecutionWrapper(self, roi)
+            execWrapper = Slot.RequestExecutionWrapper(self, roi, readonly)
             request = Request(execWrapper)
+            request.ram_estimate = self._estimateRamUsage(roi)
 
             # We must decrement the execution count even if the
             # request is cancelled
             request.notify_cancelled(execWrapper.handleCancel)
             return request
 
+    def _estimateRamUsage(self, roi):
+        """
+        Estimate the RAM (in bytes) needed to compute the given roi of this slot,
+        according to ``meta.ram_usage_per_requested_pixel``.
+        Returns 0 if no estimate is possible.
+        """
+        ram_per_pixel = self.meta.ram_usage_per_requested_pixel
+        if ram_per_pixel is None or not hasattr(roi, 'start'):
+            return 0
+        shape = list( numpy.subtract(roi.stop, roi.start) )
+
+        # By convention, ram_usage_per_requested_pixel refers to the ram used 
+        # when requesting ALL channels of a 'pixel', so don't count the channels.
+        axistags = self.meta.axistags
+        if axistags is not None and axistags.channelIndex < len(shape):
+            shape.pop( axistags.channelIndex )
+        return int( ram_per_pixel * numpy.prod(shape) )
+
     @staticmethod
     def _findUpstreamProblemSlot(slot):
         if slot.partner is not None:
@@ -766,22 +928,54 @@ class Slot(object):
         return "Couldn't find an upstream problem slot."
 
     class RequestExecutionWrapper(object):
-        def __init__(self, slot, roi):
+        def __init__(self, slot, roi, readonly=False):
             self.started = False
             self.finished = False
             self.slot = slot
             self.operator = slot.operator
             self.lock = threading.Lock()
             self.roi = roi
+            self.readonly = readonly
 
         def __call__(self, destination=None):
+            registry = self.slot._inflight_registry
+            if registry is None or not hasattr(self.roi, 'start'):
+                return self._execute(destination)
+
+            entry, is_owner = registry.join(self.roi)
+            if is_owner:
+                result = None
+                try:
+                    result = self._execute(destination)
+                    return result
+                finally:
+                    registry.finish(entry, result)
+
+            # Another request is already computing our data.
+            shared_result = entry.wait()
+            if shared_result is None or registry.isStale(entry) \
+            or not (destination is None or isinstance(destination, numpy.ndarray)):
+                # It failed, the slot became dirty in the meantime (or its result isn't an array).
+                # Compute it ourselves.
+                return self._execute(destination)
+
+            offset = numpy.subtract(self.roi.start, entry.start)
+            shape = numpy.subtract(self.roi.stop, self.roi.start)
+            shared_result = shared_result[roiToSlice(offset, offset+shape)]
+            if destination is None and self.readonly:
+                # Nobody modifies the shared result, so we don't need our own copy.
+                return makeReadOnly(shared_result)
+            if destination is None:
+                destination = self.slot.stype.allocateDestination(self.roi)
+            self.slot.stype.copy_data( dst=destination, src=shared_result )
+            return destination
+
+        def _execute(self, destination=None):
             # store whether the user wants the results in a given
             # destination area
             destination_given = destination is not None
 
-            if destination is None:
-                destination = self.slot.stype.allocateDestination(self.roi)
-            else:
+            if destination is not None:
                 if self.slot.meta.dtype is not None and hasattr(destination, 'dtype'):
                     assert self.slot.meta.dtype == destination.dtype, \
                         "Can't provide a destination array of the wrong dtype.  "\
@@ -793,6 +987,16 @@ class Slot(object):
             self._incrementOperatorExecutionCount()
 
             try:
+                if not destination_given and self.readonly:
+                    # Give the operator a chance to provide its data without any copy.
+                    result_op = self._executeReadOnly()
+                    if result_op is not None:
+                        self._decrementOperatorExecutionCount()
+                        return result_op
+
+                if destination is None:
+                    destination = self.slot.stype.allocateDestination(self.roi)
+
                 # Execute the workload, which might not ever return
                 # (if we get cancelled).
                 result_op = self.operator.execute(self.slot, (), self.roi, destination)
@@ -831,6 +1035,20 @@ class Slot(object):
                 self._decrementOperatorExecutionCount()
                 raise
 
+        def _executeReadOnly(self):
+            """
+            Ask the operator for a read-only view of the requested data.
+            Returns None if the operator can't provide one.
+            """
+            executeReadOnly = getattr(self.operator, 'executeReadOnly', None)
+            if executeReadOnly is None:
+                return None
+            result = executeReadOnly(self.slot, (), self.roi)
+            if result is None:
+                return None
+            self.slot.stype.check_result_valid(self.roi, result)
+            return makeReadOnly(result)
+
         def _incrementOperatorExecutionCount(self):
             self.started = True
             assert self.operator._executionCount >= 0, \
@@ -884,6 +1102,10 @@ class Slot(object):
             else:
                 roi = args[0]
 
+            if self._inflight_registry is not None:
+                # Requests that are already running may produce stale data.
+                self._inflight_registry.forgetAll()
+
             for c in self.partners:
                 c.setDirty(roi)
 
@@ -1271,6 +1493,7 @@ class Slot(object):
         init_kwargs['value'] = self._defaultValue
         init_kwargs['level'] = self.level
         init_kwargs['nonlane'] = self.nonlane
+        init_kwargs['deduplicate'] = self._deduplicate
         if self._type == "input":
             init_kwargs['optional'] = self._optional
         
@@ -1450,3 +1673,8 @@ class OutputSlot(Slot):
         """
         totalIndex = (self._subSlots.index(slot),) + subindex
         return self.operator.execute(self, totalIndex, roi, result)
+
+    def executeReadOnly(self, slot, subindex, roi):
+        """See execute(), above."""
+        totalIndex = (self._subSlots.index(slot),) + subindex
+        return self.operator.executeReadOnly(self, totalIndex, roi)
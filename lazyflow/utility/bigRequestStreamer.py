@@ -19,6 +19,10 @@
 # This information is also available on the ilastik web site at:
 #		   http://ilastik.org/license/
 ###############################################################################
+import os
+import time
+import threading
+
 import numpy
 from lazyflow.request import Request
 from lazyflow.utility import RoiRequestBatch
@@ -79,7 +83,7 @@ class BigRequestStreamer(object):
     >>> print "Processed {} result blocks with a total sum of: {}".format( result_count[0], result_total_sum[0] )
     Processed 6 result blocks with a total sum of: 68400
     """
-    def __init__(self, outputSlot, roi, blockshape=None, batchSize=None, blockAlignment='absolute', allowParallelResults=False):
+    def __init__(self, outputSlot, roi, blockshape=None, batchSize=None, blockAlignment='absolute', allowParallelResults=False, adaptive=False, priority=0):
         """
         Constructor.
         
@@ -90,20 +94,35 @@ class BigRequestStreamer(object):
         :param blockAlignment: Determines how block the requests. Choices are 'absolute' or 'relative'.
         :param allowParallelResults: If False, The resultSignal will not be called in parallel.
                                      In that case, your handler function has no need for locks.
+        :param adaptive: If True, the blockshape is only the starting point: Requests are enlarged (by merging 
+                         neighboring blocks) and the number of parallel requests is adjusted while the data is 
+                         processed, according to the measured throughput and RAM usage.  
+                         (See :py:class:`AdaptiveBlockTuner`.)  In that case, ``batchSize`` is the maximum 
+                         number of parallel requests.
+        :param priority: The scheduling priority of the requests (see :py:meth:`Request.set_priority()`).
+                         Background exports should use a negative priority, so they don't slow down 
+                         interactive requests.  Not honoured inside another request, and only partly 
+                         with the ``'stealing'`` scheduler (see :py:class:`RoiRequestBatch`).
         """
         self._outputSlot = outputSlot
         self._bigRoi = roi
 
         totalVolume = numpy.prod( numpy.subtract(roi[1], roi[0]) )
         
-        if batchSize is None:
-            batchSize=1000
-        
         if blockshape is None:
-            blockshape = self._determine_blockshape(outputSlot)
+            blockshape = self.determine_blockshape(outputSlot)
 
         assert blockAlignment in ['relative', 'absolute']
-        if blockAlignment == 'relative':
+        self._tuner = None
+        if adaptive:
+            num_threads = max(1, Request.global_thread_pool.num_workers)
+            self._tuner = AdaptiveBlockTuner( numpy.prod(blockshape), 
+                                              maxConcurrency=(batchSize or 2*num_threads),
+                                              initialConcurrency=min(batchSize or num_threads, num_threads) )
+            batchSize = self._tuner.concurrency
+            roi_iter = self._adaptiveRoiGen( roi, blockshape, blockAlignment, self._tuner )
+
+        elif blockAlignment == 'relative':
             # Align the blocking with the start of the roi
             offsetRoi = ([0] * len(roi[0]), numpy.subtract(roi[1], roi[0]))
             block_starts = getIntersectingBlocks(blockshape, offsetRoi)
@@ -126,6 +145,7 @@ class BigRequestStreamer(object):
                                      offset_block_bounds[1] + self._bigRoi[0] )
                     logger.debug( "Requesting Roi: {}".format( block_bounds ) )
                     yield block_bounds
+            roi_iter = roiGen()
             
         else:
             # Absolute blocking.
@@ -141,12 +161,59 @@ class BigRequestStreamer(object):
     
                     logger.debug( "Requesting Roi: {}".format( block_bounds ) )
                     yield block_intersecting_portion
+            roi_iter = roiGen()
+
+        if batchSize is None:
+            batchSize=1000
                 
-        self._requestBatch = RoiRequestBatch( self._outputSlot, roiGen(), totalVolume, batchSize, allowParallelResults )
+        self._requestBatch = RoiRequestBatch( self._outputSlot, roi_iter, totalVolume, batchSize, allowParallelResults, priority )
+        if self._tuner is not None:
+            self._tuner.setRequestBatch( self._requestBatch )
+            # Subscribe first, so the tuner sees each result before the user's handlers do.
+            self._requestBatch.resultSignal.subscribe( self._tuner.recordResult )
+
+    @staticmethod
+    def _adaptiveRoiGen( roi, blockshape, blockAlignment, tuner ):
+        """
+        Generate the rois to request in adaptive mode.
+        The blocks of the usual blocking are requested in order, but neighboring blocks along the 
+        innermost axis (of the block grid) are merged into one request, as many as the tuner says.
+        """
+        roi_start, roi_stop = numpy.array(roi[0]), numpy.array(roi[1])
+        blockshape = numpy.array(blockshape)
+        if blockAlignment == 'relative':
+            origin = roi_start
+        else:
+            origin = numpy.zeros_like(roi_start)
+        grid_start = (roi_start - origin) // blockshape
+        grid_stop = (roi_stop - origin + blockshape - 1) // blockshape
+        grid_shape = grid_stop - grid_start
+
+        # Merge along the innermost axis that has more than one block (e.g. not the channel axis)
+        merge_axes = numpy.nonzero( grid_shape > 1 )[0]
+        merge_axis = merge_axes[-1] if len(merge_axes) > 0 else len(grid_shape)-1
+        outer_shape = list(grid_shape)
+        outer_shape[merge_axis] = 1
+
+        for outer_index in numpy.ndindex( *outer_shape ):
+            block_index = numpy.array(outer_index)
+            while block_index[merge_axis] < grid_shape[merge_axis]:
+                num_blocks = min( tuner.mergeFactor, grid_shape[merge_axis] - block_index[merge_axis] )
+                block_extent = numpy.ones_like(blockshape)
+                block_extent[merge_axis] = num_blocks
+
+                start = origin + (grid_start + block_index) * blockshape
+                stop = start + block_extent * blockshape
+                block_bounds = ( numpy.maximum(start, roi_start), numpy.minimum(stop, roi_stop) )
+                logger.debug( "Requesting Roi: {}".format( block_bounds ) )
+                yield block_bounds
+                block_index[merge_axis] += num_blocks
 
-    def _determine_blockshape(self, outputSlot):
+    @staticmethod
+    def determine_blockshape(outputSlot):
         """
         Choose a blockshape using the slot metadata (if available) or an arbitrary guess otherwise.
+        This is the blockshape that is used if none is given to the constructor.
         """
         input_shape = outputSlot.meta.shape
         max_blockshape = input_shape
@@ -206,6 +273,13 @@ class BigRequestStreamer(object):
         """
         return self._requestBatch.progressSignal
 
+    @property
+    def tuner(self):
+        """
+        The :py:class:`AdaptiveBlockTuner` (in adaptive mode), or None.
+        """
+        return self._tuner
+
     def execute(self):
         """
         Request the data for the entire roi by breaking it up into many smaller requests,
@@ -219,6 +293,161 @@ class BigRequestStreamer(object):
         """
         self._requestBatch.execute()
 
+    def cancel(self):
+        """
+        Abort the processing: Stop launching new requests and cancel the active ones.
+        :py:meth:`execute()` then raises :py:class:`Request.CancellationException`.
+        See :py:meth:`RoiRequestBatch.cancel()`.
+        """
+        self._requestBatch.cancel()
+
+    def iterResults(self, bufferSize=None):
+        """
+        Alternative to :py:meth:`execute()`: Yield ``(roi, result)`` for each block, in roi order.
+        At most ``bufferSize`` blocks are held in memory (or in progress) at once.
+        See :py:meth:`RoiRequestBatch.iterResults()` for details.
+        """
+        for roi, result in self._requestBatch.iterResults( bufferSize ):
+            if self._tuner is not None:
+                # The resultSignal isn't used in this mode, so we have to feed the tuner ourselves.
+                self._tuner.recordResult( roi, result )
+            yield roi, result
+
+class AdaptiveBlockTuner(object):
+    """
+    Chooses the request size and the number of parallel requests for an adaptive 
+    :py:class:`BigRequestStreamer`, based on measurements instead of slot metadata.
+    
+    Requests are made of ``mergeFactor`` blocks of the streamer's base blockshape.
+    After every ``sampleSize`` results, the throughput (voxels/second) and the peak 
+    RSS of this process since the previous sample are compared with the previous sample:
+
+    - While the throughput keeps improving (by at least ``improvementThreshold``), 
+      the merge factor is doubled (as long as the predicted RAM usage fits the budget).
+    - Once it stops improving, the previous merge factor is restored, and kept.
+    - The number of parallel requests is then chosen as large as the RAM budget 
+      allows (up to ``maxConcurrency``), using the RAM per voxel observed so far.
+    - If the peak RSS ever exceeds the budget, the merge factor (or else the 
+      concurrency) is halved.
+    """
+    def __init__( self, baseBlockVolume, maxConcurrency, initialConcurrency=1, 
+                  ramBudget=None, sampleSize=None, maxMergeFactor=1024, improvementThreshold=0.05 ):
+        """
+        :param baseBlockVolume: The number of voxels in a block of the base blockshape.
+        :param maxConcurrency: The maximum number of requests to run in parallel.
+        :param initialConcurrency: The number of parallel requests to start with.
+        :param ramBudget: The amount (in bytes) by which the RSS may grow during the execution.
+                          By default, the RAM available when the tuner is created.
+        :param sampleSize: The number of results to measure before each adjustment.
+                           By default, twice the initial concurrency (at least 4).
+        """
+        self.baseBlockVolume = baseBlockVolume
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.concurrency = max(1, min(initialConcurrency, self.maxConcurrency))
+        self.mergeFactor = 1
+        self.maxMergeFactor = maxMergeFactor
+        self.improvementThreshold = improvementThreshold
+        self.sampleSize = sampleSize or max(4, 2*self.concurrency)
+
+        self._process = psutil.Process(os.getpid())
+        self._clock = time.time # (Tests may substitute a fake clock.)
+        self._baseline_rss = self._process.memory_info().rss
+        if ramBudget is None:
+            if lazyflow.AVAILABLE_RAM_MB != 0:
+                ramBudget = lazyflow.AVAILABLE_RAM_MB * 1e6 - self._baseline_rss
+            else:
+                ramBudget = psutil.virtual_memory().available
+        self.ramBudget = max(0, ramBudget)
+
+        self._requestBatch = None
+        self._lock = threading.Lock()
+        self._growing = True
+        self._previous_throughput = None
+        self._ram_per_voxel = None
+        self._startSample()
+
+        #: The (mergeFactor, concurrency, throughput, peak_rss) of each sample, for diagnostics.
+        self.history = []
+
+    def setRequestBatch(self, requestBatch):
+        """
+        The request batch whose batch size should be adjusted along with the concurrency.
+        """
+        self._requestBatch = requestBatch
+
+    def _startSample(self):
+        self._sample_start = self._clock()
+        self._sample_count = 0
+        self._sample_voxels = 0
+        self._sample_peak_rss = 0
+
+    def recordResult(self, roi, result=None):
+        """
+        Called with each completed roi (may be called in parallel).
+        """
+        voxels = numpy.prod( numpy.subtract(roi[1], roi[0]) )
+        rss = self._process.memory_info().rss
+        with self._lock:
+            self._sample_count += 1
+            self._sample_voxels += voxels
+            self._sample_peak_rss = max( self._sample_peak_rss, rss )
+            if self._sample_count >= self.sampleSize:
+                self._adjust()
+                self._startSample()
+
+    def _adjust(self):
+        elapsed = max( self._clock() - self._sample_start, 1e-6 )
+        throughput = self._sample_voxels / elapsed
+        peak_rss = self._sample_peak_rss
+        self.history.append( (self.mergeFactor, self.concurrency, throughput, peak_rss) )
+
+        # Estimate the RAM needed per requested voxel from the voxels that were in flight.
+        in_flight_voxels = self.concurrency * self.mergeFactor * self.baseBlockVolume
+        ram_per_voxel = max(0, peak_rss - self._baseline_rss) / float(in_flight_voxels)
+        if self._ram_per_voxel is None:
+            self._ram_per_voxel = ram_per_voxel
+        else:
+            # Be pessimistic: Don't forget large measurements too quickly.
+            self._ram_per_voxel = max( ram_per_voxel, 0.5*self._ram_per_voxel )
+
+        if peak_rss - self._baseline_rss > self.ramBudget:
+            # Over budget: back off immediately.
+            self._growing = False
+            if self.mergeFactor > 1:
+                self.mergeFactor //= 2
+            else:
+                self.concurrency = max(1, self.concurrency // 2)
+            logger.info( "Request RAM usage exceeds the budget.  Now using {} blocks per request, {} parallel requests"
+                         .format( self.mergeFactor, self.concurrency ) )
+        else:
+            if self._growing:
+                improved = self._previous_throughput is None \
+                        or throughput > self._previous_throughput * (1.0 + self.improvementThreshold)
+                if not improved:
+                    # The previous setting was better.  Keep it.
+                    self.mergeFactor = max(1, self.mergeFactor // 2)
+                    self._growing = False
+                elif self.mergeFactor*2 <= self.maxMergeFactor \
+                 and self._predictedRam( 2*self.mergeFactor, self.concurrency ) <= self.ramBudget:
+                    self._previous_throughput = throughput
+                    self.mergeFactor *= 2
+                else:
+                    self._growing = False
+
+            # Use as many parallel requests as the RAM budget allows.
+            concurrency = self.maxConcurrency
+            while concurrency > 1 and self._predictedRam( self.mergeFactor, concurrency ) > self.ramBudget:
+                concurrency -= 1
+            self.concurrency = concurrency
+            logger.debug( "Throughput: {:.0f} voxels/s.  Now using {} blocks per request, {} parallel requests"
+                          .format( throughput, self.mergeFactor, self.concurrency ) )
+
+        if self._requestBatch is not None:
+            self._requestBatch.setBatchSize( self.concurrency )
+
+    def _predictedRam(self, mergeFactor, concurrency):
+        return (self._ram_per_voxel or 0.0) * mergeFactor * concurrency * self.baseBlockVolume
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -22,6 +22,9 @@
 import os
 import copy
 import shutil
+import functools
+import contextlib
+import collections
 import threading
 import platform
 import numpy
@@ -55,6 +58,7 @@ from lazyflow.utility.log_exception import log_exception
 from lazyflow.roi import getIntersection, roiToSlice
 from lazyflow.utility import PathComponents, getPathVariants, FileLock
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, TinyVector
+from lazyflow.request import Request, RequestPool
 
 try:
     import vigra
@@ -88,6 +92,9 @@ class BlockwiseFileset(object):
     - Simultaneous reads are threadsafe.
     - NOT threadsafe for reading and writing simultaneously (or writing and writing).
     - NOT threadsafe for closing.  Do not call close() while reading or writing.
+    - Reads and writes that span several blocks are executed in parallel (one request per block file).
+    - For sequential access patterns, see :py:meth:`setReadAhead()`.
+    - At most :py:attr:`DefaultMaxOpenFiles` block files are kept open at once (see :py:meth:`setMaxOpenFiles()`).
 
     .. note:: See the unit tests in ``tests/testBlockwiseFileset.py`` for example usage.
     """
@@ -124,6 +131,9 @@ class BlockwiseFileset(object):
 
     DescriptionSchema = JsonConfigParser( DescriptionFields )
 
+    #: The default size of the pool of open block file handles.  See :py:meth:`setMaxOpenFiles()`.
+    DefaultMaxOpenFiles = 256
+
     @classmethod
     def readDescription(cls, descriptionFilePath):
         """
@@ -235,10 +245,19 @@ class BlockwiseFileset(object):
             self._description.dataset_root_dir = "."
         
         self._lock = threading.Lock()
-        self._openBlockFiles = {}
+        self._openBlockFiles = collections.OrderedDict() # In LRU order: least recently used first.
         self._fileLocks = {}
+        self._pinnedBlockFiles = {} # path -> number of transfers currently using the file
+        self._maxOpenFiles = BlockwiseFileset.DefaultMaxOpenFiles
+        self._openFileStats = { 'hits' : 0, 'misses' : 0, 'evictions' : 0 }
         self._closed = False
 
+        # Read-ahead.  See setReadAhead()
+        self._readAhead = 0
+        self._lastReadRoi = None
+        self._prefetchLock = threading.Lock()
+        self._prefetchedBlocks = {} # block_start (tuple) -> Request for the entire block's data
+
     def __del__(self):
         if hasattr(self, '_closed') and not self._closed:
             self.close()
@@ -253,17 +272,14 @@ class BlockwiseFileset(object):
         """
         Close all open block files.
         """
+        # Prefetch requests may still be reading from the files.
+        self._discardPrefetchedBlocks( wait=True )
         with self._lock:
             assert not self._closed
             paths = self._openBlockFiles.keys()
             for path in paths:
-                blockFile = self._openBlockFiles[path]
-                blockFile.close()
-                if self.mode == 'a':
-                    fileLock = self._fileLocks[path]
-                    fileLock.release()
-            self._openBlockFiles = {}
-            self._fileLocks = {}
+                self._closeBlockFile(path)
+            self._pinnedBlockFiles = {}
             self._closed = True
     
     def reopen(self, mode):
@@ -284,6 +300,7 @@ class BlockwiseFileset(object):
         roi_shape = numpy.subtract(roi[1], roi[0])
         assert ( roi_shape == out_array.shape ).all(), "out_array must match roi shape"
         assert (roi_shape != 0).all(), "Requested roi {} has zero volume!".format( roi )
+        self._prefetchAhead(roi)
         self._transferData(roi, out_array, read=True)
         return out_array
 
@@ -297,8 +314,35 @@ class BlockwiseFileset(object):
         assert self.mode != 'r'
         assert (numpy.subtract(roi[1], roi[0]) != 0).all(), "Requested roi {} has zero volume!".format( roi )
 
+        # Prefetched copies of the blocks we're about to overwrite are no longer valid.
+        if self._prefetchedBlocks:
+            block_starts = getIntersectingBlocks(self._description.block_shape, roi)
+            with self._prefetchLock:
+                for block_start in block_starts:
+                    self._prefetchedBlocks.pop( tuple(block_start), None )
+
         self._transferData(roi, data, read=False)
 
+    def setReadAhead(self, numBlocks):
+        """
+        Enable (or disable, with ``numBlocks=0``) read-ahead for sequential access patterns.
+
+        When consecutive reads move through the dataset in a consistent direction 
+        (e.g. slice-by-slice, or tile-by-tile), the next ``numBlocks`` layers of blocks in that 
+        direction are read in the background (via the request thread pool) while the caller 
+        processes the current data.  Prefetched blocks are kept in memory until the reads 
+        move past them, so at most ``numBlocks + 1`` layers of blocks (each layer as wide as 
+        the requested rois) are held at once.
+
+        Prefetched blocks are only refreshed by writes through this object, 
+        so don't enable read-ahead if other processes may overwrite blocks that are already available.
+        """
+        assert numBlocks >= 0
+        self._readAhead = numBlocks
+        if numBlocks == 0:
+            self._discardPrefetchedBlocks()
+
+
     def getDatasetDirectory( self, blockstart ):
         """
         Return the directory that contains the block that starts at the given coordinates.
@@ -414,8 +458,8 @@ class BlockwiseFileset(object):
         assert (numpy.array(clipped_roi) == numpy.array(roi)).all(), "Roi {} does not fit within dataset bounds: {}".format(roi, self._description.view_shape)
         
         block_starts = getIntersectingBlocks(self._description.block_shape, roi)
-        
-        # TODO: Parallelize this loop?
+
+        transfers = []
         for block_start in block_starts:
             entire_block_roi = self.getEntireBlockRoi(block_start) # Roi of this whole block within the whole dataset
             transfer_block_roi = getIntersection( entire_block_roi, roi ) # Roi of data needed from this block within the whole dataset
@@ -423,7 +467,108 @@ class BlockwiseFileset(object):
             array_data_roi = (transfer_block_roi[0] - roi[0], transfer_block_roi[1] - roi[0]) # Roi of data needed from this block within array_data
 
             array_slicing = roiToSlice( *array_data_roi )
-            self._transferBlockData( entire_block_roi, block_relative_roi, array_data, array_slicing, read )
+
+            prefetched_block = None
+            if read:
+                prefetched_block = self._prefetchedBlocks.get( tuple(block_start) )
+            if prefetched_block is not None:
+                transfers.append( functools.partial( self._transferPrefetchedBlockData, 
+                                                     prefetched_block, entire_block_roi, block_relative_roi, array_data, array_slicing ) )
+            else:
+                transfers.append( functools.partial( self._transferBlockData, 
+                                                     entire_block_roi, block_relative_roi, array_data, array_slicing, read ) )
+
+        if len(transfers) == 1 or Request.global_thread_pool.num_workers == 0:
+            for transfer in transfers:
+                transfer()
+        else:
+            # Each block is a separate file, so the blocks can be transferred in parallel.
+            pool = RequestPool()
+            for transfer in transfers:
+                pool.add( Request( transfer ) )
+            pool.wait()
+
+    def _prefetchAhead(self, roi):
+        """
+        If read-ahead is enabled, start reading the blocks that follow the given roi 
+        in the direction of the previous read, and forget the blocks we've moved past.
+        See :py:meth:`setReadAhead()`.
+        """
+        previous_roi = self._lastReadRoi
+        self._lastReadRoi = roi
+        if self._readAhead == 0 or previous_roi is None or Request.global_thread_pool.num_workers == 0:
+            return
+
+        direction = numpy.sign( numpy.subtract( roi[0], previous_roi[0] ) )
+        block_shape = self._description.block_shape
+        entire_dataset_roi = ([0] *len(self._description.view_shape), self._description.view_shape)
+
+        # Keep the blocks of the current roi (they may be read again by the next access), 
+        # and prefetch the next few layers of blocks.
+        current_blocks = set( map( tuple, getIntersectingBlocks( block_shape, roi ) ) )
+        ahead_blocks = set()
+        if direction.any():
+            for step in range(1, self._readAhead+1):
+                offset = step * direction * block_shape
+                next_roi = getIntersection( ( numpy.add(roi[0], offset), numpy.add(roi[1], offset) ),
+                                            entire_dataset_roi, assertIntersect=False )
+                if next_roi is None:
+                    break
+                ahead_blocks.update( map( tuple, getIntersectingBlocks( block_shape, next_roi ) ) )
+        ahead_blocks -= current_blocks
+        new_blocks = filter( lambda block_start: self.getBlockStatus( block_start ) == BlockwiseFileset.BLOCK_AVAILABLE,
+                             ahead_blocks - set( self._prefetchedBlocks.keys() ) )
+
+        with self._prefetchLock:
+            wanted_blocks = current_blocks.union( ahead_blocks )
+            for block_start in set( self._prefetchedBlocks.keys() ) - wanted_blocks:
+                del self._prefetchedBlocks[block_start]
+            for block_start in new_blocks:
+                if block_start not in self._prefetchedBlocks:
+                    req = Request( functools.partial( self._readEntireBlock, block_start ) )
+                    self._prefetchedBlocks[block_start] = req
+                    req.submit()
+
+    def _readEntireBlock(self, block_start):
+        """
+        Read the entire (viewed) block that starts at the given coordinate, and return it.
+        """
+        entire_block_roi = self.getEntireBlockRoi(block_start)
+        block_shape = numpy.subtract( entire_block_roi[1], entire_block_roi[0] )
+        block_data = numpy.ndarray( shape=block_shape, dtype=self._description.dtype )
+        block_relative_roi = ( [0] * len(block_shape), block_shape )
+        self._transferBlockData( entire_block_roi, block_relative_roi, block_data, roiToSlice( *block_relative_roi ), read=True )
+        return block_data
+
+    def _transferPrefetchedBlockData(self, prefetch_request, entire_block_roi, block_relative_roi, array_data, array_slicing):
+        """
+        Copy data from a prefetched block into ``array_data``.
+        If the prefetch failed (e.g. the block wasn't available after all), read the data from disk instead.
+        """
+        try:
+            block_data = prefetch_request.wait()
+        except Exception:
+            with self._prefetchLock:
+                self._prefetchedBlocks.pop( tuple(entire_block_roi[0]), None )
+            self._transferBlockData( entire_block_roi, block_relative_roi, array_data, array_slicing, read=True )
+        else:
+            array_data[ array_slicing ] = block_data[ roiToSlice( *block_relative_roi ) ]
+
+    def _discardPrefetchedBlocks(self, wait=False):
+        """
+        Forget all prefetched blocks.
+        If ``wait`` is True, wait for prefetch requests that are still executing.
+        """
+        with self._prefetchLock:
+            prefetch_requests = self._prefetchedBlocks.values()
+            self._prefetchedBlocks = {}
+        self._lastReadRoi = None
+        if wait:
+            for req in prefetch_requests:
+                try:
+                    req.wait()
+                except Exception:
+                    pass
 
     def _transferBlockData( self, entire_block_roi, block_relative_roi, array_data, array_slicing, read ):
         """
@@ -462,16 +607,15 @@ class BlockwiseFileset(object):
             if self.getBlockStatus( block_start ) is not BlockwiseFileset.BLOCK_AVAILABLE:
                 raise BlockwiseFileset.BlockNotReadyError( block_start )
 
-            hdf5File = self._getOpenHdf5Blockfile( hdf5FilePath )
-
-            if self._description.dtype != object and isinstance(array_data, numpy.ndarray) and array_data.flags.c_contiguous:
-                hdf5File[ path_parts.internalPath ].read_direct( array_data, roiToSlice( *block_relative_roi ), array_slicing )
-            elif self._description.dtype == object:
-                # We store arrays of dtype=object as arrays of pickle strings.
-                array_pickled_data = hdf5File[ path_parts.internalPath ][ roiToSlice( *block_relative_roi ) ]
-                array_data[ array_slicing ] = vectorized_pickle_loads(array_pickled_data)
-            else:
-                array_data[ array_slicing ] = hdf5File[ path_parts.internalPath ][ roiToSlice( *block_relative_roi ) ]
+            with self._pinnedHdf5Blockfile( hdf5FilePath ) as hdf5File:
+                if self._description.dtype != object and isinstance(array_data, numpy.ndarray) and array_data.flags.c_contiguous:
+                    hdf5File[ path_parts.internalPath ].read_direct( array_data, roiToSlice( *block_relative_roi ), array_slicing )
+                elif self._description.dtype == object:
+                    # We store arrays of dtype=object as arrays of pickle strings.
+                    array_pickled_data = hdf5File[ path_parts.internalPath ][ roiToSlice( *block_relative_roi ) ]
+                    array_data[ array_slicing ] = vectorized_pickle_loads(array_pickled_data)
+                else:
+                    array_data[ array_slicing ] = hdf5File[ path_parts.internalPath ][ roiToSlice( *block_relative_roi ) ]
                 
         else:
             # Create the directory
@@ -488,17 +632,17 @@ class BlockwiseFileset(object):
             self.setBlockStatus( block_start, BlockwiseFileset.BLOCK_NOT_AVAILABLE )
 
             # Write the block data file
-            hdf5File = self._getOpenHdf5Blockfile( hdf5FilePath )
-            if path_parts.internalPath not in hdf5File:
-                self._createDatasetInFile( hdf5File, path_parts.internalPath, entire_block_roi )
-            dataset = hdf5File[ path_parts.internalPath ]
-            data = array_data[ array_slicing ]
-            if data.dtype == object:
-                # hdf5 can't handle datasets with dtype=object,
-                #  so we have to pickle each item first.
-                dataset[ roiToSlice( *block_relative_roi ) ] = vectorized_pickle_dumps(data)
-            else:
-                dataset[ roiToSlice( *block_relative_roi ) ] = data
+            with self._pinnedHdf5Blockfile( hdf5FilePath ) as hdf5File:
+                if path_parts.internalPath not in hdf5File:
+                    self._createDatasetInFile( hdf5File, path_parts.internalPath, entire_block_roi )
+                dataset = hdf5File[ path_parts.internalPath ]
+                data = array_data[ array_slicing ]
+                if data.dtype == object:
+                    # hdf5 can't handle datasets with dtype=object,
+                    #  so we have to pickle each item first.
+                    dataset[ roiToSlice( *block_relative_roi ) ] = vectorized_pickle_dumps(data)
+                else:
+                    dataset[ roiToSlice( *block_relative_roi ) ] = data
             
 
     def _createDatasetInFile(self, hdf5File, datasetName, roi):
@@ -527,18 +671,45 @@ class BlockwiseFileset(object):
         if _use_vigra:
             dataset.attrs['axistags'] = vigra.defaultAxistags( self._description.axes ).toJSON()
 
-    def _getOpenHdf5Blockfile(self, blockFilePath):
+    def setMaxOpenFiles(self, maxOpenFiles):
+        """
+        Set the maximum number of block files to keep open.
+        When the limit is reached, the least recently used file is closed (and its write lock 
+        is released) before the next one is opened.  Files that are being read or written 
+        at the moment are never closed, so the limit may be exceeded while parallel transfers are active.
+        The excess files are closed as soon as those transfers are finished with them.
+        """
+        assert maxOpenFiles >= 1
+        with self._lock:
+            self._maxOpenFiles = maxOpenFiles
+            self._evictBlockFiles()
+
+    def getOpenFileStats(self):
+        """
+        Return a dict with statistics about the pool of open block files:
+        the number of ``'hits'`` (the file was already open), ``'misses'`` (the file had to be opened), 
+        ``'evictions'`` (a file was closed to make room), and the number of currently ``'open'`` files.
+        """
+        with self._lock:
+            stats = dict( self._openFileStats )
+            stats['open'] = len(self._openBlockFiles)
+        return stats
+
+    def _getOpenHdf5Blockfile(self, blockFilePath, pin=False):
         """
         Return a handle to the open hdf5File at the given path.
         If we haven't opened the file yet, open it first.
+        If ``pin`` is True, the file won't be closed to make room for others until it is unpinned again.
+        (See :py:meth:`_pinnedHdf5Blockfile()`.)
         """
-        # Try once without locking
-        if blockFilePath in self._openBlockFiles.keys():
-            return self._openBlockFiles[ blockFilePath ]
-
-        # Obtain the lock and try again
         with self._lock:
-            if blockFilePath not in self._openBlockFiles.keys():
+            hdf5File = self._openBlockFiles.pop( blockFilePath, None )
+            if hdf5File is not None:
+                self._openFileStats['hits'] += 1
+            else:
+                self._openFileStats['misses'] += 1
+                # Make room for the new file
+                self._evictBlockFiles( reserve=1 )
                 try:
                     writeLock = FileLock( blockFilePath, timeout=10 )
                     if self.mode == 'a':
@@ -549,15 +720,69 @@ class BlockwiseFileset(object):
                         assert writeLock.available(), "Can't read from a file that is being written to elsewhere."
                     else: 
                         assert False, "Unsupported mode"
-                    self._openBlockFiles[ blockFilePath ] = h5py.File( blockFilePath, self.mode )
+                    hdf5File = h5py.File( blockFilePath, self.mode )
                 except:
+                    if blockFilePath in self._fileLocks:
+                        self._fileLocks.pop( blockFilePath ).release()
                     log_exception( logger, "Couldn't open {}".format(blockFilePath) )
                     raise
-            return self._openBlockFiles[ blockFilePath ]
+
+            # (Re-)insert as the most recently used file
+            self._openBlockFiles[ blockFilePath ] = hdf5File
+            if pin:
+                self._pinnedBlockFiles[ blockFilePath ] = self._pinnedBlockFiles.get( blockFilePath, 0 ) + 1
+            return hdf5File
+
+    @contextlib.contextmanager
+    def _pinnedHdf5Blockfile(self, blockFilePath):
+        """
+        Context manager.  Provides the open hdf5File at the given path, 
+        and makes sure it isn't closed while the context is active.
+        """
+        hdf5File = self._getOpenHdf5Blockfile( blockFilePath, pin=True )
+        try:
+            yield hdf5File
+        finally:
+            with self._lock:
+                pin_count = self._pinnedBlockFiles.pop( blockFilePath, 0 ) - 1
+                if pin_count > 0:
+                    self._pinnedBlockFiles[ blockFilePath ] = pin_count
+                else:
+                    # If parallel transfers pushed the pool over its limit, shrink it again now.
+                    self._evictBlockFiles()
+
+    def _evictBlockFiles(self, reserve=0):
+        """
+        Close the least recently used (unpinned) block files until there is room for ``reserve`` more files.
+        Must be called with self._lock held.
+        """
+        excess = len(self._openBlockFiles) + reserve - self._maxOpenFiles
+        if excess <= 0:
+            return
+        for path in self._openBlockFiles.keys():
+            if excess <= 0:
+                break
+            if path not in self._pinnedBlockFiles:
+                self._closeBlockFile(path)
+                self._openFileStats['evictions'] += 1
+                excess -= 1
+
+    def _closeBlockFile(self, blockFilePath):
+        """
+        Close the given block file and release its write lock (if any).
+        Must be called with self._lock held.
+        """
+        blockFile = self._openBlockFiles.pop( blockFilePath )
+        blockFile.close()
+        fileLock = self._fileLocks.pop( blockFilePath, None )
+        if fileLock is not None:
+            fileLock.release()
 
     def getOpenHdf5FileForBlock(self, block_start):
         """
         Returns a handle to a file in this dataset.
+        The handle may be closed later on, when the file is evicted from the pool of open files 
+        (see :py:meth:`setMaxOpenFiles()`).
         """
         block_start = tuple(block_start)
         path_components = self.getDatasetPathComponents(block_start)
@@ -1,7 +1,12 @@
 import os
+import sys
 import numpy
 import vigra
 import shutil
+import time
+import threading
+import collections
+import Queue
 from functools import partial
 from StringIO import StringIO
 
@@ -18,7 +23,7 @@ from lazyflow.utility.timer import Timer
 from lazyflow.utility.jsonConfig import JsonConfigParser, AutoEval, FormattedField
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice, getIntersection
 
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 import logging
 logger = logging.getLogger(__name__)
@@ -54,6 +59,8 @@ class TiledVolume(object):
         #  but instead specifies the indexing order of the numpy volumes produced.
         "output_axes" : str,
 
+        # If true, decoded tiles are kept in memory (see tile_cache_mb), and OpCachedTiledVolumeReader
+        #  serves its SpecifiedOutput from a block cache.  Default: False
         "cache_tiles" : bool,
 
         # Offset not supported for now...
@@ -88,7 +95,18 @@ class TiledVolume(object):
 
         # Optional data transform.  For example:
         # "data_transform_function" : "lambda a: a == 0",
-        "data_transform_function" : str
+        "data_transform_function" : str,
+
+        # If true, the data_transform_function operates on each pixel independently, 
+        #  so for uint8 data it can be applied via a (precomputed) lookup table.
+        "data_transform_is_pointwise" : bool,
+
+        # The maximum number of HTTP requests to keep in flight at once (remote tiles only).  Default: 16
+        # (This is independent of the number of worker threads.  Downloads are handled by dedicated threads.)
+        "max_http_requests" : AutoEval(int),
+
+        # The size of the in-memory cache for decoded tiles, in MB (only used if cache_tiles is true).  Default: 64
+        "tile_cache_mb" : AutoEval(int)
     }
     DescriptionSchema = JsonConfigParser( DescriptionFields )
 
@@ -126,9 +144,29 @@ class TiledVolume(object):
         if description.cache_tiles is None:
             description.cache_tiles = False
 
+        if description.data_transform_is_pointwise is None:
+            description.data_transform_is_pointwise = False
+
+        if description.max_http_requests is None:
+            description.max_http_requests = 16
+
+        if description.tile_cache_mb is None:
+            description.tile_cache_mb = 64
+
     def __init__( self, descriptionFilePath ):
         self.description = TiledVolume.readDescription( descriptionFilePath )
         self._session = None
+        self._fetcher = None # Created on demand (remote tiles only)
+
+        # Decoded tiles, by tile index (z,y,x).  Without cache_tiles, the cache stores nothing.
+        tile_cache_bytes = 0
+        if self.description.cache_tiles:
+            tile_cache_bytes = self.description.tile_cache_mb * 1024**2
+        self._tile_cache = TileCache( tile_cache_bytes )
+
+        # Tiles that are currently being downloaded or decoded: { tile index : _TileFuture }
+        self._pending_tiles = {}
+        self._pending_tiles_lock = threading.Lock()
 
         assert self.description.format in vigra.impex.listExtensions().split(), \
             "Unknown tile format: {}".format( self.description.format )
@@ -145,7 +183,23 @@ class TiledVolume(object):
             for dest in destinations:
                 self._slice_remapping[dest] = source
 
+        # The description's functions are compiled once, here (not once per tile).
+        self._z_translation_function = None
+        self._z_translations = {} # Memoized results of the z_translation_function
+        if self.description.z_translation_function is not None:
+            self._z_translation_function = eval(self.description.z_translation_function)
+
+        self._data_transform = None
+        if self.description.data_transform_function is not None:
+            self._data_transform = eval(self.description.data_transform_function)
+            if self.description.data_transform_is_pointwise and numpy.dtype(self.description.dtype) == numpy.uint8:
+                lut = numpy.asarray( self._data_transform( numpy.arange(256, dtype=numpy.uint8) ) )
+                self._data_transform = partial( numpy.take, lut )
+
     def close(self):
+        if self._fetcher:
+            self._fetcher.stop()
+            self._fetcher = None
         if self._session:
             self._session.close()
 
@@ -174,7 +228,10 @@ class TiledVolume(object):
         tile_blockshape = (1,) + tuple(self.description.tile_shape_2d_yx)
         tile_starts = getIntersectingBlocks( tile_blockshape, roi )
 
+        remote = self.description.tile_url_format.startswith('http')
+
         pool = RequestPool()
+        remote_tiles = []
         for tile_start in tile_starts:
             tile_roi_in = getBlockBounds( self.description.bounds_zyx, tile_blockshape, tile_start )
             tile_roi_in = numpy.array(tile_roi_in)
@@ -211,38 +268,83 @@ class TiledVolume(object):
                           'x_index' : tile_index[2] }
 
             # Apply special z_translation_function
-            if self.description.z_translation_function is not None:
-                z_update_func = eval(self.description.z_translation_function)
-                rest_args['z_index'] = rest_args['z_start'] = z_update_func(rest_args['z_index'])
+            if self._z_translation_function is not None:
+                rest_args['z_index'] = rest_args['z_start'] = self._translate_z(rest_args['z_index'])
                 rest_args['z_stop'] = 1 + rest_args['z_start']
 
             # Quick sanity check
             assert rest_args['z_index'] == rest_args['z_start']
 
-            if self.description.tile_url_format.startswith('http'):
-                retrieval_fn = partial( self._retrieve_remote_tile, rest_args, tile_relative_intersection, result_region )
-            else:
-                retrieval_fn = partial( self._retrieve_local_tile, rest_args, tile_relative_intersection, result_region )            
+            # Tiles are cached by the index of the tile that is actually retrieved.
+            tile_key = ( rest_args['z_index'], rest_args['y_index'], rest_args['x_index'] )
 
-            PARALLEL_REQ = True
-            if PARALLEL_REQ:
-                pool.add( Request( retrieval_fn ) )
+            if remote:
+                # Start the download now.  (Decoded tiles are collected below.)
+                tile_future = self._request_remote_tile( tile_key, rest_args )
+                remote_tiles.append( (tile_future, tile_relative_intersection, result_region) )
             else:
-                # execute serially (leave the pool empty)
-                retrieval_fn()
+                retrieval_fn = partial( self._retrieve_local_tile, tile_key, rest_args, tile_relative_intersection, result_region )
+                pool.add( Request( retrieval_fn ) )
 
-        if PARALLEL_REQ:
-            with Timer() as timer:
-                pool.wait()
-            logger.info("Loading {} tiles took a total of {}".format( len(tile_starts), timer.seconds() ))
-        
-    def _retrieve_local_tile(self, rest_args, tile_relative_intersection, data_out):
+        with Timer() as timer:
+            pool.wait()
+            # Tiles are handed to us as soon as they are decoded, while other tiles are still downloading.
+            for tile_future, tile_relative_intersection, result_region in remote_tiles:
+                self._copy_tile( tile_future.wait(), tile_relative_intersection, result_region )
+        logger.info("Loading {} tiles took a total of {}".format( len(tile_starts), timer.seconds() ))
+
+    def _translate_z(self, z):
+        """
+        Apply the z_translation_function.  (Each z value is translated only once.)
+        """
+        try:
+            return self._z_translations[z]
+        except KeyError:
+            translated_z = self._z_translations[z] = self._z_translation_function(z)
+            return translated_z
+
+    def _transform_tile(self, img):
+        """
+        Apply the special data transform (if any) to an entire tile, before it is cached.
+        """
+        if self._data_transform is None:
+            return img
+        # The transform used to be applied to the output array, so give it the output dtype.
+        img = img.astype( self.description.dtype, copy=False )
+        return numpy.asarray( self._data_transform(img) )
+
+    def _copy_tile(self, img, tile_relative_intersection, data_out):
+        """
+        Copy the part we need from the given (transformed) tile with axes zyx into the destination array.
+        If the tile is None (i.e. missing), the destination is filled with zeros.
+        """
+        if img is None:
+            data_out[:] = 0
+            return
+
+        assert img[roiToSlice(*tile_relative_intersection)].shape == data_out.shape
+        data_out[:] = img[roiToSlice(*tile_relative_intersection)]
+
+    def _retrieve_local_tile(self, tile_key, rest_args, tile_relative_intersection, data_out):
+        img = self._tile_cache.get( tile_key )
+        if img is None:
+            img = self._load_local_tile( rest_args )
+            if img is None:
+                return
+            img = self._transform_tile( img )
+            self._tile_cache.put( tile_key, img )
+        self._copy_tile( img, tile_relative_intersection, data_out )
+
+    def _load_local_tile(self, rest_args):
+        """
+        Read the tile from disk and return it with axes zyx, or None if the tile doesn't exist.
+        """
         tile_path = self.description.tile_url_format.format( **rest_args )
         logger.debug("Opening {}".format( tile_path ))
 
         if not os.path.exists(tile_path):
             logger.error("Tile does not exist: {}".format( tile_path ))
-            return
+            return None
 
         # Read the image from the disk with vigra
         img = vigra.impex.readImage(tile_path, dtype='NATIVE')
@@ -254,16 +356,7 @@ class TiledVolume(object):
                                    "If it is RGB, be sure to set the is_rgb flag in your description json."
         
         # img has axes xyc, but we want zyx
-        img = img.transpose()[None,0,:,:]
-    
-        # Copy just the part we need into the destination array
-        assert img[roiToSlice(*tile_relative_intersection)].shape == data_out.shape
-        data_out[:] = img[roiToSlice(*tile_relative_intersection)]
-
-        # If there's a special transform, apply it now.
-        if self.description.data_transform_function is not None:
-            transform = eval(self.description.data_transform_function)
-            data_out[:] = transform(data_out)
+        return img.transpose()[None,0,:,:].view(numpy.ndarray)
 
     # For late imports
     requests = None
@@ -271,29 +364,196 @@ class TiledVolume(object):
     
     TEST_MODE = False # For testing purposes only. See below.    
 
-    def _retrieve_remote_tile(self, rest_args, tile_relative_intersection, data_out):
+    def _request_remote_tile(self, tile_key, rest_args):
+        """
+        Return a _TileFuture for the decoded tile with the given index.
+        If the tile isn't cached, and isn't already being downloaded (for a different read), start downloading it.
+        """
+        with self._pending_tiles_lock:
+            tile_future = self._pending_tiles.get( tile_key )
+            if tile_future is not None:
+                return tile_future
+
+            tile_future = _TileFuture()
+            img = self._tile_cache.get( tile_key )
+            if img is not None:
+                tile_future.set_result( img )
+                return tile_future
+            self._pending_tiles[tile_key] = tile_future
+
+        if self._fetcher is None:
+            with self._pending_tiles_lock:
+                if self._fetcher is None:
+                    self._session = self._create_session( self.description.max_http_requests )
+                    # Provide authentication if we have the details.
+                    if self.description.username and self.description.password:
+                        self._session.auth = (self.description.username, self.description.password)
+                    self._fetcher = TileFetcher( self._session, self.description.max_http_requests, self.TEST_MODE )
+
+        tile_url = self.description.tile_url_format.format( **rest_args )
+        self._fetcher.fetch( tile_url, partial( self._handle_downloaded_tile, tile_key, tile_url, tile_future ) )
+        return tile_future
+
+    def _handle_downloaded_tile(self, tile_key, tile_url, tile_future, response, exc_info):
+        """
+        Called from a download thread when a tile has been downloaded (or the download failed).
+        The tile is decoded in a separate request, so the download thread can move on to the next tile.
+        """
+        if exc_info is not None:
+            self._finish_remote_tile( tile_key, tile_future, exc_info=exc_info )
+        else:
+            Request( partial( self._decode_remote_tile, tile_key, tile_url, tile_future, response ) ).submit()
+
+    def _decode_remote_tile(self, tile_key, tile_url, tile_future, response):
+        try:
+            requests = TiledVolume.requests
+            if response.status_code == requests.codes.not_found:
+                logger.warn("NOTFOUND: {}".format( tile_url ))
+                img = None
+            else:
+                # late import
+                if not TiledVolume.PIL:
+                    import PIL
+                    import PIL.Image
+                    TiledVolume.PIL = PIL
+                PIL = TiledVolume.PIL
+
+                img = numpy.asarray( PIL.Image.open(StringIO(response.content)) )
+                if self.description.is_rgb:
+                    # "Convert" to grayscale -- just take first channel.
+                    assert img.ndim == 3
+                    img = img[...,0]
+                assert img.ndim == 2, "Image seems to be of the wrong dimension.  "\
+                                      "If it is RGB, be sure to set the is_rgb flag in your description json."
+                # img has axes xy, but we want zyx
+                img = self._transform_tile( img[None] )
+        except:
+            self._finish_remote_tile( tile_key, tile_future, exc_info=sys.exc_info() )
+        else:
+            self._finish_remote_tile( tile_key, tile_future, img )
+
+    def _finish_remote_tile(self, tile_key, tile_future, img=None, exc_info=None):
+        with self._pending_tiles_lock:
+            if exc_info is None and img is not None:
+                self._tile_cache.put( tile_key, img )
+            del self._pending_tiles[tile_key]
+        if exc_info is not None:
+            tile_future.set_exception( exc_info )
+        else:
+            tile_future.set_result( img )
+    
+    @classmethod
+    def _create_session(cls, pool_size=None):
+        """
+        Generate a requests.Session object to use for this TiledVolume.
+        Using a session allows us to benefit from a connection pool 
+          instead of establishing a new connection for every request.
+        The connection pool size defaults to the number of worker threads.
+        """
         # Late import
         if not TiledVolume.requests:
             import requests
             TiledVolume.requests = requests
         requests = TiledVolume.requests
 
-        tile_url = self.description.tile_url_format.format( **rest_args )
-        logger.debug("Retrieving {}".format( tile_url ))
-        try:
-            if self._session is None:
-                self._session = self._create_session()
+        session = requests.Session()
+
+        # Replace the session http adapters with ones that use larger connection pools
+        n_threads = pool_size or max(1, Request.global_thread_pool.num_workers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads)
+        adapter2 = requests.adapters.HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter2)
+        return session
+
+class _TileFuture(object):
+    """
+    The result of a tile download.  Can be waited for by requests and normal threads alike.
+    """
+    def __init__(self):
+        self._result = None
+        self._exc_info = None
+
+        # Held until the result is available.
+        self._done_lock = RequestLock()
+        self._done_lock.acquire()
+
+    def set_result(self, result):
+        self._result = result
+        self._done_lock.release()
 
-                # Provide authentication if we have the details.
-                if self.description.username and self.description.password:
-                    self._session.auth = (self.description.username, self.description.password)
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done_lock.release()
 
-            success = False
+    def wait(self):
+        """
+        Wait for the tile and return it (or raise the exception that occurred while downloading it).
+        """
+        self._done_lock.acquire()
+        self._done_lock.release()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class TileFetcher(object):
+    """
+    Downloads tiles with a fixed number of dedicated threads, so the number of HTTP requests 
+    in flight doesn't depend on (and doesn't occupy) the request worker threads.
+    Each download thread reuses its connection from the session's connection pool.
+    """
+    def __init__(self, session, num_threads, retry_once_more=False):
+        """
+        :param session: The requests.Session to download with.
+        :param num_threads: The number of download threads, i.e. the maximum number of HTTP requests in flight.
+        :param retry_once_more: If True, retry once more (after a short pause) if all attempts failed.  (For testing.)
+        """
+        self._session = session
+        self._retry_once_more = retry_once_more
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(num_threads):
+            th = threading.Thread( target=self._run, name="TileFetcher-{}".format(i) )
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def fetch(self, url, callback):
+        """
+        Download the given url.  When finished, ``callback(response, exc_info)`` is called from the download thread.
+        If the download failed, ``response`` is None and ``exc_info`` is the result of ``sys.exc_info()``.
+        """
+        self._queue.put( (url, callback) )
+
+    def stop(self):
+        """
+        Stop the download threads (after the downloads that are already queued).
+        """
+        for _ in self._threads:
+            self._queue.put( None )
+        self._threads = []
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            url, callback = item
+            try:
+                response = self._get( url )
+            except:
+                callback( None, sys.exc_info() )
+            else:
+                callback( response, None )
+
+    def _get(self, url):
+        requests = TiledVolume.requests
+        logger.debug("Retrieving {}".format( url ))
+        try:
             tries = 0
-            while not success:
+            while True:
                 try:
-                    r = self._session.get(tile_url)
-                    success = True
+                    return self._session.get(url)
                 except requests.ConnectionError:
                     # This special 'pass' is here because we keep running into exceptions like this: 
                     #   ConnectionError: HTTPConnectionPool(host='neurocean.int.janelia.org', port=6081): 
@@ -307,62 +567,57 @@ class TiledVolume(object):
             # During testing, the server we're pulling from might be in our own process.
             # Apparently that means that it is not very responsive, leading to exceptions.
             # As a cheap workaround, just try one more time.
-            if self.TEST_MODE:
-                import time
+            if self._retry_once_more:
                 time.sleep(0.01)
-                r = self._session.get(tile_url)
+                return self._session.get(url)
             else:
                 raise
-                
-        if r.status_code == requests.codes.not_found:
-            logger.warn("NOTFOUND: {}".format( tile_url ))
-            data_out[:] = 0
-        else:
-            # late import
-            if not TiledVolume.PIL:
-                import PIL
-                import PIL.Image
-                TiledVolume.PIL = PIL
-            PIL = TiledVolume.PIL
-
-            img = numpy.asarray( PIL.Image.open(StringIO(r.content)) )
-            if self.description.is_rgb:
-                # "Convert" to grayscale -- just take first channel.
-                assert img.ndim == 3
-                img = img[...,0]
-            assert img.ndim == 2, "Image seems to be of the wrong dimension.  "\
-                                  "If it is RGB, be sure to set the is_rgb flag in your description json."
-            # img has axes xy, but we want zyx
-            img = img[None]
-        
-            # Copy just the part we need into the destination array
-            assert img[roiToSlice(*tile_relative_intersection)].shape == data_out.shape
-            data_out[:] = img[roiToSlice(*tile_relative_intersection)]
-            
-            # If there's a special transform, apply it now.
-            if self.description.data_transform_function is not None:
-                transform = eval(self.description.data_transform_function)
-                data_out[:] = transform(data_out)
-    
-    @classmethod
-    def _create_session(cls):
+
+class TileCache(object):
+    """
+    A thread-safe, memory-bounded LRU cache of decoded tiles.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._tiles = collections.OrderedDict() # In LRU order: least recently used first.
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
         """
-        Generate a requests.Session object to use for this TiledVolume.
-        Using a session allows us to benefit from a connection pool 
-          instead of establishing a new connection for every request.
+        Return the cached tile, or None.
         """
-        # Late import
-        if not TiledVolume.requests:
-            import requests
-            TiledVolume.requests = requests
-        requests = TiledVolume.requests
-
-        session = requests.Session()
-
-        # Replace the session http adapters with ones that use larger connection pools
-        n_threads = max(1, Request.global_thread_pool.num_workers)
-        adapter = requests.adapters.HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads)
-        adapter2 = requests.adapters.HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter2)
-        return session
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tiles[key] = tile
+            return tile
+
+    def put(self, key, tile):
+        """
+        Add a tile to the cache (read-only), and evict the least recently used tiles if necessary.
+        Tiles that are too big for the cache are not stored at all.
+        """
+        if tile.nbytes > self.max_bytes:
+            return
+        tile = tile.view()
+        tile.flags.writeable = False
+        with self._lock:
+            old_tile = self._tiles.pop(key, None)
+            if old_tile is not None:
+                self._total_bytes -= old_tile.nbytes
+            self._tiles[key] = tile
+            self._total_bytes += tile.nbytes
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._total_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._total_bytes = 0
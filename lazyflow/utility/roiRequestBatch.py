@@ -26,7 +26,7 @@ import numpy
 
 import lazyflow.stype
 from lazyflow.utility import OrderedSignal
-from lazyflow.request import Request, SimpleRequestCondition, log_exception
+from lazyflow.request import Request, RequestLock, SimpleRequestCondition, log_exception
 
 
 import logging
@@ -88,8 +88,19 @@ class RoiRequestBatch( object ):
     Progress: 0 20 40 60 80 100 100 
     >>> print "Processed {} result blocks with a total sum of: {}".format( result_count[0], result_total_sum[0] )
     Processed 5 result blocks with a total sum of: 14500
+
+    Alternatively, the results can be consumed in roi order with :py:meth:`iterResults()`:
+
+    >>> batch_requester = RoiRequestBatch( op.Output, iter(rois), batchSize=2 )
+    >>> for roi, result in batch_requester.iterResults( bufferSize=3 ):
+    ...     print roi[0], result.sum()
+    (0, 0) 900
+    (0, 10) 1900
+    (0, 20) 2900
+    (0, 30) 3900
+    (0, 40) 4900
     """
-    def __init__( self, outputSlot, roiIterator, totalVolume=None, batchSize=2, allowParallelResults=False ):
+    def __init__( self, outputSlot, roiIterator, totalVolume=None, batchSize=2, allowParallelResults=False, priority=0 ):
         """
         Constructor.
 
@@ -101,6 +112,13 @@ class RoiRequestBatch( object ):
         :param batchSize: The maximum number of requests to launch in parallel.
         :param allowParallelResults: If False, The resultSignal will not be called in parallel.
                                      In that case, your handler function has no need for locks.
+        :param priority: The scheduling priority of the requests (see :py:meth:`Request.set_priority()`).
+                         Use a negative priority for background work (e.g. exports), so that it yields 
+                         the worker threads to interactive requests.
+                         The priority can't be honoured (and a warning is logged) if the batch runs 
+                         inside a request, since child requests always inherit their parent's priority.
+                         With the ``'stealing'`` scheduler, it only orders the batch's own requests among 
+                         other root requests: the work they spawn is scheduled without regard to priority.
         """
         self._resultSignal = OrderedSignal()
         self._progressSignal = OrderedSignal()
@@ -111,11 +129,26 @@ class RoiRequestBatch( object ):
         self._roiIter = roiIterator
         self._batchSize = batchSize
         self._allowParallelResults = allowParallelResults
+        self._priority = priority
         
         self._condition = SimpleRequestCondition()
 
+        # Serializes the resultSignal if allowParallelResults=False.
+        # (We don't use self._condition for that, so a slow handler doesn't prevent 
+        #  other finished requests from being counted and new requests from being activated.)
+        self._resultLock = RequestLock()
+
         self._activated_count = 0
-        self._completed_count = 0
+        self._completed_count = 0 # Includes cancelled requests
+
+        # Requests that haven't finished yet: { request index : request }
+        self._active_requests = {}
+        self._cancelled = False
+
+        # Reorder buffer for iterResults(): { request index : (roi, result) }
+        self._ordered = False
+        self._orderedResults = {}
+        self._closed = False
         
         self._failure_excinfo = None
 
@@ -137,6 +170,19 @@ class RoiRequestBatch( object ):
         Progress Signal Signature: ``f(progress_percent)``
         """
         return self._progressSignal
+
+    @property
+    def batchSize(self):
+        return self._batchSize
+
+    def setBatchSize(self, batchSize):
+        """
+        Change the number of requests to run in parallel, even while executing.
+        If the batch size shrinks, no new requests are launched until enough active requests have completed.
+        (May be called from a resultSignal handler.)
+        """
+        assert batchSize >= 1
+        self._batchSize = batchSize
     
     def execute(self):
         """
@@ -159,21 +205,25 @@ class RoiRequestBatch( object ):
             # Start by activating a batch of N requests
             for _ in range(self._batchSize):
                 with self._condition:
+                    if self._cancelled:
+                        break
                     self._activateNewRequest()
                     self._activated_count += 1
 
-            # Loop until StopIteration
-            while True:
+            # Loop until StopIteration (or cancellation)
+            while not self._cancelled:
                 # Wait for at least one active request to finish
                 with self._condition:
-                    while not self._failure_excinfo and (self._activated_count - self._completed_count) == self._batchSize:
+                    while not self._failure_excinfo and not self._cancelled \
+                      and (self._activated_count - self._completed_count) >= self._batchSize:
                         self._condition.wait()
 
                 if self._failure_excinfo:
                     raise self._failure_excinfo[0], self._failure_excinfo[1], self._failure_excinfo[2]
 
                 # Launch new requests until we have the correct number of active requests
-                while not self._failure_excinfo and self._activated_count - self._completed_count < self._batchSize:
+                while not self._failure_excinfo and not self._cancelled \
+                  and self._activated_count - self._completed_count < self._batchSize:
                     with self._condition:
                         self._activateNewRequest() # Eventually raises StopIteration
                         self._activated_count += 1
@@ -183,13 +233,109 @@ class RoiRequestBatch( object ):
 
         except StopIteration:
             # We've run out of requests to launch.
-            # Wait for the remaining active requests to finish.
-            with self._condition:
-                while not self._failure_excinfo and self._completed_count < self._activated_count:
-                    self._condition.wait()
+            pass
 
-            if self._failure_excinfo:
-                raise self._failure_excinfo[0], self._failure_excinfo[1], self._failure_excinfo[2]
+        # Wait for the remaining active requests to finish (or to be cancelled).
+        with self._condition:
+            while not self._failure_excinfo and self._completed_count < self._activated_count:
+                self._condition.wait()
+
+        if self._failure_excinfo:
+            raise self._failure_excinfo[0], self._failure_excinfo[1], self._failure_excinfo[2]
+
+        if self._cancelled:
+            raise Request.CancellationException()
+
+        self.progressSignal( 100 )
+
+    def cancel(self):
+        """
+        Stop launching new requests, and cancel the active ones.
+        (Requests that other requests are waiting for can't be cancelled, 
+        but their results are discarded.)
+
+        May be called from any thread, e.g. from a GUI "abort" button, or from a resultSignal handler.
+        :py:meth:`execute()` (or the :py:meth:`iterResults()` generator) raises 
+        :py:class:`Request.CancellationException` when the batch has been cancelled.
+        """
+        with self._condition:
+            self._cancelled = True
+            active_requests = self._active_requests.values()
+            self._condition.notify()
+
+        for req in active_requests:
+            # Finished requests may still be running their result handler (or waiting for the 
+            #  result lock).  Don't cancel them: _handleCompletedRequest() discards their results.
+            if not req.finished:
+                req.cancel()
+
+    def iterResults(self, bufferSize=None):
+        """
+        Execute the batch of requests and yield ``(roi, result)`` for each of them, 
+        in the same order as the rois were provided by the roi iterator.
+        Requests are still executed in parallel (at most ``batchSize`` of them at once), 
+        but results that arrive early are held in a reorder buffer until all preceding 
+        results have been consumed.
+
+        The buffer holds at most ``bufferSize`` results (finished or in progress).
+        When it is full, no new requests are activated until the consumer catches up, 
+        so the memory usage is bounded no matter how slow the consumer is.
+        (Default: ``batchSize``)
+
+        The results are consumed in the caller's thread, so the consumer never blocks 
+        the worker threads.  The :py:obj:`resultSignal` is not used in this mode.
+        If the generator is closed early, the remaining requests are cancelled.
+        """
+        if bufferSize is None:
+            bufferSize = self._batchSize
+        assert bufferSize >= 1
+        assert self._activated_count == 0, "A RoiRequestBatch can only be executed once."
+        self._ordered = True
+        self.progressSignal( 0 )
+
+        next_index = 0
+        exhausted = False
+        try:
+            while True:
+                with self._condition:
+                    while True:
+                        # Launch new requests as long as there's room in the buffer
+                        while ( not exhausted
+                                and not self._failure_excinfo
+                                and not self._cancelled
+                                and self._activated_count - next_index < bufferSize
+                                and self._activated_count - self._completed_count < self._batchSize ):
+                            try:
+                                self._activateNewRequest()
+                            except StopIteration:
+                                exhausted = True
+                            else:
+                                self._activated_count += 1
+
+                        if ( self._failure_excinfo
+                             or self._cancelled
+                             or next_index in self._orderedResults
+                             or (exhausted and next_index == self._activated_count) ):
+                            break
+                        self._condition.wait()
+
+                    if self._failure_excinfo:
+                        raise self._failure_excinfo[0], self._failure_excinfo[1], self._failure_excinfo[2]
+                    if self._cancelled:
+                        raise Request.CancellationException()
+                    if next_index == self._activated_count:
+                        break
+                    roi, result = self._orderedResults.pop(next_index)
+
+                next_index += 1
+                yield roi, result
+        finally:
+            with self._condition:
+                self._closed = True
+                self._orderedResults.clear()
+                unfinished = bool(self._active_requests)
+            if unfinished:
+                self.cancel()
 
         self.progressSignal( 100 )
 
@@ -200,6 +346,7 @@ class RoiRequestBatch( object ):
         """
         # This could raise StopIteration
         roi = self._roiIter.next()
+        index = self._activated_count
         req = self._outputSlot( roi[0], roi[1] )
         
         # We have to make sure that we didn't get a so-called "ValueRequest"
@@ -207,18 +354,61 @@ class RoiRequestBatch( object ):
         # (This can happen if array data was given to a slot via setValue().)
         assert isinstance( req, Request ), \
             "Can't use RoiRequestBatch with non-standard requests.  See comment above."
+
+        if req.parent_request is None:
+            req.set_priority( self._priority )
+        if self._priority != 0 and index == 0:
+            self._warnIfPriorityIgnored( req )
         
-        req.notify_finished( partial( self._handleCompletedRequest, roi ) )
-        req.notify_failed( partial( self._handleFailedRequest, roi ) )
-        req.notify_cancelled( partial( self._handleCancelledRequest, roi ) )
+        self._active_requests[index] = req
+        req.notify_finished( partial( self._handleCompletedRequest, index, roi ) )
+        req.notify_failed( partial( self._handleFailedRequest, index, roi ) )
+        req.notify_cancelled( partial( self._handleCancelledRequest, index, roi ) )
         req.submit()
 
-    def _handleCompletedRequest(self, roi, result):
+    def _warnIfPriorityIgnored(self, req):
+        """
+        Log a warning if our priority can't be (fully) honoured for the given request.
+        """
+        if req.parent_request is not None:
+            logger.warning( "RoiRequestBatch is running inside another request, so its requests inherit "
+                            "their parent's priority.  priority={} is ignored.".format( self._priority ) )
+        elif getattr( Request.global_thread_pool, 'scheduler', None ) == 'stealing':
+            logger.warning( "With the 'stealing' scheduler, priority={} only applies to the batch's own requests, "
+                            "not to the work they spawn.".format( self._priority ) )
+
+    def _handleCompletedRequest(self, index, roi, result):
+        if self._cancelled:
+            # This request couldn't be cancelled (someone else needed its result).
+            # Discard the result.
+            self._handleCancelledRequest(index, roi)
+            return
+
+        if self._ordered:
+            with self._condition:
+                del self._active_requests[index]
+                if not self._closed:
+                    # Hand the result to iterResults(), via the reorder buffer
+                    self._orderedResults[index] = (roi, result)
+                self._handleProgress(roi)
+                self._condition.notify()
+            return
+
         try:
             if self._allowParallelResults:
-                # Signal the user with the result before the critical section
                 self.resultSignal(roi, result)
-        except Exception:
+            else:
+                with self._resultLock:
+                    if self._cancelled:
+                        # The batch was cancelled while we were waiting for the lock.
+                        raise Request.CancellationException()
+                    self.resultSignal(roi, result)
+        except Exception as ex:
+            if self._cancelled and isinstance(ex, Request.CancellationException):
+                # Discard the result.
+                # (This request may have been cancelled while it was waiting for the result lock.)
+                self._handleCancelledRequest(index, roi)
+                return
             # Always notify.
             with self._condition:
                 self._failure_excinfo = sys.exc_info()
@@ -227,33 +417,39 @@ class RoiRequestBatch( object ):
 
         with self._condition:
             try:
-                if not self._allowParallelResults:
-                    # Signal here, inside the critical section.
-                    self.resultSignal(roi, result)
-    
-                # Report progress (if possible)
-                if self._totalVolume is not None:
-                    self._processedVolume += numpy.prod( numpy.subtract(roi[1], roi[0]) )
-                    progress = 100 * self._processedVolume / self._totalVolume
-                    self.progressSignal( progress )
-
-                logger.debug("Request completed for roi: {}".format(roi))
-                self._completed_count += 1
+                del self._active_requests[index]
+                self._handleProgress(roi)
             finally:
                 # Always notify in this finally section, 
-                #  even if the client result/progress handler raised.
+                #  even if the client progress handler raised.
                 self._condition.notify()
 
-    def _handleFailedRequest(self, roi, exc, exc_info):
+    def _handleProgress(self, roi):
+        """
+        Count the completed request and report progress (if possible).
+        Must be called from within the critical section.
+        """
+        logger.debug("Request completed for roi: {}".format(roi))
+        self._completed_count += 1
+        if self._totalVolume is not None:
+            self._processedVolume += numpy.prod( numpy.subtract(roi[1], roi[0]) )
+            progress = 100 * self._processedVolume / self._totalVolume
+            self.progressSignal( progress )
+
+    def _handleFailedRequest(self, index, roi, exc, exc_info):
         with self._condition:
+            del self._active_requests[index]
             msg = "Encountered exception while processing roi: {}".format( roi )
             log_exception( logger, msg, exc_info )
             self._failure_excinfo = exc_info
             self._condition.notify()
     
-    def _handleCancelledRequest(self, roi):
-        # This class doesn't yet support request cancellation.
-        raise NotImplementedError
+    def _handleCancelledRequest(self, index, roi):
+        with self._condition:
+            self._active_requests.pop(index, None)
+            logger.debug("Request cancelled for roi: {}".format(roi))
+            self._completed_count += 1
+            self._condition.notify()
     
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,170 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import time
+import threading
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, CostAwareEvictionPolicy
+
+class FakeCache(object):
+    """
+    Implements just enough of the OpArrayCache interface for the memory manager.
+    """
+    def __init__(self, mgr, nbytes, last_access, priority=0.0, compute_time=0.0):
+        self.mgr = mgr
+        self.nbytes = nbytes
+        self.compute_time = compute_time
+        self._last_access = last_access
+        self._cache_priority = priority
+        self.freed = threading.Event()
+
+    def allocate(self):
+        self.mgr.reportAllocation(self, self.nbytes)
+        self.mgr.add(self)
+
+    def grow(self, nbytes):
+        self.nbytes += nbytes
+        self.mgr.reportAllocation(self, nbytes)
+
+    def usedMemory(self):
+        return self.nbytes
+
+    def computeTime(self):
+        return self.compute_time
+
+    def _freeMemory(self, refcheck=True):
+        self.mgr.reportFree(self, self.nbytes)
+        self.freed.set()
+        return self.nbytes
+
+class TestArrayCacheMemoryMgr(object):
+
+    def setUp(self):
+        self.mgr = ArrayCacheMemoryMgr()
+        # Only look at the bytes held by caches, not the RAM usage of the whole process.
+        self.mgr._max_usage = 100
+        self.mgr._target_usage = 100
+
+    def testAccounting(self):
+        mgr = self.mgr
+        a = FakeCache(mgr, 100, time.time())
+        b = FakeCache(mgr, 50, time.time())
+        a.allocate()
+        b.allocate()
+        assert mgr.totalCacheBytes() == 150
+
+        a._freeMemory()
+        assert mgr.totalCacheBytes() == 50
+
+        mgr.remove(b)
+        assert mgr.totalCacheBytes() == 0
+
+    def testEvictionOrder(self):
+        """
+        The least recently used caches are evicted first, and removed caches are never returned.
+        """
+        mgr = self.mgr
+        now = time.time()
+        old = FakeCache(mgr, 1, now - 100)
+        older = FakeCache(mgr, 1, now - 200)
+        newest = FakeCache(mgr, 1, now)
+        removed = FakeCache(mgr, 1, now - 300)
+        for c in (old, older, newest, removed):
+            c.allocate()
+        mgr.remove(removed)
+
+        # Simulate an access of 'older' after it was registered
+        older._cache_priority = 0.5 * older._cache_priority + 200
+        older._last_access = now + 1
+
+        with mgr._lock:
+            victims = [ mgr._popVictim() for _ in range(4) ]
+        assert victims == [old, older, newest, None], victims
+
+    def testEvictOnAllocation(self):
+        """
+        Exceeding the cache budget triggers eviction immediately, without waiting for a polling interval.
+        """
+        mgr = self.mgr
+        mgr.setCacheBudget(1000, 600)
+        mgr.start()
+
+        now = time.time()
+        first = FakeCache(mgr, 600, now - 10)
+        second = FakeCache(mgr, 600, now)
+        first.allocate()
+        assert not first.freed.is_set()
+
+        second.allocate()
+        assert first.freed.wait(1.0), "Least recently used cache was not evicted in time."
+        assert not second.freed.is_set()
+        assert mgr.totalCacheBytes() == 600
+
+    def testCostAwareEviction(self):
+        """
+        With the cost-aware policy, cheap and large caches are evicted before expensive and small ones.
+        """
+        mgr = self.mgr
+        policy = CostAwareEvictionPolicy()
+        mgr.setEvictionPolicy(policy)
+
+        now = time.time()
+        expensive = FakeCache(mgr, 100, now - 100, compute_time=10.0)
+        cheap = FakeCache(mgr, 1000, now, compute_time=1.0)
+        medium = FakeCache(mgr, 100, now, compute_time=2.0)
+        for c in (expensive, cheap, medium):
+            c.allocate()
+
+        with mgr._lock:
+            assert mgr._popVictim() is cheap
+        # Evicting a cache ages the remaining ones.
+        assert policy.inflation == 1.0/1000
+
+        # A cache that is used again keeps its value relative to the new inflation.
+        mgr.add(medium)
+        with mgr._lock:
+            victims = [ mgr._popVictim() for _ in range(3) ]
+        assert victims == [medium, expensive, None], victims
+
+    def testCostAwareEvictionAfterGrowth(self):
+        """
+        A cache that grows becomes cheaper per byte, so it must move up in the eviction order.
+        """
+        mgr = self.mgr
+        mgr.setEvictionPolicy(CostAwareEvictionPolicy())
+
+        now = time.time()
+        a = FakeCache(mgr, 100, now, compute_time=1.0)
+        b = FakeCache(mgr, 100, now, compute_time=2.0)
+        a.allocate()
+        b.allocate()
+
+        b.grow(900)
+        with mgr._lock:
+            victims = [ mgr._popVictim() for _ in range(3) ]
+        assert victims == [b, a, None], victims
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
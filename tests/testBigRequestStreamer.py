@@ -21,6 +21,8 @@
 ###############################################################################
 import gc
 import sys
+import time
+import collections
 import numpy
 import psutil
 import threading
@@ -30,6 +32,7 @@ from lazyflow.operators import OpArrayPiper
 from lazyflow.request import Request
 
 from lazyflow.utility import BigRequestStreamer
+from lazyflow.utility.bigRequestStreamer import AdaptiveBlockTuner
 
 import logging
 logger = logging.getLogger(__name__)
@@ -154,6 +157,168 @@ class TestBigRequestStreamer(object):
         logger.debug( "Finished test with memory usage at: {} MB ({} MB increase)".format( finished_mem_usage_mb, difference_mb ) )
         assert difference_mb < 200, "BigRequestStreamer seems to have memory leaks.  After executing, RAM usage increased by {}".format( difference_mb )
 
+class FakeClock(object):
+    """
+    A clock for AdaptiveBlockTuner, which only advances when we say so.
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class TestAdaptiveBigRequestStreamer(object):
+
+    class OpSlowProvider( Operator ):
+        """
+        Provides the sum of the indices, with a fixed overhead per request.
+        If a FakeClock is given, the overhead (and a small cost per pixel) is charged to it instead.
+        """
+        Output = OutputSlot()
+        clock = None
+
+        def setupOutputs(self):
+            self.Output.meta.dtype = numpy.int64
+            self.Output.meta.shape = (400, 100)
+
+        def execute(self, slot, subindex, roi, result):
+            if self.clock is not None:
+                self.clock.advance( 0.01 + 1e-6 * numpy.prod(roi.stop - roi.start) )
+            else:
+                time.sleep(0.01)
+            result[:] = numpy.indices( roi.stop - roi.start ).sum(0) + sum(roi.start)
+            return result
+
+        def propagateDirty(self, slot, subindex, roi):
+            pass
+
+    def testAdaptive(self):
+        # Without worker threads, the requests are executed (and their time is charged 
+        #  to the fake clock) in order, so the tuner's decisions are deterministic.
+        num_workers = Request.global_thread_pool.num_workers
+        Request.reset_thread_pool(0)
+        try:
+            self._testAdaptive()
+        finally:
+            Request.reset_thread_pool(num_workers)
+
+    def _testAdaptive(self):
+        op = self.OpSlowProvider( graph=Graph() )
+        op.clock = FakeClock()
+        expected = numpy.indices( (400,100) ).sum(0)
+        results = numpy.zeros( (400,100), dtype=numpy.int64 )
+        coverage = numpy.zeros( (400,100), dtype=numpy.int32 )
+
+        def handleResult(roi, result):
+            results[ roiToSlice( *roi ) ] = result
+            coverage[ roiToSlice( *roi ) ] += 1
+
+        progressList = []
+        # Relative blocking, with a roi that isn't aligned to the blockshape.
+        batch = BigRequestStreamer( op.Output, [(3,0), (397,100)], (2,100), blockAlignment='relative', adaptive=True )
+        batch.resultSignal.subscribe( handleResult )
+        batch.progressSignal.subscribe( lambda progress: progressList.append( progress ) )
+        batch.tuner._clock = op.clock
+        batch.tuner._startSample()
+        batch.execute()
+
+        assert (coverage[3:397] == 1).all(), "Every pixel must be requested exactly once."
+        assert (coverage[:3] == 0).all() and (coverage[397:] == 0).all()
+        assert (results[3:397] == expected[3:397]).all()
+        assert progressList[0] == 0 and progressList[-1] == 100
+
+        # Each request has a fixed overhead, so larger requests have higher throughput.
+        tuner = batch.tuner
+        assert tuner.mergeFactor > 1, "Tuner didn't increase the request size: {}".format( tuner.history )
+        merge_factors = [ merge_factor for (merge_factor, concurrency, throughput, peak_rss) in tuner.history ]
+        assert merge_factors == [1, 2, 4, 8, 16], "Unexpected tuning history: {}".format( tuner.history )
+
+    def testAbsoluteBlocking(self):
+        op = self.OpSlowProvider( graph=Graph() )
+        rois = []
+        batch = BigRequestStreamer( op.Output, [(5,10), (395,90)], (20,20), adaptive=True )
+        batch.resultSignal.subscribe( lambda roi, result: rois.append( roi ) )
+        batch.execute()
+
+        coverage = numpy.zeros( (400,100), dtype=numpy.int32 )
+        for start, stop in rois:
+            coverage[ roiToSlice( start, stop ) ] += 1
+            # Requests may only be cut at block boundaries (or at the edge of the roi)
+            assert ( (numpy.array(start) % 20 == 0) | (numpy.array(start) == (5,10)) ).all()
+        assert (coverage[5:395, 10:90] == 1).all()
+        assert coverage.sum() == 390*80
+
+class TestAdaptiveBlockTuner(object):
+    """
+    Tests the tuner's decisions with fake RSS measurements and a fake clock.
+    """
+    class FakeProcess(object):
+        def __init__(self):
+            self.rss = 1000
+        def memory_info(self):
+            return collections.namedtuple('meminfo', 'rss')(self.rss)
+
+    def setUp(self):
+        self.tuner = AdaptiveBlockTuner( 100, maxConcurrency=4, initialConcurrency=1, ramBudget=10000, sampleSize=2 )
+        self.process = self.FakeProcess()
+        self.tuner._process = self.process
+        self.tuner._baseline_rss = 1000
+        self.clock = FakeClock()
+        self.tuner._clock = self.clock
+        self.tuner._startSample()
+
+    def _feed(self, seconds_per_request):
+        # One sample, with the given time per request.
+        for _ in range(self.tuner.sampleSize):
+            self.clock.advance( seconds_per_request )
+            self.tuner.recordResult( ((0,), (100*self.tuner.mergeFactor,)) )
+
+    def testGrowAndSettle(self):
+        tuner = self.tuner
+        # 1 byte per voxel in flight
+        self.process.rss = 1000 + 100
+        self._feed(0.01)
+        assert tuner.mergeFactor == 2
+
+        # Larger blocks take the same time: Much better throughput.
+        self.process.rss = 1000 + 200*tuner.concurrency
+        self._feed(0.01)
+        assert tuner.mergeFactor == 4
+
+        # Now larger blocks take proportionally longer: No improvement.
+        self.process.rss = 1000 + 400*tuner.concurrency
+        self._feed(0.04)
+        assert tuner.mergeFactor == 2
+        merge_factor = tuner.mergeFactor
+        concurrency = tuner.concurrency
+
+        # No further changes
+        self.process.rss = 1000 + 200*tuner.concurrency
+        self._feed(0.001)
+        assert tuner.mergeFactor == merge_factor
+        assert tuner.concurrency == concurrency
+
+    def testRamBudget(self):
+        tuner = self.tuner
+        # 10 bytes per voxel: 1000 bytes per request, so at most 10 parallel requests fit in the budget.
+        self.process.rss = 1000 + 1000
+        self._feed(0.01)
+        assert tuner.mergeFactor == 2
+        # 2 blocks per request: 2000 bytes per request, 4 requests allowed by maxConcurrency.
+        assert tuner.concurrency == 4
+
+        # Suddenly, the RAM usage exceeds the budget.
+        self.process.rss = 1000 + 20000
+        self._feed(0.001)
+        assert tuner.mergeFactor == 1
+
+        self._feed(0.001)
+        assert tuner.mergeFactor == 1
+        assert tuner.concurrency == 2
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -136,6 +136,63 @@ class TestBlockwiseFileset(object):
             assert self.data[slicing].shape == read_data.shape
             assert (self.data[slicing] == read_data).all(), "Data didn't match."
 
+    def test_4b_SequentialReadsWithReadAhead(self):
+        """
+        Read the dataset slice-by-slice along the z-axis, with read-ahead enabled.
+        """
+        self.bfs.setReadAhead(1)
+        try:
+            for z in range(0, 120, 10):
+                slicing = numpy.s_[:, 50:150, 100:150, z:z+10, :]
+                roi = sliceToRoi( slicing, self.dataShape )
+                read_data = numpy.zeros( tuple(roi[1] - roi[0]), dtype=numpy.uint8 )
+                self.bfs.readData( roi, read_data )
+                assert (self.data[slicing] == read_data).all(), "Data didn't match."
+
+                # The next layer of blocks (along z) is prefetched.
+                if z > 0:
+                    next_block_z = (z // 50 + 1) * 50
+                    prefetched = self.bfs._prefetchedBlocks.keys()
+                    assert (0, 50, 100, next_block_z, 0) in prefetched, \
+                        "Block was not prefetched: {}".format( prefetched )
+                    assert (0, 100, 100, next_block_z, 0) in prefetched
+        finally:
+            self.bfs.setReadAhead(0)
+        assert not self.bfs._prefetchedBlocks
+
+    def test_4c_OpenFilePool(self):
+        """
+        Only a limited number of block files are kept open, and evicted files are unlocked.
+        """
+        self.bfs.setMaxOpenFiles(2)
+        try:
+            stats_before = self.bfs.getOpenFileStats()
+            assert stats_before['open'] <= 2
+
+            slicing = numpy.s_[:, 0:100, 0:100, 0:100, :] # 8 blocks
+            roi = sliceToRoi( slicing, self.dataShape )
+            read_data = self.bfs.readData( roi )
+            assert (self.data[slicing] == read_data).all(), "Data didn't match."
+
+            stats = self.bfs.getOpenFileStats()
+            assert stats['open'] <= 2
+            assert stats['misses'] > stats_before['misses']
+            assert stats['evictions'] > stats_before['evictions']
+
+            # Read the same block twice: The second read is a hit.
+            self.bfs.readData( ([0,0,0,0,0], [1,10,10,10,1]) )
+            hits = self.bfs.getOpenFileStats()['hits']
+            self.bfs.readData( ([0,0,0,0,0], [1,10,10,10,1]) )
+            assert self.bfs.getOpenFileStats()['hits'] == hits + 1
+
+            # The write locks of closed files were released.
+            open_paths = self.bfs._openBlockFiles.keys()
+            for block_start in getIntersectingBlocks( self.bfs.description.block_shape, roi ):
+                path = self.bfs.getDatasetPathComponents( block_start ).externalPath
+                assert self.bfs.isBlockLocked( block_start ) == (path in open_paths)
+        finally:
+            self.bfs.setMaxOpenFiles( BlockwiseFileset.DefaultMaxOpenFiles )
+
     def test_5_TestExportRoi(self):
         roi = ( (0, 25, 25, 25, 0), (1, 75, 75, 75, 1) )
         exportDir = tempfile.mkdtemp()
@@ -0,0 +1,102 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import numpy
+import h5py
+import nose
+
+from lazyflow.operators import compressedBlocks
+from lazyflow.operators.compressedBlocks import Hdf5CompressedBlock, BloscCompressedBlock
+
+class TestHdf5CompressedBlock(object):
+    BlockClass = Hdf5CompressedBlock
+
+    def setUp(self):
+        self.data = numpy.indices( (20, 30, 2), dtype=numpy.uint32 ).sum(0)
+        self.block = self.BlockClass( self.data.shape, self.data.dtype, chunkshape=(10,10,2) )
+
+    def tearDown(self):
+        self.block.close()
+
+    def testZerosByDefault(self):
+        assert self.block.storageSize() >= 0
+        assert (self.block[...] == 0).all()
+        assert self.block[...].shape == self.data.shape
+
+    def testReadWrite(self):
+        block = self.block
+        block[...] = self.data
+        assert (block[...] == self.data).all()
+        assert (block[2:5, 3:30, 1:2] == self.data[2:5, 3:30, 1:2]).all()
+
+        # Partial write
+        block[0:10, 5:7, :] = 42
+        expected = self.data.copy()
+        expected[0:10, 5:7, :] = 42
+        assert (block[:] == expected).all()
+
+        # Compression should actually do something for this data.
+        assert 0 < block.storageSize() < self.data.nbytes
+
+    def testReadInto(self):
+        block = self.block
+        block[...] = self.data
+
+        destination = numpy.zeros( (25, 30, 2), dtype=numpy.uint32 )
+        block.readInto( numpy.s_[0:20, 0:30, 0:2], destination[5:25] )
+        assert (destination[5:25] == self.data).all()
+        assert (destination[:5] == 0).all()
+
+        destination = numpy.zeros( self.data.shape, dtype=numpy.uint32 )
+        block.readInto( numpy.s_[...], destination )
+        assert (destination == self.data).all()
+
+    def testHdf5ImportExport(self):
+        f = h5py.File( 'testCompressedBlocks', driver='core', backing_store=False, mode='w' )
+        try:
+            f.create_dataset( 'source', data=self.data )
+            self.block.importHdf5( f['source'] )
+            assert (self.block[...] == self.data).all()
+
+            self.block.exportHdf5( f, 'exported' )
+            assert (f['exported'][...] == self.data).all()
+        finally:
+            f.close()
+
+class TestBloscCompressedBlock(TestHdf5CompressedBlock):
+    BlockClass = BloscCompressedBlock
+
+    def setUp(self):
+        if not compressedBlocks._blosc_available:
+            raise nose.SkipTest
+        super( TestBloscCompressedBlock, self ).setUp()
+
+    def tearDown(self):
+        if compressedBlocks._blosc_available:
+            super( TestBloscCompressedBlock, self ).tearDown()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
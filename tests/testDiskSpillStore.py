@@ -0,0 +1,110 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import nose
+
+from lazyflow.operators import compressedBlocks
+from lazyflow.operators.diskSpillStore import DiskSpillStore
+
+class TestDiskSpillStore(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = DiskSpillStore()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testDisabledByDefault(self):
+        assert not self.store.enabled()
+        assert self.store.storeBuffer("abc") is None
+        assert self.store.storeArray( numpy.zeros((10,)) ) is None
+
+    def testArrayRoundTrip(self):
+        store = self.store
+        store.configure( 10**6, self.tmpdir )
+        data = numpy.indices( (10,20,30), dtype=numpy.float32 ).sum(0)
+        spilled = store.storeArray( data )
+        assert spilled is not None
+        assert store.usedBytes() == spilled.nbytes > 0
+        assert len(os.listdir(self.tmpdir)) == 1
+
+        out = numpy.ndarray( data.shape, dtype=data.dtype )
+        spilled.readInto( out )
+        assert (out == data).all()
+
+        spilled.discard()
+        assert store.usedBytes() == 0
+        assert len(os.listdir(self.tmpdir)) == 0
+
+    def testBudget(self):
+        store = self.store
+        store.configure( 100, self.tmpdir )
+        first = store.storeBuffer( "x"*60 )
+        assert first is not None
+
+        # Doesn't fit: refused, not evicted.
+        assert store.storeBuffer( "y"*60 ) is None
+        assert first.read() == "x"*60
+
+        first.discard()
+        assert store.storeBuffer( "y"*60 ) is not None
+
+    def testSpillCompressedBlock(self):
+        if not compressedBlocks._blosc_available:
+            raise nose.SkipTest
+        store = self.store
+        store.configure( 10**6, self.tmpdir )
+
+        data = numpy.indices( (20,30), dtype=numpy.uint8 ).sum(0)
+        block = compressedBlocks.BloscCompressedBlock( data.shape, data.dtype )
+        block[...] = data
+        size = block.storageSize()
+        assert block.spill(store) == size
+        assert block.storageSize() == 0
+        assert store.usedBytes() == size
+
+        # Spilled blocks are still readable
+        assert (block[...] == data).all()
+        
+        # Writing to the block brings it back into memory.
+        block[0:10] = 0
+        data[0:10] = 0
+        assert (block[...] == data).all()
+        assert block.storageSize() > 0
+        assert store.usedBytes() == 0
+
+        block.spill(store)
+        block.close()
+        assert store.usedBytes() == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -19,12 +19,16 @@
 # This information is also available on the ilastik web site at:
 #		   http://ilastik.org/license/
 ###############################################################################
+import gc
+import time
 import threading
 import numpy
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.roi import sliceToRoi, roiToSlice
+from lazyflow.rtype import SubRegion
 from lazyflow.operators import OpArrayPiper, OpArrayCache
+from lazyflow.operators.diskSpillStore import DiskSpillStore
 
 class KeyMaker():
     def __getitem__(self, *args):
@@ -255,6 +259,65 @@ class TestOpArrayCache(object):
         assert len(gotDirtyKeys) == 1, \
             "Expected 1 dirty notification, got {}".format( len(gotDirtyKeys) )
 
+    def testReadOnlyAccess(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        slicing = make_key[0:1, 0:10, 10:20, 0:10, 0:1]
+        roi = SubRegion( opCache.Output, pslice=slicing )
+
+        # Not cached yet: computed as usual.
+        data = opCache.Output.get( roi, readonly=True ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == 1
+
+        # Cached: We get a read-only view of the cache instead of a copy.
+        view = opCache.Output.get( roi, readonly=True ).wait()
+        assert (view == self.data[slicing]).all()
+        assert not view.flags.writeable
+        assert numpy.may_share_memory( view, opCache._cache )
+        assert opProvider.accessCount == 1
+
+        # Pipers pass the view through.
+        opPiper = OpArrayPiper( graph=opCache.graph )
+        opPiper.Input.connect( opCache.Output )
+        pipedView = opPiper.Output.get( SubRegion( opPiper.Output, pslice=slicing ), readonly=True ).wait()
+        assert numpy.may_share_memory( pipedView, view )
+
+        # When the cache is updated, the views we already have don't change (copy-on-write).
+        oldData = self.data[slicing].copy()
+        self.data[...] = 0
+        opProvider.Input.setDirty(slice(None))
+        newData = opCache.Output( slicing ).wait()
+        assert (newData == 0).all()
+        assert (view == oldData).all()
+        assert (pipedView == oldData).all()
+        assert not numpy.may_share_memory( view, opCache._cache )
+
+    def testNoFreeWhileReadOnlyViewsInUse(self):
+        opCache = self.opCache
+        slicing = make_key[0:1, 0:10, 10:20, 0:10, 0:1]
+        roi = SubRegion( opCache.Output, pslice=slicing )
+        opCache.Output( slicing ).wait()
+        req = opCache.Output.get( roi, readonly=True )
+        view = req.wait()
+        assert numpy.may_share_memory( view, opCache._cache )
+
+        # The view keeps the memory alive, so nothing can be freed.
+        usedMemory = opCache.usedMemory()
+        assert opCache._freeMemory() == 0
+        assert opCache.usedMemory() == usedMemory
+        assert (view == self.data[slicing]).all()
+
+        # Drop our references to the view (including the request's result).
+        # The worker thread may still hold the finished request for a moment, so wait until the view is gone.
+        req.clean()
+        del req, view
+        timeout = time.time() + 5.0
+        while opCache._readOnlyViewsInUse() and time.time() < timeout:
+            gc.collect()
+            time.sleep(0.01)
+        assert opCache._freeMemory() == usedMemory
+
     def testCleanBlocksSlot(self):
         self.testCacheAccess()
         opCache = self.opCache
@@ -263,6 +326,50 @@ class TestOpArrayCache(object):
         assert [[0, 10, 10, 0, 0], [1, 20, 20, 10, 1]] in clean_block_rois
          
  
+class TestOpArrayCacheDiskSpill(TestOpArrayCache):
+    """
+    Runs the same tests as above, plus tests for spilling to disk.
+    """
+
+    def setUp(self):
+        super( TestOpArrayCacheDiskSpill, self ).setUp()
+        DiskSpillStore.instance.configure( 100*1024**2 )
+
+    def tearDown(self):
+        DiskSpillStore.instance.configure( 0 )
+
+    def testSpillToDisk(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        store = DiskSpillStore.instance
+        used_before = store.usedBytes()
+
+        slicing = make_key[0:1, 0:50, 15:45, 0:10, 0:1]
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == 1
+
+        # Free the cache: The clean blocks are written to disk.
+        assert opCache._freeMemory() > 0
+        assert opCache.usedMemory() == 0
+        assert store.usedBytes() > used_before
+
+        # The data comes back from disk, not from the provider.
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == 1
+        assert store.usedBytes() == used_before
+
+        # Blocks that became dirty while they were on disk must be recomputed.
+        opCache._freeMemory()
+        dirtykey = make_key[0:1, 10:20, 20:30, 0:3, 0:1]
+        self.data[dirtykey] = 0.12345
+        opProvider.Input.setDirty(dirtykey)
+
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == 2
+
 class TestOpArrayCacheWithObjectDtype(object):
     """
     This test is here to convince me that the OpArrayCache can be used with objects as the dtype.
@@ -290,6 +397,11 @@ class TestOpArrayCacheWithObjectDtype(object):
         # Can't use (outputData == data).all() here because vigra doesn't do the right thing if dtype is object.
         for x,y in zip(outputData.flat, data.flat):
             assert x == y
+
+        # Read-only requests fall back to a copy.
+        outputData = op.Output.get( SubRegion( op.Output, pslice=numpy.s_[:] ), readonly=True ).wait()
+        for x,y in zip(outputData.flat, data.flat):
+            assert x == y
         
 class TestOpArrayCache_setInSlot(object):
     
@@ -25,6 +25,7 @@ import vigra
 from lazyflow.graph import Graph
 from lazyflow.roi import sliceToRoi, roiToSlice
 from lazyflow.operators import OpArrayPiper, OpBlockedArrayCache
+from lazyflow.operators.diskSpillStore import DiskSpillStore
 
 class KeyMaker():
     def __getitem__(self, *args):
@@ -38,11 +39,13 @@ class OpArrayPiperWithAccessCount(OpArrayPiper):
     def __init__(self, *args, **kwargs):
         super(OpArrayPiperWithAccessCount, self).__init__(*args, **kwargs)
         self.accessCount = 0
+        self.requests = []
         self._lock = threading.Lock()
     
     def execute(self, slot, subindex, roi, result):
         with self._lock:
             self.accessCount += 1        
+            self.requests.append( (tuple(roi.start), tuple(roi.stop)) )
         super(OpArrayPiperWithAccessCount, self).execute(slot, subindex, roi, result)
         
 
@@ -303,6 +306,68 @@ class TestOpBlockedArrayCache(object):
         assert opProvider.accessCount <= maxAccess
         oldAccessCount = opProvider.accessCount
 
+    def testFreeBlocks(self):
+        opCache = self.opCache
+        opProvider = self.opProvider        
+
+        slicing = make_key[:, 0:50, 15:45, 0:10, :]
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        oldAccessCount = opProvider.accessCount
+        
+        # Blocks are freed individually (as the memory manager would do it)
+        assert len(opCache._blocks) == 9
+        usedMemory = opCache.usedMemory()
+        block = opCache._blocks.values()[0]
+        freed = block._freeMemory()
+        assert freed > 0
+        assert opCache.usedMemory() == usedMemory - freed
+        
+        # Only the freed block must be requested again.
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == oldAccessCount + 1, \
+            "Access count={}, expected={}".format(opProvider.accessCount, oldAccessCount + 1)
+
+    def testCleanInnerBlocksNotRecomputed(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+
+        # Make two diagonal inner blocks of the first outer block clean
+        opCache.Output( make_key[:, 0:10, 0:10, 0:10, :] ).wait()
+        opCache.Output( make_key[:, 10:20, 10:20, 0:10, :] ).wait()
+        opProvider.requests = []
+
+        # The request's bounding box covers the clean inner blocks, 
+        #  but only the two dirty ones must be requested.
+        slicing = make_key[:, 0:20, 0:20, 0:10, :]
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        requested = sorted( opProvider.requests )
+        assert requested == [ ((0, 0, 10, 0, 0), (1, 10, 20, 10, 1)), 
+                              ((0, 10, 0, 0, 0), (1, 20, 10, 10, 1)) ], requested
+
+    def testSpillBlocks(self):
+        opCache = self.opCache
+        opProvider = self.opProvider        
+        DiskSpillStore.instance.configure( 100*1024**2 )
+        try:
+            slicing = make_key[:, 0:50, 15:45, 0:10, :]
+            data = opCache.Output( slicing ).wait()
+            oldAccessCount = opProvider.accessCount
+
+            for block in opCache._blocks.values():
+                assert block._freeMemory() > 0
+            assert opCache.usedMemory() == 0
+
+            # Spilled blocks are read back from disk, not recomputed
+            data = opCache.Output( slicing ).wait()
+            assert (data == self.data[slicing]).all()
+            assert opProvider.accessCount == oldAccessCount, \
+                "Access count={}, expected={}".format(opProvider.accessCount, oldAccessCount)
+        finally:
+            DiskSpillStore.instance.configure( 0 )
+
 if __name__ == "__main__":
     import sys
     import nose
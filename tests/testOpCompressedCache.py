@@ -20,15 +20,22 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 import sys
+import shutil
 import logging
+import tempfile
 import threading
 import functools
 
 import numpy
 import vigra
+import nose
 
 from lazyflow.graph import Graph
 from lazyflow.operators import OpCompressedCache, OpArrayPiper
+from lazyflow.operators import compressedBlocks
+from lazyflow.operators.compressedBlocks import Hdf5CompressedBlock
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
+from lazyflow.operators.diskSpillStore import DiskSpillStore
 from lazyflow.utility.slicingtools import slicing2shape
 
 logger = logging.getLogger("tests.testOpCompressedCache")
@@ -299,6 +306,79 @@ class TestOpCompressedCache( object ):
         #logger.debug("Checking data...")    
         assert (readData == expectedData).all(), "Incorrect output!"
         
+class TestOpCompressedCacheHdf5Blocks( TestOpCompressedCache ):
+    """
+    Same tests as above, but store the blocks in hdf5 (regardless of whether or not blosc is available).
+    """
+    def setUp(self):
+        OpCompressedCache.BlockClass = Hdf5CompressedBlock
+
+    def tearDown(self):
+        OpCompressedCache.BlockClass = None
+
+class TestOpCompressedCacheSpilling( object ):
+    """
+    Check the interaction of the cache with the memory manager and the DiskSpillStore.
+    """
+    def setUp(self):
+        if not compressedBlocks._blosc_available:
+            raise nose.SkipTest
+        self.tmpdir = tempfile.mkdtemp()
+
+        sampleData = numpy.indices((100, 200), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xy')
+        self.sampleData = sampleData
+
+        graph = Graph()
+        self.opData = OpArrayPiper( graph=graph )
+        self.opData.Input.setValue( sampleData )
+
+        self.op = OpCompressedCache( graph=graph )
+        # Use a private memory manager (not started) and spill store
+        self.op._memory_manager = ArrayCacheMemoryMgr()
+        self.op._spill_store = DiskSpillStore()
+        self.op.BlockShape.setValue( (50, 50) )
+        self.op.Input.connect( self.opData.Output )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testNotEvictableWithoutSpillStore(self):
+        op = self.op
+        assert (op.Output[:].wait() == self.sampleData.view(numpy.ndarray)).all()
+        assert op.usedMemory() > 0
+
+        # Blocks can't be evicted, so they mustn't count towards the cache budget.
+        assert op._memory_manager.totalCacheBytes() == 0
+        assert op not in op._memory_manager._heap_entries
+        assert op._freeMemory() == 0
+
+    def testSpillAndRestore(self):
+        op = self.op
+        op._spill_store.configure( 10**7, self.tmpdir )
+        op.Output[:].wait()
+        used_memory = op.usedMemory()
+        assert used_memory > 0
+        assert op._memory_manager.totalCacheBytes() == used_memory
+        assert op in op._memory_manager._heap_entries
+
+        assert op._freeMemory() == used_memory
+        assert op.usedMemory() == 0
+        assert op._memory_manager.totalCacheBytes() == 0
+        assert op._spill_store.usedBytes() > 0
+
+        # Reading a block loads it back into memory (and deletes its spill file).
+        assert (op.Output[0:50, 0:50].wait() == self.sampleData[0:50, 0:50].view(numpy.ndarray)).all()
+        block = op._cacheFiles[(0,0)]
+        assert not block.isSpilled()
+        assert op._memory_manager.totalCacheBytes() == block.storageSize() > 0
+
+        # The rest is restored, too.
+        assert (op.Output[:].wait() == self.sampleData.view(numpy.ndarray)).all()
+        assert op.usedMemory() == used_memory
+        assert op._memory_manager.totalCacheBytes() == used_memory
+        assert op._spill_store.usedBytes() == 0
 
 if __name__ == "__main__":
     # Set up logging for debug
@@ -2,7 +2,7 @@ import numpy
 import vigra
 
 from lazyflow.graph import Graph
-from lazyflow.operators.opFeatureMatrixCache import OpFeatureMatrixCache
+from lazyflow.operators.opFeatureMatrixCache import OpFeatureMatrixCache, _BlockRowMatrix
 
 class TestOpFeatureMatrixCache(object):
     
@@ -52,6 +52,150 @@ class TestOpFeatureMatrixCache(object):
         for feature_vec in [[10.5, 10.5], [10.5, 11.5], [20.5, 20.5], [20.5, 21.5]]:
             assert feature_vec in labels_and_features[:,1:]
 
+    def testIncrementalUpdate(self):
+        features = numpy.indices( (100,100) ).astype(numpy.float32) + 0.5
+        features = numpy.rollaxis(features, 0, 3)
+        features = vigra.taggedView(features, 'xyc')
+        labels = numpy.zeros( (100,100,1), dtype=numpy.uint8 )
+        labels = vigra.taggedView(labels, 'xyc')
+        
+        graph = Graph()
+        opFeatureMatrixCache = OpFeatureMatrixCache(graph=graph)
+        opFeatureMatrixCache.FeatureImage.setValue(features)
+        opFeatureMatrixCache.LabelImage.setValue(labels)
+        opFeatureMatrixCache.NonZeroLabelBlocks.setValue(0)
+
+        def check_matrix( expected_rows ):
+            labels_and_features = opFeatureMatrixCache.LabelAndFeatureMatrix.value
+            assert labels_and_features.shape == (len(expected_rows), 3), \
+                "Feature matrix has wrong shape: {}".format( labels_and_features.shape )
+            # Rows can be in any order
+            assert sorted( map(list, labels_and_features) ) == sorted( expected_rows )
+
+        labels[10,10] = 1
+        labels[20,20] = 2
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[10:11, 10:11] )
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[20:21, 20:21] )
+        check_matrix( [[1, 10.5, 10.5], [2, 20.5, 20.5]] )
+
+        # Grow one block
+        labels[10,11] = 1
+        labels[11,10] = 2
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[10:12, 10:12] )
+        check_matrix( [[1, 10.5, 10.5], [1, 10.5, 11.5], [2, 11.5, 10.5], [2, 20.5, 20.5]] )
+
+        # Shrink the other block, then remove it entirely
+        labels[20,20] = 1
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[20:21, 20:21] )
+        check_matrix( [[1, 10.5, 10.5], [1, 10.5, 11.5], [2, 11.5, 10.5], [1, 20.5, 20.5]] )
+
+        labels[20,20] = 0
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[20:21, 20:21] )
+        check_matrix( [[1, 10.5, 10.5], [1, 10.5, 11.5], [2, 11.5, 10.5]] )
+
+        labels[:] = 0
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[:, :] )
+        check_matrix( [] )
+
+    def testOutputUnchangedByNextUpdate(self):
+        features = numpy.indices( (100,100) ).astype(numpy.float32) + 0.5
+        features = numpy.rollaxis(features, 0, 3)
+        features = vigra.taggedView(features, 'xyc')
+        labels = numpy.zeros( (100,100,1), dtype=numpy.uint8 )
+        labels = vigra.taggedView(labels, 'xyc')
+
+        graph = Graph()
+        opFeatureMatrixCache = OpFeatureMatrixCache(graph=graph)
+        opFeatureMatrixCache.FeatureImage.setValue(features)
+        opFeatureMatrixCache.LabelImage.setValue(labels)
+        opFeatureMatrixCache.NonZeroLabelBlocks.setValue(0)
+
+        labels[10,10] = 1
+        labels[20,20] = 2
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[10:11, 10:11] )
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[20:21, 20:21] )
+        first_matrix = opFeatureMatrixCache.LabelAndFeatureMatrix.value
+        first_rows = sorted( map(list, first_matrix) )
+
+        # Patch one block in place, and remove the other one.
+        # Whoever still holds the first matrix (e.g. a classifier in training) must not see the changes.
+        labels[10,10] = 2
+        labels[20,20] = 0
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[10:11, 10:11] )
+        opFeatureMatrixCache.LabelImage.setDirty( numpy.s_[20:21, 20:21] )
+        second_matrix = opFeatureMatrixCache.LabelAndFeatureMatrix.value
+        assert sorted( map(list, second_matrix) ) == [[2, 10.5, 10.5]]
+        assert sorted( map(list, first_matrix) ) == first_rows
+
+class TestBlockRowMatrix(object):
+
+    def testUpdate(self):
+        block_rows = _BlockRowMatrix(2)
+        assert block_rows.matrix().shape == (0,2)
+
+        a = numpy.array( [[1,1], [1,2], [1,3]], dtype=numpy.float32 )
+        b = numpy.array( [[2,1], [2,2]], dtype=numpy.float32 )
+        block_rows.update( 'a', a )
+        block_rows.update( 'b', b )
+        assert (block_rows.matrix() == numpy.concatenate( (a,b) )).all()
+
+        # Fewer rows: Patched in place
+        a = a[:2] + 10
+        block_rows.update( 'a', a )
+        assert (block_rows.matrix() == numpy.concatenate( (a,b) )).all()
+
+        # The last block can grow in place
+        b = numpy.concatenate( (b,b) )
+        block_rows.update( 'b', b )
+        assert (block_rows.matrix() == numpy.concatenate( (a,b) )).all()
+
+        # Other blocks are moved to the end when they grow
+        a = numpy.concatenate( (a,a,a) )
+        block_rows.update( 'a', a )
+        assert (block_rows.matrix() == numpy.concatenate( (b,a) )).all()
+
+        block_rows.update( 'a', numpy.zeros( (0,2), dtype=numpy.float32 ) )
+        assert len(block_rows) == 1
+        assert (block_rows.matrix() == b).all()
+
+    def testCopyOnWrite(self):
+        block_rows = _BlockRowMatrix(2)
+        a = numpy.array( [[1,1], [1,2], [1,3]], dtype=numpy.float32 )
+        b = numpy.array( [[2,1], [2,2]], dtype=numpy.float32 )
+        block_rows.update( 'a', a )
+        block_rows.update( 'b', b )
+        first_matrix = block_rows.matrix()
+        first_copy = first_matrix.copy()
+
+        # Patched in place, grown in place, and moved (then compacted)
+        block_rows.update( 'a', a[:1] + 10 )
+        block_rows.update( 'b', numpy.concatenate( (b,b) ) )
+        block_rows.update( 'a', numpy.concatenate( (a,a,a) ) )
+        second_matrix = block_rows.matrix()
+        assert (first_matrix == first_copy).all()
+        assert (second_matrix == numpy.concatenate( (b, b, a, a, a) )).all()
+
+        # Without a new matrix() in between, the storage is only copied once
+        second_copy = second_matrix.copy()
+        block_rows.update( 'b', b[:1] )
+        block_rows.update( 'b', b[:1] + 1 )
+        assert (second_matrix == second_copy).all()
+        assert (block_rows.matrix() == numpy.concatenate( (b[:1] + 1, a, a, a) )).all()
+
+    def testGrowth(self):
+        block_rows = _BlockRowMatrix(3)
+        blocks = {}
+        for i in range(100):
+            blocks[i] = numpy.random.random( (i % 7 * 100, 3) ).astype(numpy.float32)
+            block_rows.update( i, blocks[i] )
+        for i in range(0, 100, 3):
+            blocks[i] = blocks[i][:50]
+            block_rows.update( i, blocks[i] )
+
+        total_matrix = block_rows.matrix()
+        assert total_matrix.shape == (sum( len(m) for m in blocks.values() ), 3)
+        assert sorted( map(tuple, total_matrix) ) == sorted( map(tuple, numpy.concatenate( blocks.values() )) )
+
 
 if __name__ == "__main__":
     import sys
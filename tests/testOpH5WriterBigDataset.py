@@ -181,6 +181,70 @@ class TestOpH5WriterBigDataset_3(object):
         assert numpy.all( dataset[...] == self.testData.view(numpy.ndarray)[...] )
         f.close()
 
+class TestOpH5WriterBigDataset_ChunkWrites(object):
+    """
+    Checks the parallel, chunk-aligned writing mode (with and without compression) 
+    for data whose shape isn't a multiple of the chunkshape.
+    """
+
+    def setUp(self):
+        self.graph = lazyflow.graph.Graph()
+        self.testDataFileName = 'bigH5TestData.h5'
+        self.datasetInternalPath = 'volume/data'
+
+        # Generate some test data
+        self.dataShape = (2, 37, 101, 53, 3)
+        self.testData = vigra.VigraArray( self.dataShape, dtype=numpy.float32, axistags=vigra.defaultAxistags('txyzc'), order='C' )
+        self.testData[...] = numpy.random.random(self.dataShape)
+
+    def tearDown(self):
+        # Clean up: Delete the test file.
+        try:
+            os.remove(self.testDataFileName)
+        except:
+            pass
+
+    def _checkWriter(self, compression, parallelChunkWrites, ram_usage_per_requested_pixel=None):
+        hdf5File = h5py.File(self.testDataFileName, 'w')
+
+        opPiper = OpArrayPiper(graph=self.graph)
+        opPiper.Input.setValue( self.testData )
+        if ram_usage_per_requested_pixel is not None:
+            opPiper.Output.meta.ram_usage_per_requested_pixel = ram_usage_per_requested_pixel
+
+        opWriter = OpH5WriterBigDataset(graph=self.graph)
+        opWriter.hdf5File.setValue( hdf5File )
+        opWriter.hdf5Path.setValue( self.datasetInternalPath )
+        opWriter.CompressionEnabled.setValue( compression )
+        opWriter.ParallelChunkWrites.setValue( parallelChunkWrites )
+        opWriter.Image.connect( opPiper.Output )
+
+        success = opWriter.WriteImage.value
+        assert success
+        assert (numpy.array(self.dataShape) % opWriter.chunkShape != 0).any(), \
+            "Test data should have partial chunks at the edges."
+        hdf5File.close()
+
+        f = h5py.File(self.testDataFileName, 'r')
+        dataset = f[self.datasetInternalPath]
+        assert dataset.shape == self.dataShape
+        assert (dataset.compression == 'gzip') == compression
+        assert numpy.all( dataset[...] == self.testData.view(numpy.ndarray)[...] )
+        f.close()
+
+    def testCompressed(self):
+        self._checkWriter( compression=True, parallelChunkWrites=True )
+
+    def testUncompressed(self):
+        self._checkWriter( compression=False, parallelChunkWrites=True )
+
+    def testSmallBlocks(self):
+        # Pretend the RAM usage will be really high to force single-chunk blocks
+        self._checkWriter( compression=True, parallelChunkWrites=True, ram_usage_per_requested_pixel=1000000.0 )
+
+    def testSerialWrites(self):
+        self._checkWriter( compression=True, parallelChunkWrites=False )
+
 if __name__ == "__main__":
     # Set up logging for debug
     logHandler = logging.StreamHandler( sys.stdout )
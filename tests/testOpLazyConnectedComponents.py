@@ -30,6 +30,7 @@ from numpy.testing import assert_array_equal, assert_array_almost_equal
 from lazyflow.utility.testing import assertEquivalentLabeling
 from lazyflow.operators.opLazyConnectedComponents\
     import OpLazyConnectedComponents as OpLazyCC
+from lazyflow.operators.opLazyConnectedComponents import UnionFindArray
 
 from lazyflow.graph import Graph
 from lazyflow.operator import Operator
@@ -463,6 +464,39 @@ class TestOpLazyCC(unittest.TestCase):
             "Got {} clean blocks (expected {}".format(len(blocks), 100)
 
 
+class TestUnionFindArray(unittest.TestCase):
+
+    def testBulkUnion(self):
+        n = 5000
+        uf = UnionFindArray(np.uint32(1))
+        offset = uf.makeNewIndices(n)
+        assert offset == 1
+        labels = np.arange(1, n+1, dtype=np.uint32)
+
+        # join labels into chains modulo 7, in random order
+        a = labels[7:].copy()
+        b = labels[:-7].copy()
+        perm = np.random.permutation(len(a))
+        uf.makeUnions(a[perm], b[perm])
+
+        roots = uf.findIndices(labels)
+        assert_array_equal(roots, (labels - 1) % 7 + 1)
+        for label in (1, 8, 4999, 5000):
+            assert uf.findIndex(label) == (label - 1) % 7 + 1
+
+        # join two of the chains with a scalar union
+        uf.makeUnion(5000, 4999)
+        assert uf.findIndex(5000) == min((5000 - 1) % 7 + 1, (4999 - 1) % 7 + 1)
+
+    def testGrow(self):
+        uf = UnionFindArray(np.uint32(1))
+        for i in range(3000):
+            assert uf.makeNewIndex() == i + 1
+        uf.makeUnion(1, 3000)
+        assert uf.findIndex(3000) == 1
+        assert uf.findIndex(0) == 0
+
+
 class OpExecuteCounter(OpArrayPiper):
 
     def __init__(self, *args, **kwargs):
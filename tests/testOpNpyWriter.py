@@ -20,16 +20,52 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 import os
+import time
 import tempfile
 import shutil
+import threading
 
 import numpy
 import vigra
 
+import lazyflow
 from lazyflow.graph import Graph
+from lazyflow.request import Request
 from lazyflow.operators import OpArrayPiper
 from lazyflow.operators.ioOperators import OpInputDataReader, OpNpyWriter
 
+class OpCountingPiper(OpArrayPiper):
+    """
+    Counts the blocks that have been computed.
+    """
+    def __init__(self, *args, **kwargs):
+        super( OpCountingPiper, self ).__init__( *args, **kwargs )
+        self.lock = threading.Lock()
+        self.computed = 0
+
+    def execute(self, slot, subindex, roi, result):
+        super( OpCountingPiper, self ).execute( slot, subindex, roi, result )
+        with self.lock:
+            self.computed += 1
+        return result
+
+class OpSlowNpyWriter(OpNpyWriter):
+    """
+    Writes slowly, and records how far the computation got ahead of the file.
+    """
+    def __init__(self, opCounter, *args, **kwargs):
+        super( OpSlowNpyWriter, self ).__init__( *args, **kwargs )
+        self.opCounter = opCounter
+        self.written = 0
+        self.max_backlog = 0
+
+    def _writeBlock(self, f, data):
+        time.sleep(0.002)
+        with self.opCounter.lock:
+            self.max_backlog = max( self.max_backlog, self.opCounter.computed - self.written )
+        super( OpSlowNpyWriter, self )._writeBlock( f, data )
+        self.written += 1
+
 class TestOpNpyWriter(object):
     
     @classmethod
@@ -64,6 +100,39 @@ class TestOpNpyWriter(object):
         
         opRead.cleanUp()
 
+    def testSlowFile(self):
+        """
+        If the file is slower than the computation, the number of blocks that have been 
+        computed but not yet written must stay bounded by the number of threads.
+        """
+        data = numpy.random.random( (200,100) ).astype( numpy.float32 )
+        data = vigra.taggedView( data, vigra.defaultAxistags('xy') )
+
+        graph = Graph()
+        opCounter = OpCountingPiper( graph=graph )
+        opCounter.Input.setValue(data)
+
+        opWriter = OpSlowNpyWriter( opCounter, graph=graph )
+        opWriter.Input.connect( opCounter.Output )
+        opWriter.Filepath.setValue( self._tmpdir + '/npy_writer_slow_test_output.npy' )
+
+        # Pretend there's very little RAM, so the data is written in many small blocks.
+        original_ram_mb = lazyflow.AVAILABLE_RAM_MB
+        lazyflow.AVAILABLE_RAM_MB = 1
+        try:
+            opWriter.write()
+        finally:
+            lazyflow.AVAILABLE_RAM_MB = original_ram_mb
+
+        num_threads = max(1, Request.global_thread_pool.num_workers)
+        assert opWriter.written >= 4*num_threads, "Test data wasn't split into enough blocks: {}".format( opWriter.written )
+        # (One block is being written, plus one block per thread.)
+        assert opWriter.max_backlog <= num_threads + 1, \
+            "{} blocks were waiting to be written, with {} threads".format( opWriter.max_backlog, num_threads )
+
+        read_data = numpy.load( opWriter.Filepath.value )
+        assert (read_data == data.view(numpy.ndarray)).all(), "Read data didn't match exported data!"
+
 if __name__ == "__main__":
     import sys
     import nose
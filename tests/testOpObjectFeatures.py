@@ -0,0 +1,84 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import numpy
+import vigra
+from numpy.testing import assert_array_almost_equal
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpObjectFeatures
+
+class TestOpObjectFeaturesBlockwise(object):
+
+    def setUp(self):
+        self.features = ["Count", "Sum", "Mean", "Variance", "Minimum", "Maximum",
+                         "Coord<Minimum>", "Coord<Maximum>", "RegionCenter"]
+        self.image = numpy.random.random((40, 30, 20)).astype(numpy.float32)
+        self.labels = numpy.random.randint(0, 20, (40, 30, 20)).astype(numpy.uint32)
+        # an object that is spread over several blocks
+        self.labels[5:35, 3:25, 2:18] = 21
+
+    def testBlockwiseMatchesWholeImage(self):
+        op = OpObjectFeatures( graph=Graph() )
+        op.Image.setValue( self.image )
+        op.Labels.setValue( self.labels )
+        op.SelectedFeatures.setValue( self.features )
+        op.BlockShape.setValue( (16, 16, 8) )
+        features = op.FeatureDict[:].wait()[0]
+
+        expected = vigra.analysis.extractRegionFeatures( self.image, self.labels, self.features )
+        for name in self.features:
+            assert len(features[name]) == 1, "Expected one array per image channel"
+            assert_array_almost_equal( features[name][0], expected[name], 3 )
+
+    def testSparseLabels(self):
+        # Each block holds only a few of the labels, which are far apart
+        labels = self.labels * 1000
+        op = OpObjectFeatures( graph=Graph() )
+        op.Image.setValue( self.image )
+        op.Labels.setValue( labels )
+        op.SelectedFeatures.setValue( self.features )
+        op.BlockShape.setValue( (7, 5, 3) )
+        features = op.FeatureDict[:].wait()[0]
+
+        expected = vigra.analysis.extractRegionFeatures( self.image, labels, self.features )
+        for name in self.features:
+            assert_array_almost_equal( features[name][0], expected[name], 3 )
+
+    def testUnsupportedFeature(self):
+        op = OpObjectFeatures( graph=Graph() )
+        op.Image.setValue( self.image )
+        op.Labels.setValue( self.labels )
+        op.BlockShape.setValue( (16, 16, 8) )
+        try:
+            op.SelectedFeatures.setValue( ["Quantiles"] )
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected a ValueError for a feature that can't be computed blockwise"
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,188 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import math
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from lazyflow.roi import extendSlice
+from lazyflow.operators import OpPixelFeaturesPresmoothed, OpPixelFeaturesSharedDerivatives
+from numpy.testing import assert_array_almost_equal
+
+class _FeatureOperatorTest(object):
+
+    def _createOperator(self, data, opType=OpPixelFeaturesPresmoothed):
+        op = opType( graph=Graph() )
+        op.Input.setValue( data )
+        op.Scales.setValue( self.scales )
+        op.FeatureIds.setValue( self.featureIds )
+        op.Matrix.setValue( self.matrix )
+        return op
+
+class TestOpPixelFeaturesPresmoothed(_FeatureOperatorTest):
+
+    def setUp(self):
+        # Includes scales that are presmoothed by cascading (see OpPixelFeaturesPresmoothed._cascadedSmoothing)
+        self.scales = [0.3, 0.7, 1.0, 1.6, 3.5, 5.0]
+        self.featureIds = [ 'GaussianSmoothing', 'GaussianGradientMagnitude' ]
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+
+        data = (numpy.random.random((3, 60, 50, 1)) * 100).astype(numpy.float32)
+        self.data_txyc = vigra.taggedView( data, 'txyc' )
+
+    def testTimeSlicesMatchSeparateImages(self):
+        features_txyc = self._createOperator( self.data_txyc ).Output[:].wait()
+        for t in range( self.data_txyc.shape[0] ):
+            data_xyc = vigra.taggedView( self.data_txyc[t].view(numpy.ndarray), 'xyc' )
+            features_xyc = self._createOperator( data_xyc ).Output[:].wait()
+            assert_array_almost_equal( features_txyc[t], features_xyc, 3 )
+
+    def testSubregionMatchesWholeImage(self):
+        data_xyc = vigra.taggedView( self.data_txyc[0].view(numpy.ndarray), 'xyc' )
+        op = self._createOperator( data_xyc )
+        features = op.Output[:].wait()
+        for roi in [ (slice(0, 20), slice(0, 50)),
+                     (slice(20, 40), slice(15, 35)) ]:
+            subregion = op.Output[roi + (slice(None),)].wait()
+            assert_array_almost_equal( features[roi], subregion, 1 )
+
+class TestCascadedSmoothing(object):
+    """
+    Cascaded presmoothing must stay close to smoothing the raw input
+    directly with each presmoothing sigma (as OpPixelFeaturesPresmoothed used to).
+    """
+
+    # Sampled Gaussians don't compose exactly.  For data in [0,100), the
+    # cascade differs from direct smoothing by about 1e-2 at most.
+    TOLERANCE = 0.05
+
+    def setUp(self):
+        self.op = OpPixelFeaturesPresmoothed( graph=Graph() )
+
+        # The presmoothing sigmas for these scales (see OpPixelFeaturesPresmoothed.execute).
+        # The last three of them form a cascade, the others are computed from the input.
+        self.scales = [0.3, 0.7, 1.0, 1.6, 3.5, 5.0]
+        self.presmoothSigmas = []
+        for j, scale in enumerate(self.scales):
+            if scale > 1.0:
+                self.presmoothSigmas.append( (j, math.sqrt(scale**2 - 1.0)) )
+            else:
+                self.presmoothSigmas.append( (j, scale) )
+
+        data = (numpy.random.random((90, 80, 1)) * 100).astype(numpy.float32)
+        self.data_xyc = vigra.taggedView( data, 'xyc' )
+
+    def _checkDirectSmoothing(self, source, droi):
+        smoothed = self.op._cascadedSmoothing( source, self.presmoothSigmas, droi )
+        assert sorted(smoothed.keys()) == range(len(self.scales))
+        for j, sigma in self.presmoothSigmas:
+            expected = vigra.filters.gaussianSmoothing( source, sigma=sigma, roi=droi, window_size=self.op.WINDOW_SIZE )
+            assert smoothed[j].shape == expected.shape
+            difference = numpy.abs( smoothed[j] - expected ).max()
+            assert difference < self.TOLERANCE, \
+                "Cascaded smoothing with sigma={} differs from direct smoothing by {}".format( sigma, difference )
+
+    def _clippedSource(self, start, stop):
+        """
+        Return the part of the data that execute() would presmooth for the given block
+        (i.e. the block, plus the margin for the largest scale, clipped to the image),
+        and the block's roi within that source.
+        """
+        start, stop = numpy.array(start), numpy.array(stop)
+        sourceStart, sourceStop = extendSlice( start, stop, self.data_xyc.shape[:-1], max(self.scales), self.op.WINDOW_SIZE )
+        source = self.data_xyc[ tuple(slice(a, b) for a, b in zip(sourceStart, sourceStop)) ]
+        droi = ( tuple(start - sourceStart), tuple(stop - sourceStart) )
+        return source, droi
+
+    def testWholeImage(self):
+        self._checkDirectSmoothing( self.data_xyc, ((0, 0), (90, 80)) )
+
+    def testInteriorBlock(self):
+        self._checkDirectSmoothing( self.data_xyc, ((30, 25), (60, 55)) )
+
+    def testBorderBlock(self):
+        self._checkDirectSmoothing( self.data_xyc, ((0, 60), (20, 80)) )
+
+    def testClippedSource(self):
+        # The source only includes the margin for the largest scale.
+        # (The cascade's combined kernels are wider than that margin.)
+        source, droi = self._clippedSource( (30, 25), (60, 55) )
+        assert (numpy.array(source.shape[:-1]) < self.data_xyc.shape[:-1]).all()
+        self._checkDirectSmoothing( source, droi )
+
+    def testClippedSourceAtBorder(self):
+        # The margin is clipped by the image border on some sides.
+        source, droi = self._clippedSource( (0, 60), (20, 80) )
+        self._checkDirectSmoothing( source, droi )
+
+    def test3d(self):
+        data = (numpy.random.random((40, 40, 40, 1)) * 100).astype(numpy.float32)
+        data_xyzc = vigra.taggedView( data, 'xyzc' )
+        self._checkDirectSmoothing( data_xyzc, ((0, 0, 0), (40, 40, 40)) )
+        self._checkDirectSmoothing( data_xyzc, ((10, 0, 25), (30, 15, 40)) )
+
+class TestOpPixelFeaturesSharedDerivatives(_FeatureOperatorTest):
+
+    def setUp(self):
+        self.scales = [0.7, 1.6, 3.5]
+        self.featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+
+    def _checkSameFeatures(self, data, key=slice(None)):
+        outputs = []
+        for opType in (OpPixelFeaturesPresmoothed, OpPixelFeaturesSharedDerivatives):
+            op = self._createOperator( data, opType )
+            outputs.append( op.Output[key].wait() )
+        assert outputs[0].shape == outputs[1].shape
+        assert_array_almost_equal( outputs[0], outputs[1], 1 )
+
+    def test2d(self):
+        data = (numpy.random.random((60, 50, 2)) * 100).astype(numpy.float32)
+        data = vigra.taggedView( data, 'xyc' )
+        self._checkSameFeatures( data )
+        # Only some of the channels, and a subregion
+        self._checkSameFeatures( data, (slice(10, 40), slice(5, 30), slice(3, 17)) )
+
+    def test3dWithTime(self):
+        data = (numpy.random.random((2, 30, 30, 20, 1)) * 100).astype(numpy.float32)
+        data = vigra.taggedView( data, 'txyzc' )
+        self._checkSameFeatures( data )
+
+    def testStructureTensorWithoutGradientMagnitude(self):
+        # Without the gradient magnitude, the structure tensor computes
+        # the gradient (with the margin for its outer scale) on its own.
+        self.featureIds = [ 'GaussianSmoothing', 'StructureTensorEigenvalues', 'HessianOfGaussianEigenvalues' ]
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+
+        data = (numpy.random.random((60, 50, 2)) * 100).astype(numpy.float32)
+        data = vigra.taggedView( data, 'xyc' )
+        self._checkSameFeatures( data )
+        # Subregions in the interior and at the image border
+        self._checkSameFeatures( data, (slice(20, 40), slice(15, 35), slice(None)) )
+        self._checkSameFeatures( data, (slice(0, 15), slice(40, 50), slice(2, 9)) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -71,6 +71,30 @@ class TestOpStackLoader(object):
         
         assert ( vol_from_stack_zyx == expected_volume_zyx ).all(), "3D Volume from stack did not match expected data."
 
+    def test_xyz_slice_cache(self):
+        expected_volume_zyx, globstring = self._prepare_data_zyx()
+        
+        graph = Graph()
+        op = OpStackLoader( graph=graph )
+        op.globstring.setValue( globstring )
+        op.SliceCacheMB.setValue( 1 )
+        
+        # Request a few xz planes: each one touches every file in the stack.
+        for y in (10, 11, 50):
+            xz_from_stack = op.stack[:, y:y+1, :, :].wait()
+            xz_from_stack = vigra.taggedView( xz_from_stack, 'zyxc' ).withAxes( *'zyx' )
+            assert ( xz_from_stack == expected_volume_zyx[:, y:y+1, :] ).all(), "xz plane from stack did not match expected data."
+        
+        assert len(op._slice_cache) == expected_volume_zyx.shape[0]
+        
+        # Disabling the cache discards the cached slices.
+        op.SliceCacheMB.setValue( 0 )
+        assert len(op._slice_cache) == 0
+        xz_from_stack = op.stack[:, 10:11, :, :].wait()
+        xz_from_stack = vigra.taggedView( xz_from_stack, 'zyxc' ).withAxes( *'zyx' )
+        assert ( xz_from_stack == expected_volume_zyx[:, 10:11, :] ).all(), "xz plane from stack did not match expected data."
+        assert len(op._slice_cache) == 0
+
     def _prepare_data_tzyx(self):
         file_base = self._tmp_dir + "/rand_4d"
         
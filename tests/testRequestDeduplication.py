@@ -0,0 +1,220 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import time
+
+import numpy
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.request import RequestLock
+
+class OpGatedPiper(Operator):
+    """
+    Copies its input, but blocks each execute() call until the gate is opened.
+    (The gate is a RequestLock, so waiting doesn't block the worker threads.)
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpGatedPiper, self).__init__(*args, **kwargs)
+        self.gate = RequestLock()
+        self.gate.acquire()
+        self.executedRois = []
+        self.fail = False
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        self.executedRois.append( (tuple(roi.start), tuple(roi.stop)) )
+        with self.gate:
+            pass
+        if self.fail:
+            raise RuntimeError("Intentional failure")
+        self.Input(roi.start, roi.stop).writeInto(result).wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class TestRequestDeduplication(object):
+
+    def setUp(self):
+        self.data = numpy.random.randint(0, 255, (20, 30)).astype(numpy.uint8)
+        self.op = OpGatedPiper(graph=Graph())
+        self.op.Input.setValue(self.data)
+
+    def tearDown(self):
+        # Never leave a request blocked.
+        if self.op.gate.locked():
+            self.op.gate.release()
+
+    def _waitForFollowers(self, count):
+        registry = self.op.Output._inflight_registry
+        timeout = time.time() + 10.0
+        while time.time() < timeout:
+            if sum( e.followers for e in registry._entries.values() ) >= count:
+                return
+            time.sleep(0.001)
+        assert False, "Requests never joined the running computation."
+
+    def _waitForExecutions(self, count):
+        timeout = time.time() + 10.0
+        while len(self.op.executedRois) < count:
+            assert time.time() < timeout, "Request never started executing."
+            time.sleep(0.001)
+
+    def testIdentical(self):
+        self.op.Output.setRequestDeduplication('identical')
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[2:10, 5:20]
+        req2.submit()
+        self._waitForFollowers(1)
+
+        self.op.gate.release()
+        result1 = req1.wait()
+        result2 = req2.wait()
+        assert len(self.op.executedRois) == 1
+        assert (result1 == self.data[2:10, 5:20]).all()
+        assert (result2 == self.data[2:10, 5:20]).all()
+        assert result1 is not result2
+
+        # Later requests compute again.
+        assert (self.op.Output[2:10, 5:20].wait() == self.data[2:10, 5:20]).all()
+        assert len(self.op.executedRois) == 2
+
+    def testContained(self):
+        self.op.Output.setRequestDeduplication('contained')
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[3:6, 10:15]
+        req2.submit()
+        destination = numpy.zeros( (6,2), dtype=numpy.uint8 )
+        req3 = self.op.Output[4:10, 5:7].writeInto(destination)
+        req3.submit()
+        self._waitForFollowers(2)
+
+        self.op.gate.release()
+        assert (req1.wait() == self.data[2:10, 5:20]).all()
+        assert (req2.wait() == self.data[3:6, 10:15]).all()
+        assert req3.wait() is destination
+        assert (destination == self.data[4:10, 5:7]).all()
+        assert len(self.op.executedRois) == 1
+
+    def testIdenticalModeDoesNotMergeContainedRois(self):
+        self.op.Output.setRequestDeduplication('identical')
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[3:6, 10:15]
+        req2.submit()
+        self._waitForExecutions(2)
+
+        self.op.gate.release()
+        assert (req1.wait() == self.data[2:10, 5:20]).all()
+        assert (req2.wait() == self.data[3:6, 10:15]).all()
+        assert len(self.op.executedRois) == 2
+
+    def testDirtyDuringExecution(self):
+        self.op.Output.setRequestDeduplication('identical')
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        # After the slot becomes dirty, new requests must not use the running computation.
+        self.data[:] = 0
+        self.op.Input.setDirty()
+        req2 = self.op.Output[2:10, 5:20]
+        req2.submit()
+        self._waitForExecutions(2)
+
+        self.op.gate.release()
+        req1.wait()
+        assert (req2.wait() == 0).all()
+
+    def testDirtyAfterJoining(self):
+        self.op.Output.setRequestDeduplication('identical')
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[2:10, 5:20]
+        req2.submit()
+        self._waitForFollowers(1)
+
+        # The slot becomes dirty after req2 joined req1's computation,
+        #  so req2 must not use req1's result, but compute the data again.
+        self.data[:] = 0
+        self.op.Input.setDirty()
+
+        self.op.gate.release()
+        req1.wait()
+        assert (req2.wait() == 0).all()
+        assert len(self.op.executedRois) == 2
+
+    def testFailedComputation(self):
+        self.op.Output.setRequestDeduplication('identical')
+        self.op.fail = True
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[2:10, 5:20]
+        req2.submit()
+        self._waitForFollowers(1)
+
+        # req2 must compute the data itself (and fail, too).
+        self.op.gate.release()
+        for req in (req1, req2):
+            try:
+                req.wait()
+            except RuntimeError:
+                pass
+            else:
+                assert False, "Expected the request to fail."
+        assert len(self.op.executedRois) == 2
+
+    def testDisabled(self):
+        req1 = self.op.Output[2:10, 5:20]
+        req1.submit()
+        self._waitForExecutions(1)
+
+        req2 = self.op.Output[2:10, 5:20]
+        req2.submit()
+        self._waitForExecutions(2)
+        self.op.gate.release()
+        req1.wait()
+        req2.wait()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
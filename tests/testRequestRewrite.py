@@ -742,6 +742,83 @@ class TestRequest(object):
          
         # Set it back to what it was
         Request.reset_thread_pool(num_workers)
+
+    def testAdmissionControl(self):
+        """
+        Root requests with a RAM estimate are held back if they would exceed the RAM budget.
+        """
+        if Request.global_thread_pool.num_workers == 0:
+            raise nose.SkipTest
+
+        import lazyflow
+        original_ram_mb = lazyflow.AVAILABLE_RAM_MB
+
+        # Choose a budget that fits exactly one of our (pretend) requests in addition to what we're already using.
+        estimate = 1024**3
+        rss = psutil.Process(os.getpid()).memory_info().rss
+        lazyflow.AVAILABLE_RAM_MB = (rss + 1.5*estimate) / 1024**2
+
+        lock = threading.Lock()
+        active = [0]
+        max_active = [0]
+        def work():
+            with lock:
+                active[0] += 1
+                max_active[0] = max( max_active[0], active[0] )
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+        try:
+            reqs = []
+            for _ in range(5):
+                req = Request(work)
+                req.ram_estimate = estimate
+                reqs.append(req)
+
+            for req in reqs:
+                req.submit()
+            for req in reqs:
+                req.wait()
+        finally:
+            lazyflow.AVAILABLE_RAM_MB = original_ram_mb
+
+        assert max_active[0] == 1, "Admission control should have serialized these requests."
+
+    def testRequestPriority(self):
+        """
+        Waiting requests with a higher priority are executed before those with a lower priority.
+        """
+        if Request.global_thread_pool.num_workers == 0:
+            raise nose.SkipTest
+
+        num_workers = Request.global_thread_pool.num_workers
+        Request.reset_thread_pool(num_workers=1)
+
+        try:
+            # Occupy the only worker until all requests have been submitted.
+            gate = threading.Event()
+            blocker = Request( gate.wait )
+            blocker.submit()
+
+            execution_order = []
+            reqs = []
+            for i in range(6):
+                priority = -1 if i % 2 == 0 else 1
+                req = Request( partial( execution_order.append, priority ) )
+                req.set_priority( priority )
+                reqs.append( req )
+                req.submit()
+
+            gate.set()
+            blocker.wait()
+            for req in reqs:
+                req.wait()
+        finally:
+            Request.reset_thread_pool(num_workers)
+
+        assert execution_order == [1,1,1,-1,-1,-1], \
+            "Requests were executed in the wrong order: {}".format( execution_order )
  
  
 class TestRequestExceptions(object):
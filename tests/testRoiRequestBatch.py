@@ -20,11 +20,14 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 import sys
+import time
 import numpy
 import threading
+import nose
 from lazyflow.graph import Graph
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
 from lazyflow.operators import OpArrayPiper
+from lazyflow.request import Request
 
 from lazyflow.utility import RoiRequestBatch
 
@@ -104,6 +107,183 @@ class TestRoiRequestBatch(object):
         else:
             assert False, "Expected exception to be propagated out of the RoiRequestBatch."
 
+    def _blockRois(self):
+        roiList = []
+        block_starts = getIntersectingBlocks( [10,10], ([0,0], [100, 100]) )
+        for block_start in block_starts:
+            roiList.append( getBlockBounds( [100,100], [10,10], block_start ) )
+        return roiList
+
+    def testOrderedResults(self):
+        op = OpArrayPiper( graph=Graph() )
+        inputData = numpy.indices( (100,100) ).sum(0)
+        op.Input.setValue( inputData )
+        roiList = self._blockRois()
+
+        # Count the rois that were taken from the iterator (i.e. requests that were activated)
+        activatedCount = [0]
+        def roiGen():
+            for roi in roiList:
+                activatedCount[0] += 1
+                yield roi
+
+        progressList = []
+        totalVolume = numpy.prod( inputData.shape )
+        batch = RoiRequestBatch(op.Output, roiGen(), totalVolume, batchSize=4)
+        batch.progressSignal.subscribe( lambda progress: progressList.append(progress) )
+
+        bufferSize = 6
+        consumedCount = 0
+        for roi, result in batch.iterResults( bufferSize ):
+            # Results come in roi order
+            assert (numpy.array(roi) == roiList[consumedCount]).all()
+            assert (result == inputData[ roiToSlice( *roi ) ]).all()
+            consumedCount += 1
+
+            # Back-pressure: No more than bufferSize results are held (or requested) at once.
+            assert activatedCount[0] - consumedCount < bufferSize
+        assert consumedCount == len(roiList)
+
+        assert progressList[0] == 0, "Invalid progress reporting."
+        assert progressList[-1] == 100, "Invalid progress reporting."
+
+    def testOrderedResultsFailure(self):
+        class SpecialException(Exception): pass
+        class OpFailingPiper(OpArrayPiper):
+            def execute(self, slot, subindex, roi, result):
+                if tuple(roi.start) == (50, 50):
+                    raise SpecialException("Intentional Exception: raised while computing the result")
+                return super( OpFailingPiper, self ).execute(slot, subindex, roi, result)
+
+        op = OpFailingPiper( graph=Graph() )
+        inputData = numpy.indices( (100,100) ).sum(0)
+        op.Input.setValue( inputData )
+        roiList = self._blockRois()
+
+        consumed = []
+        batch = RoiRequestBatch(op.Output, iter(roiList), batchSize=4)
+        try:
+            for roi, _result in batch.iterResults():
+                consumed.append( roi )
+        except SpecialException:
+            pass
+        else:
+            assert False, "Expected exception to be propagated out of the RoiRequestBatch."
+
+        # All results before the failing block can be consumed, but not the failing block itself.
+        failing_index = [ tuple(roi[0]) for roi in roiList ].index( (50,50) )
+        assert len(consumed) <= failing_index, \
+            "Got {} results".format( len(consumed) )
+
+    def testCancel(self):
+        op = OpArrayPiper( graph=Graph() )
+        inputData = numpy.indices( (100,100) ).sum(0)
+        op.Input.setValue( inputData )
+        roiList = self._blockRois()
+
+        resultsCount = [0]
+        batch = RoiRequestBatch(op.Output, iter(roiList), batchSize=4)
+        def handleResult(roi, result):
+            resultsCount[0] += 1
+            batch.cancel()
+        batch.resultSignal.subscribe( handleResult )
+
+        try:
+            batch.execute()
+        except Request.CancellationException:
+            pass
+        else:
+            assert False, "Expected the batch to be cancelled."
+
+        # No new requests are launched after cancellation.
+        assert resultsCount[0] < len(roiList)
+        assert batch._activated_count <= 1 + 4, \
+            "{} requests were activated".format( batch._activated_count )
+        assert not batch._active_requests
+
+    def testCancelWhileWaitingForResultLock(self):
+        """
+        Cancel the batch while other finished requests are waiting to run their result handler.
+        Their results must be discarded, and execute() must wait for them before it raises.
+        """
+        if Request.global_thread_pool.num_workers < 2:
+            raise nose.SkipTest
+
+        op = OpArrayPiper( graph=Graph() )
+        inputData = numpy.indices( (100,100) ).sum(0)
+        op.Input.setValue( inputData )
+        roiList = self._blockRois()
+
+        resultsCount = [0]
+        batch = RoiRequestBatch(op.Output, iter(roiList), batchSize=4)
+        def handleResult(roi, result):
+            resultsCount[0] += 1
+            # Wait (briefly) until another finished request is blocked on the result lock.
+            timeout = time.time() + 5.0
+            while not batch._resultLock._pendingRequests and time.time() < timeout:
+                time.sleep(0.001)
+            batch.cancel()
+        batch.resultSignal.subscribe( handleResult )
+
+        try:
+            batch.execute()
+        except Request.CancellationException:
+            pass
+        else:
+            assert False, "Expected the batch to be cancelled."
+
+        assert resultsCount[0] == 1, \
+            "Results were delivered after cancellation: {}".format( resultsCount[0] )
+        assert batch._completed_count == batch._activated_count
+        assert not batch._active_requests
+
+    def testCancelOrderedResults(self):
+        op = OpArrayPiper( graph=Graph() )
+        inputData = numpy.indices( (100,100) ).sum(0)
+        op.Input.setValue( inputData )
+        roiList = self._blockRois()
+
+        consumed = []
+        batch = RoiRequestBatch(op.Output, iter(roiList), batchSize=4)
+        try:
+            for roi, _result in batch.iterResults():
+                consumed.append( roi )
+                if len(consumed) == 3:
+                    batch.cancel()
+        except Request.CancellationException:
+            pass
+        else:
+            assert False, "Expected the batch to be cancelled."
+
+        assert len(consumed) == 3
+
+    def testPriorityIgnoredInsideRequest(self):
+        """
+        Inside a request, the batch's requests inherit the parent's priority, so a warning must be logged.
+        """
+        op = OpArrayPiper( graph=Graph() )
+        op.Input.setValue( numpy.indices( (100,100) ).sum(0) )
+
+        messages = []
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                messages.append( record.getMessage() )
+        handler = ListHandler( logging.WARNING )
+        batchLogger = logging.getLogger("lazyflow.utility.roiRequestBatch")
+        batchLogger.addHandler( handler )
+        try:
+            def runBatch():
+                batch = RoiRequestBatch( op.Output, iter(self._blockRois()), batchSize=4, priority=-1 )
+                batch.execute()
+            req = Request( runBatch )
+            req.submit() # (Otherwise, wait() would simply execute runBatch() in this thread.)
+            req.wait()
+        finally:
+            batchLogger.removeHandler( handler )
+
+        assert len(messages) == 1, messages
+        assert "ignored" in messages[0]
+
 if __name__ == "__main__":
     # Run this file independently to see debug output.
     handler = logging.StreamHandler(sys.stdout)
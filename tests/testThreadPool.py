@@ -21,7 +21,7 @@
 ###############################################################################
 import time
 import threading
-from lazyflow.request.threadPool import ThreadPool
+from lazyflow.request.threadPool import ThreadPool, MemoryAdmissionController
 
 class TestThreadPool(object):
     """
@@ -49,9 +49,9 @@ class TestThreadPool(object):
             e1.wait()
             e2.set()
         
-        TestThreadPool.thread_pool.wake_up( f2 )
+        self.thread_pool.wake_up( f2 )
         time.sleep(0.1)
-        TestThreadPool.thread_pool.wake_up( f1 )
+        self.thread_pool.wake_up( f1 )
         
         e2.wait()
         
@@ -130,6 +130,109 @@ class TestThreadPool(object):
         self.thread_pool._wait_for_idle()
 
 
+class TestMemoryAdmissionController(object):
+
+    class FakeProcess(object):
+        def __init__(self, rss):
+            self.rss = rss
+        def memory_info(self):
+            return self
+
+    def setUp(self):
+        import lazyflow
+        self._original_ram_mb = lazyflow.AVAILABLE_RAM_MB
+        lazyflow.AVAILABLE_RAM_MB = 10*1024 # 10 GB
+
+    def tearDown(self):
+        import lazyflow
+        lazyflow.AVAILABLE_RAM_MB = self._original_ram_mb
+
+    def testAdmittedTasksNotCountedTwice(self):
+        GB = 1024**3
+        controller = MemoryAdmissionController( thread_pool=None )
+        controller.process = self.FakeProcess( 1*GB )
+
+        tasks = []
+        for _ in range(3):
+            task = lambda: None
+            task.ram_estimate = 4*GB
+            tasks.append(task)
+
+        assert controller.admit( tasks[0] )
+
+        # The first task has allocated its memory, which is now part of the RSS.
+        # There's still room for the second task (1 + 4 + 4 <= 10 GB), but not for the third.
+        controller.process.rss = 5*GB
+        assert controller.admit( tasks[1] )
+        controller.process.rss = 9*GB
+        assert not controller.admit( tasks[2] )
+
+
+class TestWorkStealingThreadPool(TestThreadPool):
+    """
+    Run the same tests with the work-stealing scheduler, plus a few that are specific to it.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        cls.thread_pool = ThreadPool(num_workers = 4, scheduler='stealing')
+
+    def testSpawnFromWorker(self):
+        """
+        Tasks that are spawned from within a worker land in that worker's local deque,
+        but idle peers must still steal and execute them.
+        """
+        num_children = 20
+        child_threads = []
+        all_done = threading.Event()
+        release = threading.Event()
+        lock = threading.Lock()
+
+        def child():
+            release.wait()
+            with lock:
+                child_threads.append( threading.current_thread() )
+                if len(child_threads) == num_children:
+                    all_done.set()
+
+        def parent():
+            for _ in range(num_children):
+                # Plain functions can't be re-used as tasks (they get an assigned_worker), so make new ones.
+                def f():
+                    child()
+                self.thread_pool.wake_up( f )
+            # The parent is still running, so its own worker can't execute the children.
+            time.sleep(0.2)
+            release.set()
+
+        self.thread_pool.wake_up( parent )
+        assert all_done.wait(5.0), "Not all spawned tasks were executed."
+        assert len( set(child_threads) ) > 1, "Spawned tasks were never stolen by idle workers."
+        self.thread_pool._wait_for_idle()
+
+    def testSpawnSingleChildFromWorker(self):
+        """
+        A single task spawned from a worker that keeps running must be picked up by an idle peer.
+        """
+        child_done = threading.Event()
+        parent_done = threading.Event()
+        results = []
+
+        def child():
+            child_done.set()
+
+        def parent():
+            self.thread_pool.wake_up( child )
+            # Keep running (don't yield) until the child has been executed elsewhere.
+            results.append( child_done.wait(5.0) )
+            parent_done.set()
+
+        self.thread_pool.wake_up( parent )
+        assert parent_done.wait(10.0), "The parent task never finished."
+        assert results == [True], "The spawned task wasn't started while its parent kept running."
+        self.thread_pool._wait_for_idle()
+
+
 if __name__ == "__main__":
     import sys
     import nose
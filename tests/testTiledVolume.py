@@ -7,11 +7,12 @@ import copy
 import SimpleHTTPServer
 import SocketServer
 import nose
+from functools import partial
 
 from lazyflow.utility.io.tiledVolume import TiledVolume
 from lazyflow.utility import PathComponents, export_to_tiles
 from lazyflow.utility.jsonConfig import JsonConfigParser
-from lazyflow.roi import roiToSlice
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 
 # See 'main' section below for logging configuration.
 import logging
@@ -82,6 +83,9 @@ class DataSetup(object):
         self.TRANSPOSED_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'transposed_volume_description.json' )
         self.TRANSLATED_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'translated_volume_description.json' )
         self.SPECIAL_Z_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'special_z_volume_description.json' )
+        self.CACHED_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'cached_volume_description.json' )
+        self.TRANSFORMED_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'transformed_volume_description.json' )
+        self.POINTWISE_VOLUME_DESCRIPTION_FILE = os.path.join( self.TILE_DIRECTORY, 'pointwise_volume_description.json' )
     
         if not os.path.exists(self.TILE_DIRECTORY):
             print "Creating new tile directory: {}".format( self.TILE_DIRECTORY )
@@ -96,7 +100,9 @@ class DataSetup(object):
                 ref_vol = ref_file[ref_vol_path_comp.internalPath][:] 
     
         need_rewrite = False
-        if not os.path.exists( self.VOLUME_DESCRIPTION_FILE ):
+        if not os.path.exists( self.VOLUME_DESCRIPTION_FILE ) \
+        or not os.path.exists( self.CACHED_VOLUME_DESCRIPTION_FILE ) \
+        or not os.path.exists( self.POINTWISE_VOLUME_DESCRIPTION_FILE ):
             need_rewrite = True
         else:
             with open(self.VOLUME_DESCRIPTION_FILE, 'r') as f:
@@ -134,6 +140,25 @@ class DataSetup(object):
             special_z_description = copy.copy(volume_description)
             special_z_description.z_translation_function = "lambda z: z+11"
             config_helper.writeConfigFile(self.SPECIAL_Z_VOLUME_DESCRIPTION_FILE, special_z_description)
+
+            # Write out another copy of the description, but with the decoded-tile cache enabled.
+            config_helper = JsonConfigParser( TiledVolume.DescriptionFields )
+            cached_description = copy.copy(volume_description)
+            cached_description.cache_tiles = True
+            config_helper.writeConfigFile(self.CACHED_VOLUME_DESCRIPTION_FILE, cached_description)
+
+            # Write out another copy of the description, with both special functions.
+            config_helper = JsonConfigParser( TiledVolume.DescriptionFields )
+            transformed_description = copy.copy(volume_description)
+            transformed_description.z_translation_function = "lambda z: z+11"
+            transformed_description.data_transform_function = "lambda a: (a/3) + (a > 128)"
+            config_helper.writeConfigFile(self.TRANSFORMED_VOLUME_DESCRIPTION_FILE, transformed_description)
+
+            # ...and once more, but with a pointwise transform (applied via a lookup table).
+            config_helper = JsonConfigParser( TiledVolume.DescriptionFields )
+            pointwise_description = copy.copy(transformed_description)
+            pointwise_description.data_transform_is_pointwise = True
+            config_helper.writeConfigFile(self.POINTWISE_VOLUME_DESCRIPTION_FILE, pointwise_description)
     
             # Remove all old image tiles in the tile directory
             files = os.listdir(self.TILE_DIRECTORY)
@@ -260,6 +285,44 @@ class TestTiledVolume(object):
    
         assert (expected == result_out).all()
 
+    def testTileCache(self):
+        tiled_volume = TiledVolume( self.data_setup.CACHED_VOLUME_DESCRIPTION_FILE )
+        tiled_volume.TEST_MODE = True
+        roi = numpy.array( [(10, 150, 100), (12, 550, 550)] )
+        result_out = numpy.zeros( roi[1] - roi[0], dtype=tiled_volume.description.dtype )
+        tiled_volume.read( roi, result_out )
+        assert tiled_volume._tile_cache.hits == 0
+
+        # Read an overlapping roi: The shared tiles are not downloaded again.
+        roi2 = numpy.array( [(11, 100, 100), (12, 300, 300)] )
+        result_out2 = numpy.zeros( roi2[1] - roi2[0], dtype=tiled_volume.description.dtype )
+        tiled_volume.read( roi2, result_out2 )
+        assert tiled_volume._tile_cache.hits == 4
+        tiled_volume.close()
+
+        ref_path_comp = PathComponents(self.data_setup.REFERENCE_VOL_PATH)
+        with h5py.File(ref_path_comp.externalPath, 'r') as f:
+            ref_data = f[ref_path_comp.internalPath][:]
+
+        assert (ref_data[roiToSlice(*roi)] == result_out).all()
+        assert (ref_data[roiToSlice(*roi2)] == result_out2).all()
+
+    def testTileCacheDisabledByDefault(self):
+        tiled_volume = TiledVolume( self.data_setup.VOLUME_DESCRIPTION_FILE )
+        tiled_volume.TEST_MODE = True
+        assert not tiled_volume.description.cache_tiles
+        roi = numpy.array( [(10, 150, 100), (12, 550, 550)] )
+        result_out = numpy.zeros( roi[1] - roi[0], dtype=tiled_volume.description.dtype )
+        tiled_volume.read( roi, result_out )
+
+        # Reading the same roi again downloads every tile again.
+        result_out2 = numpy.zeros_like( result_out )
+        tiled_volume.read( roi, result_out2 )
+        assert tiled_volume._tile_cache.hits == 0
+        tiled_volume.close()
+
+        assert (result_out == result_out2).all()
+
 class TestLocalTiledVolume(object):
 
     @classmethod
@@ -389,6 +452,68 @@ class TestSpecialZTranslation(object):
  
         assert (expected == result_out).all()
 
+class TestDescriptionFunctions(object):
+    """
+    The description's z_translation_function and data_transform_function are compiled once (not eval'd for every tile),
+    and pointwise transforms of uint8 data are applied via a lookup table.  The results must not change.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        cls.data_setup = DataSetup()
+        cls.data_setup.setup()
+
+    @classmethod
+    def teardownClass(cls):
+        cls.data_setup.teardown()
+
+    def _evalPerTile(self, description, ref_data, roi):
+        """
+        Compute the expected result the way TiledVolume used to:
+        by eval()'ing the description's functions for every tile (and transforming the output array).
+        """
+        expected = numpy.zeros( roi[1] - roi[0], dtype=description.dtype )
+        tile_blockshape = (1,) + tuple(description.tile_shape_2d_yx)
+        for tile_start in getIntersectingBlocks( tile_blockshape, roi ):
+            tile_roi = numpy.array( getBlockBounds( description.bounds_zyx, tile_blockshape, tile_start ) )
+            intersecting_roi = numpy.array( getIntersection( roi, tile_roi ) )
+
+            z_update_func = eval(description.z_translation_function)
+            source_roi = intersecting_roi.copy()
+            source_roi[0][0] = z_update_func( intersecting_roi[0][0] )
+            source_roi[1][0] = source_roi[0][0] + 1
+
+            data_out = expected[roiToSlice(*(intersecting_roi - roi[0]))]
+            data_out[:] = ref_data[roiToSlice(*source_roi)]
+            transform = eval(description.data_transform_function)
+            data_out[:] = transform(data_out)
+        return expected
+
+    def _checkFunctions(self, description_file):
+        tiled_volume = TiledVolume( description_file )
+        tiled_volume.TEST_MODE = True
+        roi = numpy.array( [(20, 150, 100), (30, 550, 550)] )
+        result_out = numpy.zeros( roi[1] - roi[0], dtype=tiled_volume.description.dtype )
+        tiled_volume.read( roi, result_out )
+        tiled_volume.close()
+
+        ref_path_comp = PathComponents(self.data_setup.REFERENCE_VOL_PATH)
+        with h5py.File(ref_path_comp.externalPath, 'r') as f:
+            ref_data = f[ref_path_comp.internalPath][:]
+
+        expected = self._evalPerTile( tiled_volume.description, ref_data, roi )
+        assert (expected == result_out).all()
+        return tiled_volume
+
+    def testCompiledFunctions(self):
+        tiled_volume = self._checkFunctions( self.data_setup.TRANSFORMED_VOLUME_DESCRIPTION_FILE )
+        assert not isinstance( tiled_volume._data_transform, partial )
+
+    def testLookupTableTransform(self):
+        tiled_volume = self._checkFunctions( self.data_setup.POINTWISE_VOLUME_DESCRIPTION_FILE )
+        assert isinstance( tiled_volume._data_transform, partial ), \
+            "Expected the pointwise transform to be applied via a lookup table"
+
 if __name__ == "__main__":
     # Logging is OFF by default when running from command-line nose, i.e.:
     # nosetests thisFile.py)